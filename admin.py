@@ -0,0 +1,117 @@
+"""Local control socket for a running mailserver.py
+
+mailserver.py --admin-socket PATH listens on a Unix stream socket and
+mailctl.py talks to it. A request is one line, "COMMAND [ARG]", and the
+reply is one line of JSON: the command's result, or {"error": "..."}.
+Several requests can be sent on one connection.
+
+Commands only read state the server keeps anyway (the metrics registry,
+the session tables, the traffic counts) or call reload/drain hooks, so
+serving them adds nothing to the SMTP sessions themselves. Access is
+controlled by the socket's file mode (0600 by default).
+"""
+
+import asyncio
+import inspect
+import json
+import os
+import socket
+import tempfile
+
+
+class AdminServer:
+    def __init__(self, path, commands, mode=0o600):
+        """commands maps a name to fn(arg) returning a JSON-serialisable result
+
+        fn may be a coroutine function; arg is the rest of the line, or ''.
+        """
+        self.path = path
+        self.commands = dict(commands)
+        self.commands.setdefault('help', lambda arg: sorted(self.commands))
+        self.mode = mode
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except ConnectionRefusedError:
+                os.unlink(self.path)     # left behind by a previous run
+            else:
+                raise OSError(f"{self.path} is in use by another process")
+            finally:
+                probe.close()
+        self.server = await asyncio.start_unix_server(self.handle, sock=self._bind())
+
+    def _bind(self):
+        """A socket bound at path that was never reachable with looser permissions than mode
+
+        bind() creates the file with the umask's permissions, so it is bound
+        inside a private 0700 directory, chmod'ed, then renamed into place.
+        The umask is process-wide, so it is left alone.
+        """
+        private = tempfile.mkdtemp(prefix='.admin-', dir=os.path.dirname(os.path.abspath(self.path)))
+        tmp = os.path.join(private, 's')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(tmp)
+            os.chmod(tmp, self.mode)
+            os.rename(tmp, self.path)
+        except BaseException:
+            sock.close()
+            raise
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            os.rmdir(private)
+        return sock
+
+    async def run(self, line):
+        name, _, arg = line.strip().partition(' ')
+        command = self.commands.get(name.lower())
+        if command is None:
+            return {'error': f"unknown command {name!r}, try help"}
+        try:
+            result = command(arg.strip())
+            if inspect.isawaitable(result):
+                result = await result
+        except ValueError as e:
+            return {'error': str(e)}
+        except Exception as e:
+            print(f"⚠️  Admin command {name!r} failed: {e}")
+            return {'error': f"{name} failed: {type(e).__name__}: {e}"}
+        return result
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                result = await self.run(line.decode('utf-8', 'replace'))
+                writer.write(json.dumps(result, default=str).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+def request(path, line, timeout=10.0):
+    """Send one command to the admin socket at path and return the decoded reply"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(line.encode() + b'\n')
+        reply = sock.makefile('rb').readline()
+    if not reply:
+        raise ConnectionError("admin socket closed without replying")
+    return json.loads(reply)
@@ -0,0 +1,148 @@
+"""Content-addressed attachment storage
+
+Attachments are decoded chunk by chunk straight into a temporary file while
+their sha256 is computed, then moved to blobs/<ab>/<cd>/<sha256>. A blob
+that already exists is not written again. blobs.db records each digest's
+size, so the store's total can be capped with max_total.
+
+Base64 is decoded as leniently as the email package does: characters
+outside the alphabet are skipped and missing padding is filled in, so a
+slightly malformed attachment is still saved rather than failing the
+whole message.
+"""
+
+import binascii
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+from pathlib import Path
+
+from fast_decode import raw_headers
+
+CHUNK = 64 * 1024
+_BASE64_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+# Everything else is dropped before decoding, padding included; padding is
+# recomputed from the length of the final quantum
+_NOT_BASE64 = bytes(c for c in range(256) if c not in _BASE64_ALPHABET)
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+def _base64_chunks(payload):
+    """Decode a base64 payload string in bounded chunks"""
+    pending = b''
+    for start in range(0, len(payload), CHUNK):
+        data = pending + payload[start:start + CHUNK].encode('ascii', 'ignore').translate(None, _NOT_BASE64)
+        usable = len(data) - len(data) % 4
+        pending = data[usable:]
+        if usable:
+            yield binascii.a2b_base64(data[:usable])
+    if len(pending) > 1:
+        # A single leftover character carries less than a byte and is dropped
+        yield binascii.a2b_base64(pending + b'=' * (-len(pending) % 4))
+
+
+def _qp_chunks(payload):
+    """Decode a quoted-printable payload string on line boundaries"""
+    start = 0
+    while start < len(payload):
+        end = payload.find('\n', start + CHUNK)
+        end = len(payload) if end == -1 else end + 1
+        yield binascii.a2b_qp(payload[start:end].encode('ascii', 'surrogateescape'))
+        start = end
+
+
+def decoded_chunks(part):
+    """Yield the decoded bytes of a MIME part without building the whole payload"""
+    if part.is_multipart():
+        return iter(())
+    _, cte = raw_headers(part)
+    cte = cte.strip().lower() if cte else '7bit'
+    if cte in ('base64', 'quoted-printable'):
+        # ASCII payloads come back from get_payload() as stored, uncopied
+        payload = part.get_payload()
+        return _base64_chunks(payload) if cte == 'base64' else _qp_chunks(payload)
+    # get_payload() without decode would re-decode 8bit payloads with the
+    # part's charset; decode=True gives the original bytes back
+    payload = part.get_payload(decode=True) or b''
+    return (payload[start:start + CHUNK] for start in range(0, len(payload), CHUNK))
+
+
+class BlobStore:
+    def __init__(self, directory, max_size=25 * 1024 * 1024, max_total=None):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.max_total = max_total
+        (self.directory / 'tmp').mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        if (self.directory / 'refs.db').exists() and not (self.directory / 'blobs.db').exists():
+            # Stores from before the reference counts were dropped
+            os.replace(self.directory / 'refs.db', self.directory / 'blobs.db')
+        self._db = sqlite3.connect(self.directory / 'blobs.db', check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER NOT NULL)')
+        if 'refs' in {row[1] for row in self._db.execute('PRAGMA table_info(blobs)')}:
+            self._db.execute('ALTER TABLE blobs DROP COLUMN refs')
+        self._db.commit()
+        self.total_size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def path_for(self, digest):
+        return self.directory / digest[:2] / digest[2:4] / digest
+
+    def put_chunks(self, chunks):
+        """Store a stream of bytes and return (sha256 hex digest, size)"""
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.directory / 'tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_size:
+                        raise AttachmentTooLarge(f"attachment exceeds {self.max_size} bytes")
+                    sha.update(chunk)
+                    f.write(chunk)
+            digest = sha.hexdigest()
+            with self._lock:
+                row = self._db.execute('SELECT 1 FROM blobs WHERE digest = ?', (digest,)).fetchone()
+                if row is None:
+                    if self.max_total is not None and self.total_size + size > self.max_total:
+                        raise AttachmentTooLarge(f"blob store is full ({self.max_total} bytes)")
+                    path = self.path_for(digest)
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(tmp, path)
+                    tmp = None
+                    self._db.execute('INSERT INTO blobs VALUES (?, ?)', (digest, size))
+                    self._db.commit()
+                    self.total_size += size
+            return digest, size
+        finally:
+            if tmp is not None:
+                os.unlink(tmp)
+
+
+def is_attachment(part):
+    if part.is_multipart():
+        return False
+    if part.get_content_disposition() == 'attachment':
+        return True
+    return part.get_content_maintype() not in ('text', 'multipart', 'message')
+
+
+def save_attachments(msg, store):
+    """Write every attachment of msg into store and describe what was saved"""
+    saved = []
+    for part in msg.walk():
+        if not is_attachment(part):
+            continue
+        info = {'filename': part.get_filename(), 'content_type': part.get_content_type()}
+        try:
+            info['sha256'], info['size'] = store.put_chunks(decoded_chunks(part))
+        except (AttachmentTooLarge, binascii.Error) as e:
+            info['skipped'] = str(e)
+        saved.append(info)
+    return saved
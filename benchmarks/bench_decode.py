@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Compare fast_decode against part.get_content() over a message corpus"""
+
+import argparse
+import os
+import sys
+import time
+from email import message_from_bytes
+from email.policy import default
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fast_decode import content_type, decode_command, get_text
+import corpus
+
+COMMANDS = [b"EHLO mail.example.com\r\n", b"MAIL FROM:<sender@example.com> SIZE=1024\r\n",
+            b"RCPT TO:<rcpt@example.com>\r\n", b"DATA\r\n", b"QUIT\r\n"]
+
+
+def text_parts(raw):
+    msg = message_from_bytes(raw, policy=default)
+    return [part for part in msg.walk()
+            if not part.is_multipart() and part.get_content_maintype() == 'text']
+
+
+def timed(fn, items, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for item in items:
+            fn(item)
+    return (time.perf_counter() - start) / (rounds * len(items))
+
+
+def run(messages, rounds=200):
+    # Parse once and keep fresh copies per decoder so neither side benefits
+    # from header objects cached on the message by the other.
+    results = {}
+    for name, raw in messages:
+        parts = text_parts(raw)
+        if not parts:
+            continue
+        for part in parts:
+            if get_text(part) != part.get_content():
+                raise AssertionError(f"{name}: fast path output differs from get_content()")
+        stdlib = timed(lambda p: (p.get_content_type(), p.get_content()), text_parts(raw), rounds)
+        fast = timed(lambda p: (content_type(p), get_text(p)), text_parts(raw), rounds)
+        results[name] = {'stdlib_us': stdlib * 1e6, 'fast_us': fast * 1e6}
+
+    lines = COMMANDS * 1000
+    results['commands'] = {
+        'stdlib_us': timed(lambda l: l.decode('utf-8', errors='ignore'), lines, 20) * 1e6,
+        'fast_us': timed(decode_command, lines, 20) * 1e6,
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MIME text decoding microbenchmark')
+    parser.add_argument('--corpus', help='Directory of .eml files to use instead of the built-in corpus')
+    parser.add_argument('--rounds', type=int, default=200, help='Repetitions per message (default: 200)')
+    args = parser.parse_args()
+
+    if args.corpus:
+        messages = [(p.name, p.read_bytes()) for p in sorted(Path(args.corpus).glob('*.eml'))]
+    else:
+        messages = corpus.build()
+
+    results = run(messages, args.rounds)
+    print(f"{'case':<24} {'stdlib µs':>10} {'fast µs':>10} {'speedup':>8}")
+    for name, r in results.items():
+        print(f"{name:<24} {r['stdlib_us']:>10.2f} {r['fast_us']:>10.2f} {r['stdlib_us'] / r['fast_us']:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
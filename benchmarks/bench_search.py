@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Benchmark search index throughput and query latency"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from search_index import SearchIndex
+
+WORDS = ("invoice meeting report deploy server outage password reset order "
+         "shipment newsletter weekly update receipt payment failed success "
+         "alert cpu memory disk backup schedule review approve").split()
+
+
+def make_doc(rng):
+    subject = ' '.join(rng.choices(WORDS, k=5))
+    body = ' '.join(rng.choices(WORDS, k=200))
+    return subject, body
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(docs=20000, queries=500, seed=1):
+    rng = random.Random(seed)
+    corpus = [make_doc(rng) for _ in range(docs)]
+    with tempfile.TemporaryDirectory() as tmp:
+        index = SearchIndex(os.path.join(tmp, 'search.db'))
+        start = time.perf_counter()
+        for subject, body in corpus:
+            index.add(subject, body, 'sender@example.com', ['rcpt@example.com'])
+        index.flush()
+        index_seconds = time.perf_counter() - start
+
+        latencies = []
+        for _ in range(queries):
+            q = ' '.join(rng.choices(WORDS, k=2))
+            start = time.perf_counter()
+            index.search(q, limit=20)
+            latencies.append(time.perf_counter() - start)
+        index.close()
+
+    return {
+        'index_docs_per_sec': docs / index_seconds,
+        'query_p50_ms': percentile(latencies, 0.50) * 1000,
+        'query_p95_ms': percentile(latencies, 0.95) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search index benchmark')
+    parser.add_argument('--docs', type=int, default=20000, help='Documents to index (default: 20000)')
+    parser.add_argument('--queries', type=int, default=500, help='Queries to time (default: 500)')
+    args = parser.parse_args()
+
+    results = run(args.docs, args.queries)
+    print(f"📇 Indexed {args.docs} docs: {results['index_docs_per_sec']:.0f} docs/s")
+    print(f"🔎 Query latency: p50 {results['query_p50_ms']:.2f} ms, p95 {results['query_p95_ms']:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
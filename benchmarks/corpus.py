@@ -0,0 +1,70 @@
+"""Deterministic message corpus shared by the benchmarks"""
+
+import random
+from email.message import EmailMessage
+from email.policy import SMTP
+
+LOREM = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+         "tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(LOREM) for _ in range(words))
+
+
+def _message(subject, sender='sender@example.com', to='rcpt@example.com'):
+    msg = EmailMessage(policy=SMTP)
+    msg['From'] = sender
+    msg['To'] = to
+    msg['Subject'] = subject
+    msg['Message-ID'] = f'<{abs(hash(subject))}@example.com>'
+    return msg
+
+
+def plain(rng, words=300, charset='utf-8', cte=None):
+    msg = _message('plain message')
+    text = _text(rng, words)
+    if charset != 'us-ascii':
+        text += ' café ünïcödé'
+    msg.set_content(text, charset=charset, cte=cte)
+    return msg.as_bytes()
+
+
+def multipart(rng, words=300):
+    msg = _message('multipart message')
+    text = _text(rng, words)
+    msg.set_content(text)
+    msg.add_alternative(f'<html><body><p>{text}</p></body></html>', subtype='html')
+    return msg.as_bytes()
+
+
+def html_only(rng, words=3000):
+    msg = _message('html newsletter')
+    rows = ''.join(f'<tr><td style="padding:4px">{_text(rng, 20)}</td></tr>'
+                   for _ in range(words // 20))
+    msg.set_content(f'<html><head><style>td{{color:#333}}</style></head>'
+                    f'<body><table>{rows}</table></body></html>', subtype='html')
+    return msg.as_bytes()
+
+
+def with_attachment(rng, size=2 * 1024 * 1024):
+    msg = _message('message with attachment')
+    msg.set_content(_text(rng, 100))
+    msg.add_attachment(rng.randbytes(size), maintype='application', subtype='pdf',
+                       filename='report.pdf')
+    return msg.as_bytes()
+
+
+def build(seed=42):
+    """Return [(name, raw message bytes), ...]"""
+    rng = random.Random(seed)
+    return [
+        ('plain-ascii-7bit', plain(rng, charset='us-ascii')),
+        ('plain-utf8-8bit', plain(rng, cte='8bit')),
+        ('plain-utf8-qp', plain(rng, cte='quoted-printable')),
+        ('plain-utf8-base64', plain(rng, cte='base64')),
+        ('plain-latin1-qp', plain(rng, charset='iso-8859-1', cte='quoted-printable')),
+        ('multipart-alternative', multipart(rng)),
+        ('html-only', html_only(rng)),
+        ('large-attachment', with_attachment(rng)),
+    ]
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""HTTP load generator for webserver.py
+
+    ./webserver --no-tls --port 8080 > /dev/null &
+    python benchmarks/http_load.py --port 8080 --connections 64 --duration 10
+
+    ./webserver --no-tls --port 8080 --production --workers 4 > /dev/null &
+    python benchmarks/http_load.py --port 8080 --connections 64 --duration 10
+
+Each connection is a keep-alive HTTP/1.1 client posting the same email
+JSON in a loop. Reports requests/second, latency percentiles and the
+status codes seen.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+
+SAMPLE = {
+    "from": "sender@example.com",
+    "to": ["inbox@example.org"],
+    "subject": "Load test message",
+    "text": "Hello,\n\nThis is a load-test message body.\n" * 20,
+    "headers": {"message-id": "<load@example.com>"},
+}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    length = 0
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    if length:
+        await reader.readexactly(length)
+    return status
+
+
+async def client(args, request, deadline, latencies, statuses):
+    while time.monotonic() < deadline:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+        try:
+            while time.monotonic() < deadline:
+                began = time.perf_counter()
+                writer.write(request)
+                await writer.drain()
+                statuses[await read_response(reader)] += 1
+                latencies.append(time.perf_counter() - began)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            statuses['reset'] += 1  # reconnect and carry on
+        finally:
+            writer.close()
+
+
+async def run(args):
+    body = json.dumps(SAMPLE).encode()
+    request = (f"POST {args.path} HTTP/1.1\r\nHost: {args.host}\r\n"
+               f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n").encode() + body
+    latencies = []
+    statuses = Counter()
+    started = time.monotonic()
+    deadline = started + args.duration
+    await asyncio.gather(*(client(args, request, deadline, latencies, statuses)
+                           for _ in range(args.connections)))
+    return latencies, statuses, time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='POST emails to webserver.py as fast as it answers')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--path', default='/email')
+    parser.add_argument('--connections', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--json', action='store_true', help='Print the result as JSON')
+    args = parser.parse_args()
+
+    latencies, statuses, elapsed = asyncio.run(run(args))
+    result = {
+        'requests': len(latencies),
+        'requests_per_sec': round(len(latencies) / elapsed, 1),
+        'latency_p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'latency_p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'statuses': dict(statuses),
+    }
+    if args.json:
+        print(json.dumps(result))
+        return
+    print(f"{result['requests']} requests in {elapsed:.1f}s: {result['requests_per_sec']} req/s")
+    print(f"latency p50 {result['latency_p50_ms']}ms  p95 {result['latency_p95_ms']}ms  "
+          f"p99 {result['latency_p99_ms']}ms")
+    print(f"status codes: {dict(statuses)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for the parsing and protocol hot paths, with baselines
+
+    python benchmarks/run.py                          # run every case
+    python benchmarks/run.py --save baseline.json     # ... and keep the results
+    python benchmarks/run.py --only 'read_data/*'     # some of them
+    python benchmarks/run.py compare baseline.json    # run again, flag regressions
+    python benchmarks/run.py compare old.json new.json --threshold 0.15
+
+Cases:
+    handle_DATA/*     EmailHandler.handle_DATA (print route) on the corpus
+    read_data/*       DATA terminator scanning and dot-unstuffing
+    commands/*        decoding and splitting SMTP command lines
+    server/*          MailServer start/stop, and one SMTP session over loopback
+    receive_email/*   webserver.py: Email validation, and POST /email end to end
+
+Each case runs in rounds of enough calls to take --min-time seconds; the
+figure reported is the median time per call across rounds, which is
+steadier than the mean on a busy machine. compare exits with status 1 when
+a case is slower than its baseline by more than the threshold.
+
+Everything runs offline in this process: SMTP reads go through an
+in-memory StreamReader and POST /email is a synthetic ASGI request, so no
+sockets, DNS or other services are needed. Console output from the code
+under test goes to /dev/null.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import fnmatch
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import corpus
+
+COMMANDS = [b"EHLO mail.example.com\r\n", b"MAIL FROM:<sender@example.com> SIZE=1024 BODY=8BITMIME\r\n",
+            b"RCPT TO:<rcpt@example.com>\r\n", b"RCPT TO:<other@example.com> NOTIFY=NEVER\r\n",
+            b"DATA\r\n", b"QUIT\r\n"]
+
+
+def wire_format(raw):
+    """raw as a client sends it after DATA: CRLF lines, dot-stuffed, terminated"""
+    lines = raw.replace(b'\r\n', b'\n').split(b'\n')
+    if lines[-1] == b'':
+        lines.pop()
+    return b''.join((b'.' + line if line[:1] == b'.' else line) + b'\r\n' for line in lines) + b'.\r\n'
+
+
+def dotted_message(lines=2000):
+    """A body where every other line starts with a dot, to weigh unstuffing"""
+    body = b''.join(b'.%d leading dot\r\nplain line %d\r\n' % (i, i) for i in range(lines // 2))
+    return b'From: a@example.com\r\nTo: b@example.com\r\nSubject: dots\r\n\r\n' + body
+
+
+def smtp_cases(messages):
+    from mailserver import EmailHandler, MailServer, path_address, read_data
+    from budget import DataBuffer
+    from fast_decode import decode_command
+
+    cases = {}
+    handler = EmailHandler()
+    session = type('Session', (), {'peer': ('192.0.2.1', 40000)})()
+
+    def handle_data(raw):
+        envelope = type('Envelope', (), {'mail_from': 'sender@example.com',
+                                         'rcpt_tos': ['rcpt@example.com'], 'content': raw})()
+
+        async def calls(n):
+            for _ in range(n):
+                result = await handler.handle_DATA(None, session, envelope)
+                if not result.startswith('250'):
+                    raise AssertionError(f"handle_DATA returned {result!r}")
+        return calls
+
+    for name, raw in messages:
+        cases[f'handle_DATA/{name}'] = handle_data(raw)
+
+    def read(wire):
+        async def calls(n):
+            for _ in range(n):
+                reader = asyncio.StreamReader()
+                reader.feed_data(wire)
+                reader.feed_eof()
+                buffer = DataBuffer()
+                await read_data(reader, buffer)
+                if buffer.size >= len(wire):
+                    raise AssertionError("terminator not found")
+        return calls
+
+    sources = dict(messages)
+    cases['read_data/plain'] = read(wire_format(sources['plain-utf8-qp']))
+    cases['read_data/large-attachment'] = read(wire_format(sources['large-attachment']))
+    cases['read_data/dot-stuffed'] = read(wire_format(dotted_message()))
+
+    def parse_commands(n):
+        for _ in range(n):
+            for line in COMMANDS:
+                parts = decode_command(line).strip().split(None, 1)
+                cmd = parts[0].upper()
+                if cmd == 'MAIL':
+                    path_address(parts[1], 'FROM:')
+                elif cmd == 'RCPT':
+                    path_address(parts[1], 'TO:')
+    cases['commands/session'] = parse_commands
+
+    class Accept:
+        async def handle_DATA(self, server, session, envelope):
+            return '250 OK'
+
+    async def start_stop(n):
+        for _ in range(n):
+            async with MailServer(Accept()):
+                pass
+
+    transaction = (b"EHLO bench.example.com\r\nMAIL FROM:<sender@example.com>\r\n"
+                   b"RCPT TO:<rcpt@example.com>\r\nDATA\r\n")
+    data = wire_format(sources['plain-utf8-qp']) + b"QUIT\r\n"
+
+    async def session(n):
+        async with MailServer(Accept()) as server:
+            for _ in range(n):
+                reader, writer = await asyncio.open_connection(*server.address)
+                writer.write(transaction)
+                # Banner, the EHLO lines, MAIL, RCPT and the 354
+                while not (await reader.readline()).startswith(b'354'):
+                    pass
+                writer.write(data)
+                if not (await reader.readline()).startswith(b'250'):
+                    raise AssertionError("message not accepted")
+                await reader.readline()
+                writer.close()
+                await writer.wait_closed()
+
+    cases['server/start-stop'] = start_stop
+    cases['server/session'] = session
+    return cases
+
+
+def http_cases(messages):
+    import webserver
+    from starlette.requests import Request
+
+    small = {'from': 'sender@example.com', 'to': ['inbox@example.org'], 'subject': 'Benchmark',
+             'text': 'Hello,\n\nThis is a benchmark message body.\n' * 20,
+             'headers': {'message-id': '<bench@example.com>'}}
+    with_raw = dict(small, raw=dict(messages)['multipart-alternative'].decode())
+
+    def validate(n):
+        fields = dict(small, from_=small['from'])
+        del fields['from']
+        for _ in range(n):
+            webserver.Email(**fields)
+
+    def post(payload):
+        body = json.dumps(payload).encode()
+        scope = {'type': 'http', 'method': 'POST', 'path': '/email', 'query_string': b'',
+                 'headers': [(b'content-type', b'application/json'),
+                             (b'content-length', str(len(body)).encode())]}
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def calls(n):
+            for _ in range(n):
+                result = await webserver.post_email(Request(scope, receive))
+                if result.get('status') != 'success':
+                    raise AssertionError(f"post_email returned {result!r}")
+        return calls
+
+    return {'receive_email/validate': validate,
+            'receive_email/post': post(small),
+            'receive_email/post-raw': post(with_raw)}
+
+
+def collect(only):
+    messages = corpus.build()
+    cases = {}
+    for group in (smtp_cases, http_cases):
+        try:
+            cases.update(group(messages))
+        except ImportError as e:
+            print(f"⚠️  Skipping {group.__name__[:-6]} cases: {e}", file=sys.stderr)
+    if only:
+        cases = {name: fn for name, fn in cases.items()
+                 if any(fnmatch.fnmatch(name, pattern) for pattern in only)}
+    return cases
+
+
+def measure(fn, rounds, min_time):
+    """Median and minimum seconds per call of fn(n), run in timed rounds"""
+    loop = asyncio.new_event_loop()
+
+    def call(n):
+        result = fn(n)
+        if asyncio.iscoroutine(result):
+            loop.run_until_complete(result)
+
+    def timed(n):
+        start = time.perf_counter()
+        call(n)
+        return time.perf_counter() - start
+
+    try:
+        # Warm up, then find a call count that fills min_time
+        n = 1
+        elapsed = timed(n)
+        while elapsed < min_time:
+            n = max(n * 2, int(n * min_time / max(elapsed, 1e-9) * 1.2))
+            elapsed = timed(n)
+        gc.collect()
+        per_call = [timed(n) / n for _ in range(rounds)]
+    finally:
+        loop.close()
+    return {'median_us': statistics.median(per_call) * 1e6, 'min_us': min(per_call) * 1e6,
+            'rounds': rounds, 'calls': n}
+
+
+def run(only=(), rounds=7, min_time=0.1):
+    results = {}
+    with open(os.devnull, 'w') as devnull:
+        for name, fn in collect(only).items():
+            with contextlib.redirect_stdout(devnull):
+                results[name] = measure(fn, rounds, min_time)
+            print(f"{name:<36} {results[name]['median_us']:>12.2f} µs", file=sys.stderr)
+    return {'meta': {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                     'python': platform.python_version(), 'implementation': platform.python_implementation(),
+                     'machine': platform.machine(), 'host': platform.node()},
+            'results': results}
+
+
+def compare(baseline, current, threshold):
+    """Print both runs side by side; returns the names of regressed cases"""
+    for key in ('python', 'implementation', 'machine'):
+        if baseline['meta'].get(key) != current['meta'].get(key):
+            print(f"⚠️  {key} differs: baseline {baseline['meta'].get(key)}, "
+                  f"current {current['meta'].get(key)}")
+    regressions = []
+    print(f"{'case':<36} {'baseline µs':>12} {'current µs':>12} {'change':>8}")
+    for name in sorted(baseline['results'].keys() | current['results'].keys()):
+        old = baseline['results'].get(name)
+        new = current['results'].get(name)
+        if old is None or new is None:
+            print(f"{name:<36} {'new' if old is None else 'not run':>12}")
+            continue
+        change = new['median_us'] / old['median_us'] - 1
+        mark = ''
+        if change > threshold:
+            mark = '🔴 slower'
+            regressions.append(name)
+        elif change < -threshold:
+            mark = '🟢 faster'
+        print(f"{name:<36} {old['median_us']:>12.2f} {new['median_us']:>12.2f} {change:>+8.1%} {mark}")
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+        f.write('\n')
+    print(f"💾 Saved {len(results['results'])} results to {path}", file=sys.stderr)
+
+
+def main():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--only', action='append', default=[], metavar='PATTERN',
+                        help='Run only cases matching this glob, e.g. "read_data/*" (repeatable)')
+    common.add_argument('--rounds', type=int, default=7, help='Timed rounds per case (default: 7)')
+    common.add_argument('--min-time', type=float, default=0.1,
+                        help='Seconds each round should take at least (default: 0.1)')
+    common.add_argument('--save', metavar='FILE', help='Write the results here as JSON')
+    parser = argparse.ArgumentParser(description='Hot path microbenchmarks with JSON baselines')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('run', parents=[common], help='Run the benchmarks (the default)')
+    compare_parser = commands.add_parser('compare', parents=[common],
+                                         help='Compare against a saved baseline')
+    compare_parser.add_argument('baseline', help='Baseline JSON from --save')
+    compare_parser.add_argument('current', nargs='?',
+                                help='Results JSON to compare (default: run the benchmarks now)')
+    compare_parser.add_argument('--threshold', type=float, default=0.10,
+                                help='Slowdown that counts as a regression (default: 0.10 = 10%%)')
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in ('run', 'compare', '-h', '--help'):
+        argv.insert(0, 'run')
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        baseline = load(args.baseline)
+        if args.current:
+            current = load(args.current)
+        else:
+            current = run(args.only or sorted(baseline['results']), args.rounds, args.min_time)
+        if args.save:
+            save(current, args.save)
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print(f"\n🔴 {len(regressions)} regression(s) beyond {args.threshold:.0%}: "
+                  f"{', '.join(regressions)}")
+            sys.exit(1)
+        print(f"\n✅ No regressions beyond {args.threshold:.0%}")
+        return
+
+    results = run(args.only, args.rounds, args.min_time)
+    if args.save:
+        save(results, args.save)
+    print(f"{'case':<36} {'median µs':>12} {'min µs':>12} {'calls':>8}")
+    for name, r in results['results'].items():
+        print(f"{name:<36} {r['median_us']:>12.2f} {r['min_us']:>12.2f} {r['calls']:>8}")
+
+
+if __name__ == "__main__":
+    main()
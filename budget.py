@@ -0,0 +1,143 @@
+"""Global memory budget shared by every SMTP session
+
+Each DATA phase charges the bytes it buffers against one process-wide
+limit. When the budget is exhausted new DATA commands are refused with a
+452, and a body that outgrows the remaining budget while it is still being
+received is spilled to a temporary file. Before the handler runs, the full
+message plus an allowance for the parsed message tree must fit in the
+budget; sessions wait for room rather than all parsing at once.
+"""
+
+import asyncio
+import tempfile
+import threading
+import time
+
+from metrics import metrics
+
+# Parsing keeps roughly another copy of the message in the EmailMessage tree
+PARSE_OVERHEAD = 1.0
+
+
+class MemoryBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        # Sessions waiting in reserve(), and bodies currently spilled to disk
+        self.waiting = 0
+        self.spilled = 0
+        self._lock = threading.Lock()
+        metrics.gauge_callback('mail_memory_budget_bytes', lambda: self.limit,
+                               help='Configured message buffer budget')
+        metrics.gauge_callback('mail_memory_in_use_bytes', lambda: self.used,
+                               help='Bytes of message data currently buffered or being parsed')
+        metrics.gauge_callback('mail_memory_peak_bytes', lambda: self.peak,
+                               help='Highest buffered byte count since start')
+        metrics.gauge_callback('mail_memory_waiting_sessions', lambda: self.waiting,
+                               help='Sessions waiting for room in the budget')
+        metrics.gauge_callback('mail_data_spilled_bodies', lambda: self.spilled,
+                               help='DATA bodies currently spilled to disk')
+
+    def has_headroom(self):
+        return self.used < self.limit
+
+    def try_reserve(self, n, held=0):
+        """Charge n bytes if they fit
+
+        A caller that is the only user of the budget (apart from the `held`
+        bytes it already owns) always gets its reservation, so a single
+        message larger than the budget can still be processed.
+        """
+        with self._lock:
+            if self.used + n > self.limit and self.used > held:
+                return False
+            self.used += n
+            if self.used > self.peak:
+                self.peak = self.used
+            return True
+
+    async def reserve(self, n, timeout=30.0, held=0):
+        """Wait until n bytes fit in the budget; False on timeout"""
+        if self.try_reserve(n, held):
+            return True
+        deadline = time.monotonic() + timeout
+        delay = 0.005
+        self.waiting += 1
+        try:
+            while not self.try_reserve(n, held):
+                if time.monotonic() >= deadline:
+                    return False
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.1)
+            return True
+        finally:
+            self.waiting -= 1
+
+    def release(self, n):
+        with self._lock:
+            self.used = max(0, self.used - n)
+
+
+class DataBuffer:
+    """Accumulates a DATA body, in memory while the budget allows, else on disk"""
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.size = 0
+        self.reserved = 0
+        self._buf = bytearray()
+        self._file = None
+
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self._file is None:
+            if self.budget is None:
+                self._buf += chunk
+                return
+            if self.budget.try_reserve(len(chunk)):
+                self.reserved += len(chunk)
+                self._buf += chunk
+                return
+            # Out of budget mid-body: move what we have to disk
+            self._file = tempfile.TemporaryFile()
+            self._file.write(self._buf)
+            self._buf = bytearray()
+            self.budget.release(self.reserved)
+            self.reserved = 0
+            self.budget.spilled += 1
+            metrics.inc('mail_data_spilled_total', help='DATA bodies spilled to disk')
+        self._file.write(chunk)
+
+    async def load(self, timeout=30.0):
+        """Reserve room for handling the message and return its bytes, or None"""
+        if self.budget is not None:
+            needed = int(self.size * (1 + PARSE_OVERHEAD)) - self.reserved
+            if not await self.budget.reserve(needed, timeout, held=self.reserved):
+                return None
+            self.reserved += needed
+        if self._file is None:
+            content = bytes(self._buf)
+            self._buf = bytearray()
+            return content
+        self._file.seek(0)
+        content = self._file.read()
+        self._close_file()
+        return content
+
+    def _close_file(self):
+        self._file.close()
+        self._file = None
+        self.budget.spilled -= 1
+
+    def release(self):
+        if self.budget is not None and self.reserved:
+            self.budget.release(self.reserved)
+            self.reserved = 0
+        self._buf = bytearray()
+        if self._file is not None:
+            self._close_file()
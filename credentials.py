@@ -0,0 +1,116 @@
+"""Submission credentials for SMTP AUTH on listeners that require it
+
+The credentials file has one "user:hash" line per account, where hash is
+produced by `python credentials.py USER` (PBKDF2-SHA256 with a random
+salt). Blank lines and lines starting with "#" are ignored. The file is
+reloaded when it changes, like the recipients list.
+
+Checking a password deliberately costs tens of milliseconds of CPU, so
+callers on the event loop should run verify() in an executor.
+"""
+
+import base64
+import functools
+import getpass
+import hashlib
+import hmac
+import os
+import sys
+import threading
+import time
+
+ALGORITHM = 'pbkdf2_sha256'
+ITERATIONS = 200_000
+
+
+def hash_password(password, iterations=ITERATIONS):
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    return '$'.join((ALGORITHM, str(iterations),
+                     base64.b64encode(salt).decode(), base64.b64encode(digest).decode()))
+
+
+def check_password(password, encoded):
+    try:
+        algorithm, iterations, salt, digest = encoded.split('$')
+        if algorithm != ALGORITHM:
+            return False
+        expected = base64.b64decode(digest)
+        actual = hashlib.pbkdf2_hmac('sha256', password.encode(), base64.b64decode(salt),
+                                     int(iterations))
+    except ValueError:
+        return False
+    return hmac.compare_digest(actual, expected)
+
+
+@functools.lru_cache(maxsize=1)
+def _dummy_hash():
+    return hash_password('')
+
+
+class CredentialStore:
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked = 0.0
+        self.users = {}
+        self.reload()
+
+    def reload(self):
+        """Load the credentials file now; keep the previous accounts if it fails"""
+        with self._lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                with open(self.path) as f:
+                    lines = [line.strip() for line in f]
+            except OSError as e:
+                print(f"⚠️  Credentials not loaded: {e}")
+                return False
+            users = {}
+            for line in lines:
+                if not line or line.startswith('#') or ':' not in line:
+                    continue
+                user, encoded = line.split(':', 1)
+                users[user] = encoded
+            self.users = users
+            self._mtime = mtime
+            print(f"🔑 Loaded {len(users)} accounts from {self.path}")
+            return True
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.reload()
+
+    def verify(self, user, password):
+        self.maybe_reload()
+        encoded = self.users.get(user)
+        if encoded is None:
+            # Same cost as a wrong password, so timing does not reveal accounts
+            check_password(password, _dummy_hash())
+            return False
+        return check_password(password, encoded)
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: credentials.py USER >> credentials.txt")
+        sys.exit(2)
+    password = getpass.getpass(f"Password for {sys.argv[1]}: ")
+    if password != getpass.getpass("Again: "):
+        print("Passwords do not match", file=sys.stderr)
+        sys.exit(1)
+    print(f"{sys.argv[1]}:{hash_password(password)}")
+
+
+if __name__ == "__main__":
+    main()
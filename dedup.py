@@ -0,0 +1,171 @@
+"""Drop repeated deliveries of the same message
+
+A message is identified by its Message-ID plus a blake2b hash of its body;
+messages without a Message-ID are identified by a hash of the whole
+message. The SMTP server narrows that to the envelope recipients
+(recipients_key), so a retry for only some of a message's recipients is
+not taken for the delivery that already reached the others. Keys are remembered for a fixed time window in memory and can be
+persisted to an append-only file so restarts do not forget them.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+
+
+class DedupHasher:
+    """Computes the dedup key incrementally, one line at a time"""
+
+    def __init__(self):
+        self._hash = hashlib.blake2b(digest_size=16)
+        self._headers = []
+        self.message_id = None
+
+    def _end_headers(self):
+        if self.message_id:
+            self._hash.update(b'message-id:' + self.message_id)
+        else:
+            for line in self._headers:
+                self._hash.update(line)
+        self._headers = None
+
+    def update(self, line):
+        if self._headers is None:
+            self._hash.update(line)
+            return
+        if line == b'\r\n' or line == b'\n':
+            self._end_headers()
+            self._hash.update(line)
+            return
+        self._headers.append(line)
+        if line[:11].lower() == b'message-id:':
+            self.message_id = line[11:].strip()
+
+    def key(self):
+        if self._headers is not None:
+            self._end_headers()
+        return self._hash.digest()
+
+
+def message_key(content):
+    """Dedup key for a complete raw message; equal to feeding DedupHasher"""
+    if content[:1] in (b'\r', b'\n'):
+        # No header block at all
+        return hashlib.blake2b(content, digest_size=16).digest()
+    hasher = DedupHasher()
+    end = content.find(b'\n\r\n')
+    if end == -1:
+        end = content.find(b'\n\n')
+    if end == -1:
+        for line in content.splitlines(keepends=True):
+            hasher.update(line)
+        return hasher.key()
+    for line in content[:end + 1].splitlines(keepends=True):
+        hasher.update(line)
+    hasher._end_headers()
+    hasher._hash.update(content[end + 1:])
+    return hasher.key()
+
+
+def file_key(f, chunk_size=64 * 1024):
+    """Dedup key for a raw message in a binary file, read from the current position"""
+    hasher = DedupHasher()
+    for line in f:
+        hasher.update(line)
+        if hasher._headers is None:
+            break
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        hasher.update(chunk)
+    return hasher.key()
+
+
+def recipients_key(key, rcpt_tos):
+    """A message key narrowed to one set of recipients"""
+    if isinstance(rcpt_tos, str):
+        rcpt_tos = [rcpt_tos]
+    rcpts = sorted({rcpt.lower() for rcpt in rcpt_tos or ()})
+    return hashlib.blake2b(key + b'\0' + '\0'.join(rcpts).encode('utf-8', 'surrogateescape'),
+                           digest_size=16).digest()
+
+
+class Deduplicator:
+    def __init__(self, window=3600, path=None):
+        self.window = window
+        self.path = path
+        self._seen = OrderedDict()   # key -> expiry; insertion order is expiry order
+        self._lock = threading.Lock()
+        self._file = None
+        self._logged = 0
+        if path:
+            self._load()
+            self._file = open(path, 'a')
+        metrics.gauge_callback('mail_dedup_keys', lambda: len(self._seen),
+                               help='Message keys remembered for duplicate detection')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        now = time.time()
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    expiry, key = line.split()
+                    expiry = float(expiry)
+                except ValueError:
+                    continue
+                if expiry > now:
+                    self._seen[bytes.fromhex(key)] = expiry
+                    self._logged += 1
+        # The file may not be in expiry order after a window change
+        self._seen = OrderedDict(sorted(self._seen.items(), key=lambda item: item[1]))
+        self._compact()
+
+    def _compact(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for key, expiry in self._seen.items():
+                f.write(f"{expiry:.0f} {key.hex()}\n")
+        os.replace(tmp, self.path)
+        self._logged = len(self._seen)
+
+    def _expire(self, now):
+        while self._seen:
+            key, expiry = next(iter(self._seen.items()))
+            if expiry > now:
+                break
+            self._seen.popitem(last=False)
+
+    def is_duplicate(self, key):
+        """True if key was recorded within the window"""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            duplicate = key in self._seen
+        if duplicate:
+            metrics.inc('mail_duplicates_total', help='Duplicate messages skipped')
+        return duplicate
+
+    def record(self, key):
+        """Remember key for the next `window` seconds"""
+        expiry = time.time() + self.window
+        with self._lock:
+            self._seen.pop(key, None)
+            self._seen[key] = expiry
+            if self._file is not None:
+                self._file.write(f"{expiry:.0f} {key.hex()}\n")
+                self._file.flush()
+                self._logged += 1
+                if self._logged > 2 * len(self._seen) + 10000:
+                    self._file.close()
+                    self._compact()
+                    self._file = open(self.path, 'a')
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,293 @@
+"""Small asyncio DNS stub resolver with a TTL-bounded LRU cache
+
+Queries go straight to the configured nameserver over UDP (with EDNS0,
+and over TCP when the answer is truncated), so lookups never block the
+event loop the way socket.gethostbyaddr()/getfqdn() do. Answers are
+cached for their TTL; NXDOMAIN and empty answers are cached too
+(negative caching, using the SOA minimum when the server sends one), and
+failures are cached briefly so a dead resolver is not hammered.
+Concurrent lookups of the same name share one query.
+"""
+
+import asyncio
+import ipaddress
+import random
+import struct
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+
+TYPES = {'A': 1, 'NS': 2, 'CNAME': 5, 'SOA': 6, 'PTR': 12, 'MX': 15, 'TXT': 16, 'AAAA': 28}
+TYPE_NAMES = {v: k for k, v in TYPES.items()}
+
+NOERROR, SERVFAIL, NXDOMAIN = 0, 2, 3
+
+_HEADER = struct.Struct('>HHHHHH')
+_RR = struct.Struct('>HHIH')
+
+
+class DNSError(Exception):
+    """The lookup failed (timeout, SERVFAIL, malformed answer)"""
+
+
+def encode_name(name):
+    out = bytearray()
+    for label in name.rstrip('.').split('.'):
+        if label:
+            raw = label.encode('idna') if not label.isascii() else label.encode()
+            out.append(len(raw))
+            out += raw
+    out.append(0)
+    return bytes(out)
+
+
+def decode_name(data, offset):
+    """Read a possibly compressed name; returns (name, offset after it)"""
+    labels = []
+    end = None
+    for _ in range(128):    # bound pointer loops
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+            continue
+        offset += 1
+        if length == 0:
+            return '.'.join(labels), end if end is not None else offset
+        labels.append(data[offset:offset + length].decode('ascii', 'replace'))
+        offset += length
+    raise DNSError("name compression loop")
+
+
+def build_query(name, qtype, query_id):
+    header = _HEADER.pack(query_id, 0x0100, 1, 0, 0, 1)   # RD, one question, one OPT
+    question = encode_name(name) + struct.pack('>HH', TYPES[qtype], 1)
+    opt = b'\x00' + struct.pack('>HHIH', 41, 1232, 0, 0)   # EDNS0, 1232-byte UDP payload
+    return header + question + opt
+
+
+def _rdata(rtype, data, offset, length):
+    if rtype == 1:
+        return str(ipaddress.IPv4Address(data[offset:offset + 4]))
+    if rtype == 28:
+        return str(ipaddress.IPv6Address(data[offset:offset + 16]))
+    if rtype in (2, 5, 12):
+        return decode_name(data, offset)[0]
+    if rtype == 15:
+        return (struct.unpack_from('>H', data, offset)[0], decode_name(data, offset + 2)[0])
+    if rtype == 16:
+        strings, end = [], offset + length
+        while offset < end:
+            n = data[offset]
+            strings.append(data[offset + 1:offset + 1 + n])
+            offset += 1 + n
+        return b''.join(strings).decode('utf-8', 'replace')
+    return data[offset:offset + length]
+
+
+def parse_response(data, query_id):
+    """Returns (rcode, truncated, answers, negative_ttl)
+
+    answers is a list of (type name, ttl, value) in answer order.
+    """
+    if len(data) < _HEADER.size:
+        raise DNSError("short response")
+    rid, flags, qdcount, ancount, nscount, _ = _HEADER.unpack_from(data)
+    if rid != query_id:
+        raise DNSError("response id mismatch")
+    offset = _HEADER.size
+    for _ in range(qdcount):
+        offset = decode_name(data, offset)[1] + 4
+    answers = []
+    negative_ttl = None
+    for section, count in ((0, ancount), (1, nscount)):
+        for _ in range(count):
+            offset = decode_name(data, offset)[1]
+            rtype, _, ttl, length = _RR.unpack_from(data, offset)
+            offset += _RR.size
+            if section == 0:
+                answers.append((TYPE_NAMES.get(rtype, rtype), ttl, _rdata(rtype, data, offset, length)))
+            elif rtype == 6:
+                # SOA: the last field is the negative-caching TTL (RFC 2308)
+                minimum = struct.unpack_from('>I', data, offset + length - 4)[0]
+                negative_ttl = min(ttl, minimum)
+            offset += length
+    return flags & 0x000F, bool(flags & 0x0200), answers, negative_ttl
+
+
+def system_nameserver(path='/etc/resolv.conf'):
+    try:
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] == 'nameserver':
+                    return parts[1]
+    except OSError:
+        pass
+    return '127.0.0.1'
+
+
+class _UDPQuery(asyncio.DatagramProtocol):
+    def __init__(self, future):
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        if not self.future.done():
+            self.future.set_result(data)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class TTLCache:
+    """LRU mapping whose entries also expire after their own TTL"""
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key):
+        """Returns (hit, value)"""
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+        expiry, value = entry
+        if expiry < time.monotonic():
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    def set(self, key, value, ttl):
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class Resolver:
+    def __init__(self, nameserver=None, port=53, timeout=2.0, attempts=2, cache_size=4096,
+                 negative_ttl=300, failure_ttl=30, min_ttl=5, max_ttl=86400):
+        self.nameserver = nameserver or system_nameserver()
+        self.port = port
+        self.timeout = timeout
+        self.attempts = attempts
+        self.negative_ttl = negative_ttl
+        self.failure_ttl = failure_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.cache = TTLCache(cache_size)
+        self._inflight = {}
+        metrics.gauge_callback('mail_dns_cache_entries', lambda: len(self.cache),
+                               help='Entries in the DNS answer cache')
+
+    async def query(self, name, qtype='A'):
+        """Values of the answers of type qtype; [] for NXDOMAIN or no data
+
+        Raises DNSError when the lookup fails; failures are cached for
+        failure_ttl seconds as well.
+        """
+        key = (name.lower().rstrip('.'), qtype)
+        hit, value = self.cache.get(key)
+        if hit:
+            metrics.inc('mail_dns_lookups_total', result='cached', help='DNS lookups by outcome')
+            if isinstance(value, DNSError):
+                raise value
+            return value
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._resolve(key))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _resolve(self, key):
+        name, qtype = key
+        try:
+            rcode, answers, negative_ttl = await self._exchange(name, qtype)
+        except DNSError as e:
+            metrics.inc('mail_dns_lookups_total', result='failed', help='DNS lookups by outcome')
+            self.cache.set(key, e, self.failure_ttl)
+            raise
+        if rcode not in (NOERROR, NXDOMAIN):
+            error = DNSError(f"{name} {qtype}: rcode {rcode}")
+            metrics.inc('mail_dns_lookups_total', result='failed', help='DNS lookups by outcome')
+            self.cache.set(key, error, self.failure_ttl)
+            raise error
+        values = [value for rtype, _, value in answers if rtype == qtype]
+        if values:
+            ttl = min(ttl for rtype, ttl, _ in answers if rtype == qtype)
+            ttl = max(self.min_ttl, min(ttl, self.max_ttl))
+            result = 'answer'
+        else:
+            ttl = negative_ttl if negative_ttl is not None else self.negative_ttl
+            result = 'negative'
+        metrics.inc('mail_dns_lookups_total', result=result, help='DNS lookups by outcome')
+        self.cache.set(key, values, ttl)
+        return values
+
+    async def _exchange(self, name, qtype):
+        loop = asyncio.get_running_loop()
+        last_error = None
+        for _ in range(self.attempts):
+            query_id = random.getrandbits(16)
+            packet = build_query(name, qtype, query_id)
+            future = loop.create_future()
+            try:
+                transport, _ = await loop.create_datagram_endpoint(
+                    lambda: _UDPQuery(future), remote_addr=(self.nameserver, self.port))
+            except OSError as e:
+                raise DNSError(f"cannot reach {self.nameserver}: {e}")
+            try:
+                transport.sendto(packet)
+                data = await asyncio.wait_for(future, self.timeout)
+                rcode, truncated, answers, negative_ttl = parse_response(data, query_id)
+                if truncated:
+                    rcode, answers, negative_ttl = await self._exchange_tcp(packet, query_id)
+                return rcode, answers, negative_ttl
+            except asyncio.TimeoutError:
+                last_error = DNSError(f"{name} {qtype}: timed out after {self.timeout}s")
+            except (OSError, IndexError, struct.error, asyncio.IncompleteReadError, DNSError) as e:
+                last_error = DNSError(f"{name} {qtype}: {e}")
+            finally:
+                transport.close()
+        raise last_error
+
+    async def _exchange_tcp(self, packet, query_id):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.nameserver, self.port), self.timeout)
+        try:
+            writer.write(struct.pack('>H', len(packet)) + packet)
+            length = struct.unpack('>H', await asyncio.wait_for(reader.readexactly(2), self.timeout))[0]
+            data = await asyncio.wait_for(reader.readexactly(length), self.timeout)
+        finally:
+            writer.close()
+        rcode, _, answers, negative_ttl = parse_response(data, query_id)
+        return rcode, answers, negative_ttl
+
+    async def ptr(self, ip):
+        """Reverse name of an address, or None if it has none or lookup failed"""
+        try:
+            names = await self.query(ipaddress.ip_address(ip).reverse_pointer, 'PTR')
+        except (DNSError, ValueError):
+            return None
+        return names[0].rstrip('.') if names else None
+
+    async def forward_confirmed(self, ip):
+        """The PTR name of ip if that name resolves back to ip (FCrDNS), else None"""
+        name = await self.ptr(ip)
+        if name is None:
+            return None
+        qtype = 'AAAA' if ipaddress.ip_address(ip).version == 6 else 'A'
+        try:
+            addresses = await self.query(name, qtype)
+        except DNSError:
+            return None
+        return name if ipaddress.ip_address(ip) in map(ipaddress.ip_address, addresses) else None
+
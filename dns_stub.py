@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Local stub DNS server for exercising dns_client.Resolver
+
+    dns_stub.py --port 5353 --record PTR 127.0.0.1 localhost.test \
+                --record A localhost.test 127.0.0.1 --delay 0.2
+    mailserver.py --no-tls --port 1025 --resolve-clients --dns-server 127.0.0.1:5353
+
+Serves only the records it is given, answering NXDOMAIN (with an SOA
+carrying --negative-ttl) for any other name. --delay and --drop simulate
+a slow or lossy resolver. Every query is counted, so the effect of
+caching shows up in the summary printed at exit.
+"""
+
+import argparse
+import asyncio
+import ipaddress
+import json
+import random
+import struct
+from collections import Counter
+
+from dns_client import TYPES, TYPE_NAMES, decode_name, encode_name
+
+_HEADER = struct.Struct('>HHHHHH')
+
+
+def _rdata(qtype, value):
+    if qtype == 'A':
+        return ipaddress.IPv4Address(value).packed
+    if qtype == 'AAAA':
+        return ipaddress.IPv6Address(value).packed
+    if qtype in ('PTR', 'CNAME', 'NS'):
+        return encode_name(value)
+    if qtype == 'MX':
+        preference, host = value.split(None, 1) if ' ' in value else ('10', value)
+        return struct.pack('>H', int(preference)) + encode_name(host)
+    if qtype == 'TXT':
+        raw = value.encode()
+        return b''.join(bytes([len(raw[i:i + 255])]) + raw[i:i + 255]
+                        for i in range(0, max(len(raw), 1), 255))
+    raise ValueError(f"unsupported record type {qtype}")
+
+
+class StubDNSServer(asyncio.DatagramProtocol):
+    def __init__(self, records, ttl=300, negative_ttl=60, delay=0.0, drop=0.0, verbose=False):
+        # records: {(name, type): [values]}; PTR names may be given as IPs
+        self.records = {}
+        for (name, qtype), values in records.items():
+            if qtype == 'PTR':
+                try:
+                    name = ipaddress.ip_address(name).reverse_pointer
+                except ValueError:
+                    pass
+            self.records[(name.lower().rstrip('.'), qtype)] = values
+        self.names = {name for name, _ in self.records}
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.delay = delay
+        self.drop = drop
+        self.verbose = verbose
+        self.queries = Counter()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        asyncio.ensure_future(self._answer(data, addr))
+
+    def answer(self, data):
+        query_id, flags, qdcount, _, _, _ = _HEADER.unpack_from(data)
+        name, offset = decode_name(data, _HEADER.size)
+        qtype_code, qclass = struct.unpack_from('>HH', data, offset)
+        question = data[_HEADER.size:offset + 4]
+        qtype = TYPE_NAMES.get(qtype_code, str(qtype_code))
+        key = (name.lower().rstrip('.'), qtype)
+        self.queries[key] += 1
+        if self.verbose:
+            print(f"? {name} {qtype}")
+
+        answers = b''
+        authority = b''
+        values = self.records.get(key, [])
+        for value in values:
+            rdata = _rdata(qtype, value)
+            answers += b'\xc0\x0c' + struct.pack('>HHIH', qtype_code, 1, self.ttl, len(rdata)) + rdata
+        rcode = 0 if key[0] in self.names else 3
+        if not values:
+            soa = (encode_name('ns.stub.test') + encode_name('hostmaster.stub.test')
+                   + struct.pack('>IIIII', 1, 3600, 600, 86400, self.negative_ttl))
+            authority = encode_name('stub.test') + struct.pack('>HHIH', 6, 1, self.negative_ttl, len(soa)) + soa
+        header = _HEADER.pack(query_id, 0x8180 | rcode, 1, len(values), 1 if authority else 0, 0)
+        return header + question + answers + authority
+
+    async def _answer(self, data, addr):
+        if self.drop and random.random() < self.drop:
+            return
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        try:
+            self.transport.sendto(self.answer(data), addr)
+        except (struct.error, IndexError, ValueError) as e:
+            print(f"⚠️  Bad query from {addr}: {e}")
+
+
+async def start_stub(records, host='127.0.0.1', port=5353, **options):
+    loop = asyncio.get_running_loop()
+    _, server = await loop.create_datagram_endpoint(
+        lambda: StubDNSServer(records, **options), local_addr=(host, port))
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub DNS server for local testing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5353)
+    parser.add_argument('--record', nargs=3, action='append', default=[],
+                        metavar=('TYPE', 'NAME', 'VALUE'),
+                        help='Serve a record, e.g. --record PTR 10.0.0.1 mx.example.com')
+    parser.add_argument('--records', help='JSON file of {"TYPE": {"name": "value" | [values]}}')
+    parser.add_argument('--ttl', type=int, default=300)
+    parser.add_argument('--negative-ttl', type=int, default=60)
+    parser.add_argument('--delay', type=float, default=0.0, help='Seconds to wait before answering')
+    parser.add_argument('--drop', type=float, default=0.0, help='Fraction of queries to ignore')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    records = {}
+    if args.records:
+        with open(args.records) as f:
+            for qtype, entries in json.load(f).items():
+                for name, values in entries.items():
+                    records[(name, qtype.upper())] = values if isinstance(values, list) else [values]
+    for qtype, name, value in args.record:
+        if qtype.upper() not in TYPES:
+            parser.error(f"unsupported record type {qtype}")
+        records.setdefault((name, qtype.upper()), []).append(value)
+
+    async def serve():
+        server = await start_stub(records, args.host, args.port, ttl=args.ttl,
+                                  negative_ttl=args.negative_ttl, delay=args.delay,
+                                  drop=args.drop, verbose=args.verbose)
+        print(f"✅ Stub DNS on {args.host}:{args.port} with {len(records)} record sets")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            print(f"\n{sum(server.queries.values())} queries:")
+            for (name, qtype), count in server.queries.most_common(20):
+                print(f"  {count:>6}  {name} {qtype}")
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,56 @@
+// Forwards incoming mail to webserver.py.
+//
+// By default the message is sent as one binary frame (see framing.py):
+//   "MPF1" | u32 big-endian header length | header JSON | raw message bytes
+// gzip-compressed on the fly with CompressionStream, so the raw message is
+// streamed straight from message.raw without being decoded or buffered.
+// Set FORWARD_FORMAT = "json" to send the old JSON payload (also gzipped).
+
+const FORWARD_URL = 'https://telemetry.fyi/email';
+
+function frameStream(fields, raw) {
+  const header = new TextEncoder().encode(JSON.stringify(fields));
+  const prefix = new Uint8Array(8 + header.length);
+  prefix.set(new TextEncoder().encode('MPF1'), 0);
+  new DataView(prefix.buffer).setUint32(4, header.length);
+  prefix.set(header, 8);
+
+  const reader = raw.getReader();
+  return new ReadableStream({
+    start(controller) {
+      controller.enqueue(prefix);
+    },
+    async pull(controller) {
+      const { done, value } = await reader.read();
+      if (done) {
+        controller.close();
+      } else {
+        controller.enqueue(value);
+      }
+    },
+    cancel(reason) {
+      return reader.cancel(reason);
+    }
+  });
+}
+
+async function readRaw(raw) {
+  const reader = raw.getReader();
+  const decoder = new TextDecoder();
+  const parts = [];
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    parts.push(decoder.decode(value, { stream: true }));
+  }
+  parts.push(decoder.decode());
+  return parts.join('');
+}
+
 export default {
   async email(message, env, ctx) {
-    console.log(`📧 Worker v2.0 - Received email from: ${message.from} to: ${message.to}`);
-    
+    console.log(`📧 Worker v3.0 - Received email from: ${message.from} to: ${message.to}`);
+
     try {
       // Parse email headers
       const headers = {};
@@ -10,40 +59,38 @@ export default {
       }
 
       console.log(`📋 Subject: ${headers.subject || '(no subject)'}`);
-
-      // Read the email body
-      const reader = message.raw.getReader();
-      const decoder = new TextDecoder();
-      let rawEmail = '';
-      
-      while (true) {
-        const { done, value } = await reader.read();
-        if (done) break;
-        rawEmail += decoder.decode(value);
-      }
-
       console.log(`📏 Email size: ${message.rawSize} bytes`);
 
-      // Prepare the payload for telemetry.fyi
-      const payload = {
+      const fields = {
         from: message.from,
         to: message.to,
         subject: headers.subject || '',
         headers: headers,
-        raw: rawEmail,
         size: message.rawSize,
         timestamp: new Date().toISOString()
       };
 
-      console.log(`🚀 Forwarding to: https://telemetry.fyi/email`);
+      let body;
+      let contentType;
+      if ((env.FORWARD_FORMAT || 'frame') === 'json') {
+        fields.raw = await readRaw(message.raw);
+        body = new Blob([JSON.stringify(fields)]).stream();
+        contentType = 'application/json';
+      } else {
+        body = frameStream(fields, message.raw);
+        contentType = 'application/x-mailprint-frame';
+      }
+
+      const url = env.FORWARD_URL || FORWARD_URL;
+      console.log(`🚀 Forwarding to: ${url}`);
 
-      // Send to telemetry.fyi/email
-      const response = await fetch('https://telemetry.fyi/email', {
+      const response = await fetch(url, {
         method: 'POST',
         headers: {
-          'Content-Type': 'application/json',
+          'Content-Type': contentType,
+          'Content-Encoding': 'gzip',
         },
-        body: JSON.stringify(payload)
+        body: body.pipeThrough(new CompressionStream('gzip'))
       });
 
       if (!response.ok) {
@@ -63,4 +110,4 @@ export default {
       // message.setReject(`Error processing email: ${error.message}`);
     }
   }
-}
\ No newline at end of file
+}
@@ -0,0 +1,85 @@
+"""Fast text decoding for MIME parts and SMTP command lines
+
+part.get_content() under policy=default builds header objects through the
+header registry and resolves the charset through email.charset for every
+part. For the common case (a charset Python knows, with 7bit, 8bit,
+quoted-printable or base64 transfer encoding) this module reads the raw
+headers and decodes the payload bytes directly. Anything else falls back to
+the stdlib.
+"""
+
+import binascii
+import codecs
+import functools
+import re
+
+FAST_CTES = frozenset(('7bit', '8bit', 'binary', 'quoted-printable', 'base64'))
+
+_CHARSET = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=256)
+def codec_name(charset):
+    """Canonical codec name for a MIME charset, or None if Python lacks it"""
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return None
+
+
+def raw_headers(part):
+    """Content-Type and Content-Transfer-Encoding as unparsed strings"""
+    ctype = cte = None
+    for name, value in part.raw_items():
+        lname = name.lower()
+        if lname == 'content-type':
+            ctype = value
+        elif lname == 'content-transfer-encoding':
+            cte = value
+    return ctype, cte
+
+
+def content_type(part):
+    """Like part.get_content_type() without going through the header registry"""
+    ctype, _ = raw_headers(part)
+    if ctype is None:
+        return part.get_default_type()
+    ctype = ctype.split(';', 1)[0].strip().lower()
+    if ctype.count('/') != 1:
+        return 'text/plain'
+    return ctype
+
+
+def get_text(part):
+    """Decoded text of a text/* part; same result as part.get_content()"""
+    ctype, cte = raw_headers(part)
+    cte = cte.strip().lower() if cte else '7bit'
+    # get_payload() re-reads Content-Transfer-Encoding through the header
+    # registry and re-decodes 8bit text, so read the stored payload directly
+    payload = part._payload
+    if cte not in FAST_CTES or not isinstance(payload, str) or (ctype and 'charset*' in ctype):
+        return part.get_content()
+    match = _CHARSET.search(ctype) if ctype else None
+    codec = codec_name(match.group(1).lower() if match else 'us-ascii')
+    if codec is None:
+        return part.get_content()
+    try:
+        data = payload.encode('ascii', 'surrogateescape')
+    except UnicodeEncodeError:
+        return part.get_content()
+    if cte == 'quoted-printable':
+        data = binascii.a2b_qp(data)
+    elif cte == 'base64':
+        try:
+            data = binascii.a2b_base64(data)
+        except binascii.Error:
+            return part.get_content()
+    return data.decode(codec, 'replace')
+
+
+def decode_command(line):
+    """Decode an SMTP command line; plain decode() is the fastest path"""
+    try:
+        return line.decode()
+    except UnicodeDecodeError:
+        return line.decode('utf-8', errors='ignore')
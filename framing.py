@@ -0,0 +1,66 @@
+"""Compact binary framing for emails posted by email-worker.js
+
+    b'MPF1' | u32 big-endian header length | header JSON | raw message bytes
+
+The header JSON carries the small fields (from, to, subject, headers, ...)
+and everything after it is the raw message, unescaped and undecoded, so
+the receiver can spool it without any JSON string handling.
+"""
+
+import json
+import struct
+import tempfile
+
+MAGIC = b'MPF1'
+CONTENT_TYPE = 'application/x-mailprint-frame'
+MAX_HEADER = 1024 * 1024
+SPOOL_MEMORY = 1024 * 1024
+
+_PREFIX = struct.Struct('>4sI')
+
+
+def encode_frame(fields, raw):
+    header = json.dumps(fields).encode()
+    return _PREFIX.pack(MAGIC, len(header)) + header + raw
+
+
+class FrameStreamParser:
+    """Same interface as json_stream.ObjectStreamParser, for framed bodies"""
+
+    def __init__(self, spool_memory=SPOOL_MEMORY):
+        self.spool_memory = spool_memory
+        self.fields = None
+        self.spools = {}
+        self._buf = bytearray()
+        self._header_length = None
+
+    def feed(self, chunk):
+        if self.fields is not None:
+            self.spools['raw'].write(chunk)
+            return
+        self._buf += chunk
+        if self._header_length is None:
+            if len(self._buf) < _PREFIX.size:
+                return
+            magic, self._header_length = _PREFIX.unpack_from(self._buf)
+            if magic != MAGIC:
+                raise ValueError("not a mailprint frame")
+            if self._header_length > MAX_HEADER:
+                raise ValueError("frame header too large")
+        end = _PREFIX.size + self._header_length
+        if len(self._buf) < end:
+            return
+        self.fields = json.loads(bytes(self._buf[_PREFIX.size:end]))
+        if not isinstance(self.fields, dict):
+            raise ValueError("frame header is not a JSON object")
+        raw = tempfile.SpooledTemporaryFile(self.spool_memory)
+        raw.write(self._buf[end:])
+        self.spools['raw'] = raw
+        self._buf = None
+
+    def close(self):
+        """Check the frame was complete; returns (fields, spools)"""
+        if self.fields is None:
+            raise ValueError("truncated frame")
+        self.spools['raw'].seek(0)
+        return self.fields, self.spools
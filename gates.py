@@ -0,0 +1,240 @@
+"""Cheap checks that stop junk before DATA, and greylisting
+
+A session meets the gates in order, cheapest first, and every check
+happens before the client gets to send a body:
+
+1. pregreet: hold the 220 banner back for a moment. Legitimate clients
+   wait for it; spam bots often start talking straight away and are
+   dropped with a 554.
+2. helo: at each RCPT the HELO/EHLO name must be a syntactically valid
+   FQDN, or an address literal matching the client. Bare IPs, our own
+   name and single-label names are refused. Like Postfix, the verdict is
+   given at RCPT rather than at HELO so the log shows who was targeted.
+3. greylist: the first delivery attempt for a (client /24, sender,
+   recipient) triplet gets a 451. A real MTA retries after a few minutes
+   and is then let through; the triplet is remembered for weeks after
+   each delivery.
+
+Greylist triplets are stored as a 64-bit blake2b hash mapped to one
+packed int, and snapshotted to a file from a background thread with an
+atomic rename, so a restart does not make every sender wait again.
+
+Authenticated submission, LMTP and Unix-socket sessions are not gated;
+the server decides that per listener by setting session.gates.
+"""
+
+import array
+import asyncio
+import hashlib
+import ipaddress
+import itertools
+import os
+import re
+import sys
+import threading
+import time
+
+from metrics import metrics
+
+GREYLIST_DELAY = 300
+# A first attempt that is not retried within this long starts over
+RETRY_WINDOW = 2 * 86400
+# A triplet that delivered is remembered this long after its last message
+PASS_TTL = 35 * 86400
+
+_HOSTNAME = re.compile(r'[A-Za-z0-9_]([A-Za-z0-9_-]*[A-Za-z0-9_])?'
+                       r'(\.[A-Za-z0-9_]([A-Za-z0-9_-]*[A-Za-z0-9_])?)+\.?')
+
+
+def client_net(ip):
+    """The part of a client address greylisting keys on: the /24 or the /64"""
+    if ':' not in ip:
+        return ip.rpartition('.')[0]
+    address = ipaddress.IPv6Address(ip)
+    if address.ipv4_mapped:
+        return str(address.ipv4_mapped).rpartition('.')[0]
+    return address.exploded[:19]
+
+
+def triplet_key(ip, sender, rcpt):
+    data = '\0'.join((client_net(ip), (sender or '').lower(), rcpt.lower())).encode()
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+class Greylist:
+    """Triplet store: hash -> (timestamp << 1 | passed)
+
+    A pending triplet keeps the time of its first attempt, a passed one
+    the time of its last delivery.
+    """
+
+    def __init__(self, delay=GREYLIST_DELAY, retry_window=RETRY_WINDOW, pass_ttl=PASS_TTL,
+                 path=None, snapshot_interval=60):
+        self.delay = delay
+        self.retry_window = retry_window
+        self.pass_ttl = pass_ttl
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        if path:
+            self._load()
+        metrics.gauge_callback('mail_greylist_entries', lambda: len(self._entries),
+                               help='Greylist triplets remembered')
+
+    def check(self, ip, sender, rcpt, now=None):
+        """Seconds the client must still wait, or 0 if the triplet may deliver"""
+        now = int(now if now is not None else time.time())
+        key = triplet_key(ip, sender, rcpt)
+        with self._lock:
+            value = self._entries.get(key)
+            self._dirty = True
+            if value is not None and not self._expired(value, now):
+                seen = value >> 1
+                if value & 1 or now - seen >= self.delay:
+                    self._entries[key] = now << 1 | 1
+                    return 0
+                return self.delay - (now - seen)
+            self._entries[key] = now << 1
+            return self.delay
+
+    def _expired(self, value, now):
+        ttl = self.pass_ttl if value & 1 else self.retry_window
+        return now - (value >> 1) > ttl
+
+    def _load(self):
+        entries = array.array('Q')
+        try:
+            with open(self.path, 'rb') as f:
+                entries.frombytes(f.read())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"⚠️  Greylist snapshot not loaded: {e}")
+            return
+        if sys.byteorder != 'little':
+            entries.byteswap()
+        now = int(time.time())
+        pairs = zip(entries[::2], entries[1::2])
+        self._entries = {key: value for key, value in pairs if not self._expired(value, now)}
+        print(f"⏳ Loaded {len(self._entries)} greylist triplets from {self.path}")
+
+    def prune(self, now=None):
+        """Forget expired triplets; returns the live ones as a list of pairs"""
+        now = int(now if now is not None else time.time())
+        with self._lock:
+            items = list(self._entries.items())
+        live = []
+        expired = []
+        for item in items:
+            (expired if self._expired(item[1], now) else live).append(item)
+        with self._lock:
+            for key, value in expired:
+                # Skip entries that check() touched since the copy was taken
+                if self._entries.get(key) == value:
+                    del self._entries[key]
+        return live
+
+    def snapshot(self):
+        """Prune, then write the live triplets to path with an atomic rename"""
+        self._dirty = False
+        entries = array.array('Q', itertools.chain.from_iterable(self.prune()))
+        if sys.byteorder != 'little':
+            entries.byteswap()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            entries.tofile(f)
+        os.replace(tmp, self.path)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.snapshot_interval):
+            if not self.path:
+                self.prune()
+            elif self._dirty:
+                try:
+                    self.snapshot()
+                except OSError as e:
+                    print(f"⚠️  Greylist snapshot failed: {e}")
+
+    def stop(self):
+        self._stop.set()
+        if self.path and self._dirty:
+            self.snapshot()
+
+
+class Gates:
+    """The pre-DATA checks that are switched on, run in order for a session"""
+
+    def __init__(self, server_name, pregreet_wait=0.0, helo_checks=False, greylist=None):
+        self.server_name = server_name.lower().rstrip('.')
+        self.pregreet_wait = pregreet_wait
+        self.helo_checks = helo_checks
+        self.greylist = greylist
+
+    def _count(self, gate, result):
+        metrics.inc('mail_gate_total', gate=gate, result=result,
+                    help='Pre-DATA gate decisions by gate and result')
+
+    async def pregreet(self, reader):
+        """Hold back the banner; 'pass', or 'early' / 'disconnect' to drop the client"""
+        if not self.pregreet_wait:
+            return 'pass'
+        try:
+            data = await asyncio.wait_for(reader.read(1), self.pregreet_wait)
+        except asyncio.TimeoutError:
+            result = 'pass'
+        else:
+            result = 'early' if data else 'disconnect'
+        self._count('pregreet', result)
+        return result
+
+    def helo_problem(self, name, peer_ip):
+        """Why the HELO name is unacceptable, as an SMTP reply, or None"""
+        if not name:
+            return '503 5.5.1 Send HELO/EHLO first'
+        if name.startswith('[') and name.endswith(']'):
+            literal = name[1:-1]
+            if literal.lower().startswith('ipv6:'):
+                literal = literal[5:]
+            try:
+                if peer_ip is None or ipaddress.ip_address(literal) == ipaddress.ip_address(peer_ip):
+                    return None
+            except ValueError:
+                return f'501 5.5.2 <{name}>: Helo command rejected: invalid address literal'
+            return f'550 5.7.1 <{name}>: Helo command rejected: not your address'
+        try:
+            ipaddress.ip_address(name)
+        except ValueError:
+            pass
+        else:
+            return f'504 5.5.2 <{name}>: Helo command rejected: use an address literal [{name}]'
+        if not _HOSTNAME.fullmatch(name):
+            if '.' not in name:
+                return f'504 5.5.2 <{name}>: Helo command rejected: need fully-qualified hostname'
+            return f'501 5.5.2 <{name}>: Helo command rejected: invalid hostname'
+        if name.lower().rstrip('.') in (self.server_name, 'localhost.localdomain'):
+            return f'550 5.7.1 <{name}>: Helo command rejected: that is my name'
+        return None
+
+    def check_helo(self, session):
+        if not self.helo_checks:
+            return None
+        peer_ip = session.peer[0] if isinstance(session.peer, tuple) else None
+        problem = self.helo_problem(getattr(session, 'host_name', None), peer_ip)
+        self._count('helo', 'reject' if problem else 'pass')
+        return problem
+
+    def check_greylist(self, session, sender, rcpt):
+        if self.greylist is None or not isinstance(session.peer, tuple):
+            return None
+        wait = self.greylist.check(session.peer[0], sender, rcpt)
+        self._count('greylist', 'defer' if wait else 'pass')
+        if wait:
+            return f'451 4.7.1 <{rcpt}>: Recipient address rejected: Greylisted, try again in {wait} seconds'
+        return None
@@ -0,0 +1,117 @@
+"""Bounded HTML-to-text rendering for html-only messages
+
+The HTML is fed to the parser in chunks and parsing stops as soon as the
+requested number of text characters has been produced, so a 5MB newsletter
+costs about as much as its first few kilobytes. Rendered previews are kept
+in a small LRU cache keyed by a hash of the HTML, since newsletters reuse
+the same templates over and over.
+"""
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from html.parser import HTMLParser
+
+FEED_CHUNK = 8192
+
+SKIP_TAGS = frozenset(('script', 'style', 'head', 'title', 'noscript', 'template', 'svg'))
+BLOCK_TAGS = frozenset((
+    'p', 'div', 'br', 'tr', 'table', 'ul', 'ol', 'li', 'blockquote', 'pre', 'hr',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'article', 'header', 'footer',
+    'dl', 'dt', 'dd', 'center', 'form',
+))
+
+_SPACES = re.compile(r'[ \t\r\f\v ]+')
+_BLANK_LINES = re.compile(r' *\n[ \n]*\n')
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self, limit):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.parts = []
+        self.length = 0
+        self.skip_depth = 0
+        self.done = False
+
+    def _emit(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+        if self.length >= self.limit:
+            self.done = True
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag == 'li':
+            self._emit('\n• ')
+        elif tag in BLOCK_TAGS:
+            self._emit('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in BLOCK_TAGS:
+            self._emit('\n')
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in BLOCK_TAGS and tag != 'li':
+            self._emit('\n')
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        text = _SPACES.sub(' ', data.replace('\n', ' '))
+        if text.strip():
+            self._emit(text)
+
+
+def html_to_text(html, limit=2000):
+    """Render at most `limit` characters of readable text from html"""
+    parser = _TextExtractor(limit)
+    for start in range(0, len(html), FEED_CHUNK):
+        parser.feed(html[start:start + FEED_CHUNK])
+        if parser.done:
+            break
+    else:
+        parser.close()
+    text = _BLANK_LINES.sub('\n\n', ''.join(parser.parts)).strip()
+    if parser.done and len(text) >= limit:
+        text = text[:limit].rstrip() + '…'
+    return text
+
+
+class PreviewCache:
+    """LRU of rendered previews keyed by content hash"""
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, html, limit=2000):
+        key = (hashlib.blake2b(html.encode('utf-8', 'surrogatepass'), digest_size=16).digest(), limit)
+        with self._lock:
+            text = self._entries.get(key)
+            if text is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return text
+            self.misses += 1
+        text = html_to_text(html, limit)
+        with self._lock:
+            self._entries[key] = text
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return text
+
+
+previews = PreviewCache()
+
+
+def html_preview(html, limit=2000):
+    """Cached html_to_text()"""
+    return previews.render(html, limit)
@@ -0,0 +1,249 @@
+"""Incremental parser for a JSON object with very large string fields
+
+The Cloudflare worker posts {"from": ..., "to": ..., "raw": "<whole
+message>", ...}. ObjectStreamParser takes the body in chunks as it
+arrives. Ordinary fields are collected and decoded with json.loads once
+each value is complete; the fields named in `spool` (normally just "raw")
+are unescaped on the fly and written as UTF-8 to a SpooledTemporaryFile,
+so the message is never held in memory as one string.
+"""
+
+import json
+import re
+import tempfile
+
+SPOOL_MEMORY = 1024 * 1024
+
+_PLAIN = re.compile(rb'[^"\\]+')
+# Bytes that can be part of an unfinished escape or UTF-8 sequence at the
+# end of a chunk
+_UNSAFE_TAIL = frozenset(b'\\u0123456789abcdefABCDEF') | frozenset(range(0x80, 0x100))
+_WS = b' \t\r\n'
+_ESCAPES = {ord('"'): b'"', ord('\\'): b'\\', ord('/'): b'/', ord('b'): b'\b',
+            ord('f'): b'\f', ord('n'): b'\n', ord('r'): b'\r', ord('t'): b'\t'}
+
+# Parser states
+START, KEY_OR_END, KEY, COLON, VALUE_START, VALUE, SPOOL_STRING, AFTER_VALUE, DONE = range(9)
+
+
+def _is_escaped(data, start, pos):
+    """True if the quote at pos is preceded by an odd run of backslashes"""
+    run = 0
+    while pos - run > start and data[pos - run - 1] == 0x5c:
+        run += 1
+    return run % 2 == 1
+
+
+def _encode_code_point(cp):
+    return chr(cp).encode('utf-8', 'surrogatepass')
+
+
+class ObjectStreamParser:
+    def __init__(self, spool=('raw',), spool_memory=SPOOL_MEMORY):
+        self.spool_keys = frozenset(spool)
+        self.spool_memory = spool_memory
+        self.fields = {}
+        self.spools = {}
+        self._state = START
+        self._pending = b''
+        self._buf = bytearray()
+        self._key = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._high = None   # high surrogate waiting for its pair
+
+    def feed(self, chunk):
+        data = self._pending + chunk if self._pending else chunk
+        self._pending = b''
+        i = 0
+        n = len(data)
+        while i < n:
+            state = self._state
+            c = data[i]
+            if state == SPOOL_STRING:
+                i = self._spool(data, i)
+                continue
+            if state == VALUE:
+                i = self._value(data, i)
+                continue
+            if c in _WS and state != KEY:
+                i += 1
+                continue
+            if state == START:
+                self._expect(c, b'{')
+                self._state = KEY_OR_END
+            elif state == KEY_OR_END:
+                if c == ord('}'):
+                    self._state = DONE
+                else:
+                    self._expect(c, b'"')
+                    self._buf = bytearray(b'"')
+                    self._escaped = False
+                    self._state = KEY
+            elif state == KEY:
+                self._buf.append(c)
+                if self._escaped:
+                    self._escaped = False
+                elif c == ord('\\'):
+                    self._escaped = True
+                elif c == ord('"'):
+                    self._key = json.loads(bytes(self._buf))
+                    self._state = COLON
+            elif state == COLON:
+                self._expect(c, b':')
+                self._state = VALUE_START
+            elif state == VALUE_START:
+                if self._key in self.spool_keys and c == ord('"'):
+                    self.spools[self._key] = tempfile.SpooledTemporaryFile(self.spool_memory)
+                    self._state = SPOOL_STRING
+                    i += 1
+                    continue
+                self._buf = bytearray()
+                self._depth = 0
+                self._in_string = False
+                self._escaped = False
+                self._state = VALUE
+                continue
+            elif state == AFTER_VALUE:
+                if c == ord(','):
+                    self._state = KEY_OR_END
+                else:
+                    self._expect(c, b'}')
+                    self._state = DONE
+            elif state == DONE:
+                raise ValueError("unexpected data after the JSON object")
+            i += 1
+
+    def _expect(self, c, char):
+        if c != char[0]:
+            raise ValueError(f"expected {char.decode()!r}, got {chr(c)!r}")
+
+    def _value(self, data, i):
+        """Collect one ordinary value; returns the index after what was consumed"""
+        n = len(data)
+        buf = self._buf
+        while i < n:
+            c = data[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif c == 0x5c:     # backslash
+                    self._escaped = True
+                elif c == 0x22:     # quote
+                    self._in_string = False
+            elif c == 0x22:
+                self._in_string = True
+            elif c in b'[{':
+                self._depth += 1
+            elif c in b']}' and self._depth:
+                self._depth -= 1
+            elif self._depth == 0 and c in b',}':
+                self.fields[self._key] = json.loads(bytes(buf))
+                self._state = AFTER_VALUE
+                return i   # let AFTER_VALUE see the delimiter
+            buf.append(c)
+            i += 1
+        return i
+
+    def _spool(self, data, i):
+        """Unescape a spooled string straight into its file
+
+        Complete stretches of the string are unescaped with json.loads. Only
+        a possibly unfinished escape at the end of the chunk is held back
+        for the next one.
+        """
+        out = self.spools[self._key]
+        n = len(data)
+        end = data.find(b'"', i)
+        while end != -1 and _is_escaped(data, i, end):
+            end = data.find(b'"', end + 1)
+        if end != -1:
+            self._write_segment(out, data[i:end])
+            out.seek(0)
+            self._state = AFTER_VALUE
+            return end + 1
+        # Cut after the last byte that cannot belong to an unfinished escape or character
+        cut = n
+        limit = max(i, n - 64)
+        while cut > limit and data[cut - 1] in _UNSAFE_TAIL:
+            cut -= 1
+        if cut == limit:
+            return self._spool_escapes(data, i)
+        self._write_segment(out, data[i:cut])
+        self._pending = data[cut:]
+        return n
+
+    def _write_segment(self, out, segment):
+        # _spool_escapes() copies bytes verbatim and may have stopped inside
+        # a UTF-8 sequence; pass its continuation bytes straight through
+        start = 0
+        while start < len(segment) and 0x80 <= segment[start] < 0xC0:
+            start += 1
+        if start:
+            out.write(segment[:start])
+            segment = segment[start:]
+        if self._high is not None:
+            segment = b'\\u%04x' % self._high + segment
+            self._high = None
+        if segment:
+            out.write(json.loads(b'"' + segment + b'"', strict=False).encode('utf-8', 'surrogatepass'))
+
+    def _spool_escapes(self, data, i):
+        """Escape-by-escape version of _spool() for long runs of escape-like bytes"""
+        out = self.spools[self._key]
+        n = len(data)
+        while i < n:
+            match = _PLAIN.match(data, i)
+            if match:
+                self._flush_high(out)
+                out.write(match.group())
+                i = match.end()
+                continue
+            c = data[i]
+            if c == 0x22:
+                self._flush_high(out)
+                out.seek(0)
+                self._state = AFTER_VALUE
+                return i + 1
+            # Backslash escape; keep it for the next chunk if it is cut off
+            if i + 1 >= n:
+                self._pending = data[i:]
+                return n
+            kind = data[i + 1]
+            if kind == ord('u'):
+                if i + 6 > n:
+                    self._pending = data[i:]
+                    return n
+                cp = int(data[i + 2:i + 6], 16)
+                if 0xD800 <= cp < 0xDC00:
+                    self._flush_high(out)
+                    self._high = cp
+                elif 0xDC00 <= cp < 0xE000 and self._high is not None:
+                    out.write(_encode_code_point(0x10000 + ((self._high - 0xD800) << 10) + (cp - 0xDC00)))
+                    self._high = None
+                else:
+                    self._flush_high(out)
+                    out.write(_encode_code_point(cp))
+                i += 6
+            else:
+                self._flush_high(out)
+                try:
+                    out.write(_ESCAPES[kind])
+                except KeyError:
+                    raise ValueError(f"invalid escape \\{chr(kind)}")
+                i += 2
+        return i
+
+    def _flush_high(self, out):
+        if self._high is not None:
+            out.write(_encode_code_point(self._high))
+            self._high = None
+
+    def close(self):
+        """Check the object was complete; returns (fields, spools)"""
+        if self._state != DONE:
+            for f in self.spools.values():
+                f.close()
+            raise ValueError("truncated JSON body")
+        return self.fields, self.spools
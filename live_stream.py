@@ -0,0 +1,188 @@
+"""Fan-out of ingested-message summaries to live subscribers
+
+webserver.py serves GET /stream as Server-Sent Events. Each summary is
+encoded into an SSE frame once, and that same bytes object is appended to
+every subscriber's queue. Queues are bounded: when a dashboard stops
+reading, its oldest frames are dropped (or, with slow='close', it is
+disconnected), so publishing never waits on a subscriber.
+
+mailserver.py runs in another process and hands its summaries over with
+EventPublisher: one JSON datagram per message on a Unix datagram socket.
+Sends never block. If nothing is listening, or the socket buffer is full,
+the event is dropped. It also sends one datagram per refused recipient
+(see rejection()); those feed webserver.py's traffic counts but are not
+streamed, since /stream lists ingested messages.
+"""
+
+import asyncio
+import json
+import os
+import socket
+from collections import deque
+
+QUEUE_SIZE = 256
+KEEPALIVE = 15.0
+# Unix datagrams larger than this are not worth sending for a summary
+MAX_DATAGRAM = 16 * 1024
+
+
+def summary(source, sender, rcpt_tos, subject, size=None, **extra):
+    """The event published for one ingested message"""
+    event = {'source': source, 'from': sender, 'to': rcpt_tos,
+             'subject': subject if subject is None else str(subject)[:200], 'size': size}
+    event.update(extra)
+    return event
+
+
+def rejection(source, sender, rcpt, reply, **extra):
+    """The event sent for one refused recipient"""
+    event = {'event': 'reject', 'source': source, 'from': sender, 'to': [rcpt], 'reply': reply[:200]}
+    event.update(extra)
+    return event
+
+
+# Compact JSON of a rejection() starts with this, so it can be told apart unparsed
+REJECT_PREFIX = b'{"event":"reject"'
+
+
+class Subscriber:
+    def __init__(self, maxlen=QUEUE_SIZE):
+        self.maxlen = maxlen
+        self.frames = deque()
+        self.dropped = 0
+        self.closed = False
+        self._ready = asyncio.Event()
+
+    def push(self, frame, slow='drop'):
+        if len(self.frames) >= self.maxlen:
+            if slow == 'close':
+                self.close()
+                return
+            self.frames.popleft()
+            self.dropped += 1
+        self.frames.append(frame)
+        self._ready.set()
+
+    def close(self):
+        self.closed = True
+        self.frames.clear()
+        self._ready.set()
+
+    async def next(self, timeout=KEEPALIVE):
+        """Every frame queued so far as one bytes object
+
+        Returns b'' after timeout seconds with nothing to send, and None
+        once the subscriber is closed.
+        """
+        if not self.frames and not self.closed:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return b''
+        if self.closed:
+            return None
+        frames = b''.join(self.frames)
+        self.frames.clear()
+        return frames
+
+
+class Broadcaster:
+    def __init__(self, queue_size=QUEUE_SIZE, slow='drop'):
+        if slow not in ('drop', 'close'):
+            raise ValueError("slow must be 'drop' or 'close'")
+        self.queue_size = queue_size
+        self.slow = slow
+        self.subscribers = set()
+        self.sequence = 0
+        self.closed_slow = 0
+
+    def subscribe(self):
+        subscriber = Subscriber(self.queue_size)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish(self, event):
+        self.publish_json(json.dumps(event, separators=(',', ':'), default=str).encode())
+
+    def publish_json(self, data):
+        """Publish an already serialised JSON event; must run on the event loop"""
+        self.sequence += 1
+        if not self.subscribers:
+            return
+        # Compact JSON has no raw newlines, but a datagram might; SSE data ends at one
+        frame = b'id: %d\nevent: message\ndata: %s\n\n' % (self.sequence, data.replace(b'\n', b''))
+        for subscriber in list(self.subscribers):
+            subscriber.push(frame, self.slow)
+            if subscriber.closed:
+                self.closed_slow += 1
+                self.subscribers.discard(subscriber)
+
+    def stats(self):
+        return {'subscribers': len(self.subscribers), 'published': self.sequence,
+                'dropped': sum(s.dropped for s in self.subscribers),
+                'closed_slow': self.closed_slow}
+
+
+class _DatagramIngest(asyncio.DatagramProtocol):
+    def __init__(self, broadcaster, on_event=None):
+        self.broadcaster = broadcaster
+        self.on_event = on_event
+
+    def datagram_received(self, data, addr):
+        if self.on_event is not None:
+            try:
+                self.on_event(json.loads(data))
+            except ValueError:
+                return
+        if not data.startswith(REJECT_PREFIX):
+            self.broadcaster.publish_json(data)
+
+
+async def listen_datagrams(path, broadcaster, on_event=None):
+    """Publish every message datagram sent to the Unix socket at path; returns the transport
+
+    on_event, if given, is called with every decoded event, rejections included.
+    """
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)     # left behind by a previous run
+        else:
+            raise OSError(f"{path} is in use by another process")
+        finally:
+            probe.close()
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: _DatagramIngest(broadcaster, on_event), local_addr=path, family=socket.AF_UNIX)
+    return transport
+
+
+class EventPublisher:
+    """Sends summaries to webserver.py --stream-socket without ever blocking"""
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sent = 0
+        self.dropped = 0
+
+    def publish(self, event):
+        data = json.dumps(event, separators=(',', ':'), default=str).encode()
+        if len(data) > MAX_DATAGRAM:
+            self.dropped += 1
+            return
+        try:
+            self.sock.sendto(data, self.path)
+            self.sent += 1
+        except OSError:
+            # No listener yet, or its buffer is full: the event is dropped
+            self.dropped += 1
+
+    def close(self):
+        self.sock.close()
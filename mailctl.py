@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Control a running mailserver.py through its --admin-socket
+
+    mailctl.py stats              live counters, memory budget, spool
+    mailctl.py top [N] [MEASURE] [MINUTES]
+                                  top client IPs and sender domains by
+                                  messages, bytes or rejects (default: 10
+                                  by messages over the last 60 minutes)
+    mailctl.py traffic [MINUTES]  totals per minute, and the top talkers
+    mailctl.py sessions           open SMTP sessions
+    mailctl.py verbose [on|off]   full or one-line message printouts
+    mailctl.py reload [WHAT...]   reload routes, recipients, credentials, tls
+    mailctl.py drain              stop accepting, exit once sessions finish
+
+The socket defaults to $MAILCTL_SOCKET, or mailserver-admin.sock.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from admin import request
+
+
+def print_stats(stats):
+    print(f"⏱️  Up {stats['uptime']}s, {stats['sessions']} open sessions"
+          f"{' (draining)' if stats['draining'] else ''}, verbose {'on' if stats['verbose'] else 'off'}")
+    memory = stats.get('memory')
+    if memory:
+        print(f"🧠 Memory budget: {memory['used']} / {memory['limit']} bytes (peak {memory['peak']}), "
+              f"{stats['queue']['waiting_for_memory']} sessions waiting")
+    spool = stats.get('spool')
+    if spool:
+        print("💽 Spool: " + ', '.join(f"{name.replace('_', ' ')} {value}" for name, value in spool.items()))
+    print()
+    for name, value in stats['counters'].items():
+        print(f"  {name:<60} {value}")
+
+
+def print_top(report):
+    totals = report['totals']
+    print(f"📊 Last {report['minutes']} minutes: {totals['messages']} messages, "
+          f"{totals['bytes']} bytes, {totals['rejects']} rejected recipients")
+    for kind, title in (('ip', 'Client IP'), ('domain', 'Sender domain')):
+        print(f"\n{title:<40} {'messages':>10} {'bytes':>12} {'rejects':>8}")
+        for row in report['top'][kind]:
+            print(f"{row['key']:<40} {row['messages']:>10} {row['bytes']:>12} {row['rejects']:>8}")
+
+
+def print_traffic(report):
+    print(f"{'minute':<8} {'messages':>10} {'bytes':>12} {'rejects':>8}")
+    for point in report['series']:
+        minute = time.strftime('%H:%M', time.localtime(point['minute']))
+        print(f"{minute:<8} {point['messages']:>10} {point['bytes']:>12} {point['rejects']:>8}")
+    print()
+    print_top(report)
+
+
+def print_sessions(rows):
+    if not rows:
+        print("No open sessions")
+        return
+    print(f"{'peer':<24} {'listener':<10} {'age s':>7}  {'helo':<24} {'user':<12} {'mail from':<30} rcpts")
+    for row in rows:
+        print(f"{row['peer']:<24} {row['listener'] or '':<10} {row['age']:>7}  {row['helo'] or '':<24} "
+              f"{row['user'] or '':<12} {row['mail_from'] or '':<30} {row['rcpts']}")
+
+
+FORMATTERS = {'stats': print_stats, 'top': print_top, 'traffic': print_traffic, 'sessions': print_sessions}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Control a running mailserver.py')
+    parser.add_argument('--socket', default=os.environ.get('MAILCTL_SOCKET', 'mailserver-admin.sock'),
+                        help='The server\'s --admin-socket (default: $MAILCTL_SOCKET or mailserver-admin.sock)')
+    parser.add_argument('--json', action='store_true', help='Print the raw JSON reply')
+    parser.add_argument('command', help='stats, top, traffic, sessions, verbose, reload, drain or help')
+    parser.add_argument('args', nargs='*')
+    args = parser.parse_args()
+
+    try:
+        reply = request(args.socket, ' '.join([args.command] + args.args))
+    except (OSError, ValueError) as e:
+        print(f"❌ No answer from {args.socket}: {e}", file=sys.stderr)
+        sys.exit(1)
+    if isinstance(reply, dict) and 'error' in reply:
+        print(f"❌ {reply['error']}", file=sys.stderr)
+        sys.exit(1)
+    formatter = FORMATTERS.get(args.command.lower())
+    if args.json or formatter is None:
+        print(json.dumps(reply, indent=2))
+    else:
+        formatter(reply)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,14 @@
 # dependencies = [
 #     "aiosmtpd>=1.4.0",
 #     "cryptography>=41.0.0",
+#     "zstandard>=0.22.0",
 # ]
 # ///
 
 import argparse
 import asyncio
+import base64
+import binascii
 import socket
 import subprocess
 import sys
@@ -25,50 +28,1032 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
 import datetime
+import functools
+import threading
+import time
+from routing import Router
+from message_store import Compactor, MessageStore
+from recipients import RecipientIndex
+from attachments import BlobStore, save_attachments
+from search_index import SearchIndex
+from html_text import html_preview
+from fast_decode import content_type, decode_command, get_text
+from tracing import NULL_TRACE, SamplingProfiler, Tracer
+from budget import PARSE_OVERHEAD, DataBuffer, MemoryBudget
+from metrics import metrics, start_metrics_server
+from dedup import DedupHasher, Deduplicator, message_key, recipients_key
+from session_capture import NULL_SESSION, SessionRecorder
+from dns_client import Resolver
+from credentials import CredentialStore
+from live_stream import EventPublisher, rejection, summary
+from sender_auth import Verifier
+from gates import Gates, Greylist
+from traffic import TrafficStats
+from admin import AdminServer
+
+
+def peer_ip(session):
+    """The client's IP address, or None on a Unix socket"""
+    return session.peer[0] if isinstance(session.peer, tuple) else None
 
 
 class EmailHandler:
+    def __init__(self, router=None, store=None, recipients=None, blobs=None, search=None,
+                 html_preview_chars=4000, dedup=None, resolver=None, events=None, verifier=None,
+                 gates=None, traffic=None):
+        self.router = router
+        self.store = store
+        self.recipients = recipients
+        self.blobs = blobs
+        self.search = search
+        self.html_preview_chars = html_preview_chars
+        self.dedup = dedup
+        self.resolver = resolver
+        self.events = events
+        self.verifier = verifier
+        self.gates = gates
+        self.traffic = traffic
+        # Full printouts, or one line per message; toggled with mailctl verbose
+        self.verbose = True
+
+    def start_lookups(self, session):
+        """Called when a client connects: start its PTR lookup in the background"""
+        if self.resolver is not None and isinstance(session.peer, tuple):
+            session.ptr_lookup = asyncio.ensure_future(self.resolver.ptr(session.peer[0]))
+
+    async def client_name(self, session):
+        """'name [ip]' for the connected client, using the cached async resolver"""
+        if not isinstance(session.peer, tuple):
+            return None
+        ip = session.peer[0]
+        lookup = getattr(session, 'ptr_lookup', None)
+        name = await (lookup if lookup is not None else self.resolver.ptr(ip))
+        return f"{name or 'unknown'} [{ip}]"
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        """Reject unknown recipients and gated clients before the client sends DATA"""
+        problem = self.rcpt_problem(session, envelope, address)
+        if problem:
+            self.rejected(session, envelope.mail_from, address, problem)
+            return problem
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    def rcpt_problem(self, session, envelope, address):
+        """The reply refusing this recipient, or None to accept it"""
+        gates = getattr(session, 'gates', None)
+        if getattr(session, 'user', None) or getattr(session, 'authenticated', False):
+            gates = None
+        if gates is not None:
+            problem = gates.check_helo(session)
+            if problem:
+                return problem
+        if self.recipients is not None and address not in self.recipients:
+            return f'550 5.1.1 <{address}>: Recipient address rejected: User unknown'
+        if gates is not None:
+            problem = gates.check_greylist(session, envelope.mail_from, address)
+            if problem:
+                return problem
+        return None
+
+    def rejected(self, session, sender, rcpt, reply):
+        """Count a refused recipient, and tell webserver.py's stream about it"""
+        ip = peer_ip(session)
+        if self.traffic is not None:
+            self.traffic.record(ip, sender, rejected=True)
+        if self.events is not None:
+            self.events.publish(rejection('smtp', sender, rcpt, reply, ts=time.time(), client=ip))
+
     async def handle_DATA(self, server, session, envelope):
         """Handle incoming email data"""
+        trace = getattr(session, 'trace', NULL_TRACE)
         try:
+            sender = envelope.mail_from
+            if self.traffic is not None:
+                self.traffic.record(peer_ip(session), sender, len(envelope.content))
+
+            # Retries of a message we already handled are acknowledged and skipped
+            dedup_key = None
+            if self.dedup is not None:
+                dedup_key = recipients_key(getattr(envelope, 'dedup_key', None) or message_key(envelope.content),
+                                           envelope.rcpt_tos)
+                if self.dedup.is_duplicate(dedup_key):
+                    return '250 Message accepted for delivery'
+
+            # SPF/DKIM results go on the message itself, so stored and
+            # forwarded copies carry them too
+            auth = None
+            if self.verifier is not None:
+                with trace.span('verify'):
+                    peer = session.peer[0] if isinstance(session.peer, tuple) else None
+                    auth = await self.verifier.verify(envelope.content, sender, peer,
+                                                      getattr(session, 'host_name', None))
+                    envelope.content = auth.apply(envelope.content)
+                    envelope.auth_results = auth
+                trace.set('auth', auth.summary())
+
+            # Resolve routes before parsing so drop/store/forward-only mail
+            # never pays for building the message tree
+            msg = None
+            routes = None
+            if self.router is not None:
+                with trace.span('route'):
+                    if self.router.table.needs_headers:
+                        msg = message_from_bytes(envelope.content, policy=default)
+                    routes = self.route(sender, envelope.rcpt_tos, msg)
+            kept = routes is None or any(action != 'drop' for action, _ in routes)
+            needs_body = (routes is None or any(action in ('print', 'webhook') for action, _ in routes)
+                          or (self.search is not None and kept))
+            needs_attachments = self.blobs is not None and kept
+            if not needs_body and not needs_attachments:
+                with trace.span('dispatch'):
+                    await self.dispatch(envelope, routes, None, None, None)
+                self.record_delivery(dedup_key, envelope)
+                self.publish(session, envelope, None, routes, auth=auth)
+                return '250 Message accepted for delivery'
+
+            client = None
+            if self.resolver is not None:
+                with trace.span('ptr'):
+                    client = await self.client_name(session)
+                trace.set('client', client)
+
             # Parse the email message
-            msg = message_from_bytes(envelope.content, policy=default)
+            with trace.span('parse'):
+                if msg is None:
+                    msg = message_from_bytes(envelope.content, policy=default)
+                
+                # Extract subject and body
+                subject = msg.get('Subject', '(no subject)')
+                
+                # Get the email body
+                body = self.extract_body(msg) if needs_body else ''
+
+            if self.search is not None and kept:
+                self.search.add(subject, body, sender, envelope.rcpt_tos, msg.get('Message-ID'))
+
+            # Save attachments to content-addressed storage off the event loop
+            attachments = []
+            if needs_attachments:
+                with trace.span('attachments'):
+                    attachments = await asyncio.get_running_loop().run_in_executor(
+                        None, save_attachments, msg, self.blobs)
             
-            # Extract subject and body
-            subject = msg.get('Subject', '(no subject)')
-            sender = envelope.mail_from
-            recipients = ', '.join(envelope.rcpt_tos)
+            with trace.span('print' if routes is None else 'dispatch'):
+                if routes is None:
+                    self.print_email(sender, envelope.rcpt_tos, subject, body, attachments, client, auth)
+                else:
+                    await self.dispatch(envelope, routes, subject, body, attachments)
             
-            # Get the email body
-            body = ''
-            if msg.is_multipart():
-                for part in msg.walk():
-                    if part.get_content_type() == 'text/plain':
-                        body = part.get_content()
-                        break
-                    elif part.get_content_type() == 'text/html' and not body:
-                        body = part.get_content()
+            self.record_delivery(dedup_key, envelope)
+            self.publish(session, envelope, subject, routes, client, auth)
+            return '250 Message accepted for delivery'
+            
+        except Exception as e:
+            trace.error(e)
+            print(f"Error processing email: {e}")
+            return '500 Error processing message'
+
+    def record_delivery(self, dedup_key, envelope):
+        """Remember a handled message, unless LMTP will see a retry for a failed recipient"""
+        if dedup_key is not None and not getattr(envelope, 'rcpt_status', None):
+            self.dedup.record(dedup_key)
+
+    def publish(self, session, envelope, subject, routes, client=None, auth=None):
+        """Send a summary to webserver.py's live /stream, if configured"""
+        if self.events is None:
+            return
+        self.events.publish(summary(
+            'smtp', envelope.mail_from, envelope.rcpt_tos, subject, len(envelope.content),
+            ts=time.time(), client=client or (session.peer[0] if isinstance(session.peer, tuple) else None),
+            actions=sorted({action for action, _ in routes}) if routes else ['print'],
+            auth=auth.summary() if auth else None))
+
+    def extract_body(self, msg):
+        """Return the text/plain body, or a text rendering of the html one"""
+        body = ''
+        html = ''
+        if msg.is_multipart():
+            for part in msg.walk():
+                ctype = content_type(part)
+                if ctype == 'text/plain':
+                    body = get_text(part)
+                    break
+                elif ctype == 'text/html' and not html:
+                    html = get_text(part)
+        else:
+            ctype = content_type(msg)
+            if ctype == 'text/html':
+                html = get_text(msg)
+            elif ctype.startswith('text/'):
+                body = get_text(msg)
             else:
                 body = msg.get_content()
-            
-            # Print email details
-            print("\n" + "="*60)
-            print(f"📧 NEW EMAIL RECEIVED")
-            print("-"*60)
-            print(f"From: {sender}")
-            print(f"To: {recipients}")
-            print(f"Subject: {subject}")
+        if not body and html:
+            # html-only message: render a bounded plain-text preview
+            body = html_preview(html, self.html_preview_chars)
+        return body
+
+    def print_email(self, sender, rcpt_tos, subject, body, attachments=(), client=None, auth=None):
+        """Print email details"""
+        if not self.verbose:
+            print(f"📧 {sender} → {', '.join(rcpt_tos)}: {subject}")
+            return
+        print("\n" + "="*60)
+        print(f"📧 NEW EMAIL RECEIVED")
+        print("-"*60)
+        print(f"From: {sender}")
+        print(f"To: {', '.join(rcpt_tos)}")
+        if client:
+            print(f"Client: {client}")
+        if auth:
+            print(f"Auth: {auth.summary()}")
+        print(f"Subject: {subject}")
+        print("-"*60)
+        print("Body:")
+        print(body.strip() if body else "(empty body)")
+        if attachments:
             print("-"*60)
-            print("Body:")
-            print(body.strip() if body else "(empty body)")
-            print("="*60 + "\n")
+            print("Attachments:")
+            for info in attachments:
+                name = info['filename'] or '(unnamed)'
+                if 'sha256' in info:
+                    print(f"  📎 {name} ({info['content_type']}, {info['size']} bytes) sha256:{info['sha256'][:12]}")
+                else:
+                    print(f"  📎 {name} ({info['content_type']}) not saved: {info['skipped']}")
+        print("="*60 + "\n")
+
+    def route(self, sender, rcpt_tos, msg):
+        """Group recipients by (action, target)"""
+        routes = {}
+        for rcpt in rcpt_tos:
+            r = self.router.route(rcpt, sender, msg)
+            routes.setdefault((r.action, r.target), []).append(rcpt)
+        return routes
+
+    async def dispatch(self, envelope, routes, subject, body, attachments):
+        """Run the routed action for each group of recipients"""
+        loop = asyncio.get_running_loop()
+        sender = envelope.mail_from
+        auth = getattr(envelope, 'auth_results', None)
+        for (action, target), rcpts in routes.items():
+            try:
+                if action == 'print':
+                    self.print_email(sender, rcpts, subject, body, attachments, auth=auth)
+                elif action == 'store':
+                    if self.store is None:
+                        print(f"⚠️  No --store-dir configured, printing instead")
+                        self.print_email(sender, rcpts, subject, body, attachments)
+                        continue
+                    await loop.run_in_executor(
+                        None, functools.partial(self.store.append, envelope.content,
+                                                mail_from=sender, rcpt_tos=rcpts))
+                elif action == 'forward':
+                    await loop.run_in_executor(
+                        None, forward_message, target, sender, rcpts, envelope.content)
+                elif action == 'webhook':
+                    payload = {'from': sender, 'to': rcpts, 'subject': str(subject),
+                               'body': body or '', 'attachments': attachments or []}
+                    await loop.run_in_executor(None, post_webhook, target, payload)
+                # 'drop' needs no work
+            except Exception as e:
+                print(f"⚠️  Route {action} -> {target} failed for {', '.join(rcpts)}: {e}")
+                # LMTP reports these recipients as failed so only they are retried
+                statuses = getattr(envelope, 'rcpt_status', None)
+                if statuses is not None:
+                    for rcpt in rcpts:
+                        statuses[rcpt] = f'451 4.3.0 <{rcpt}>: {action} failed, try again later'
+
+
+def forward_message(target, sender, rcpts, content):
+    """Relay a raw message to host[:port] over SMTP"""
+    import smtplib
+    host, _, port = target.rpartition(':') if ':' in target else (target, '', '25')
+    with smtplib.SMTP(host, int(port), timeout=30) as smtp:
+        smtp.sendmail(sender or '', rcpts, content)
+
+
+def post_webhook(url, payload):
+    """POST a JSON summary of a message to a webhook URL"""
+    import urllib.request
+    import json
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode(),
+        headers={'Content-Type': 'application/json'}, method='POST')
+    with urllib.request.urlopen(request, timeout=10) as response:
+        response.read()
+
+
+SMTP_COMMANDS = frozenset(('EHLO', 'HELO', 'LHLO', 'STARTTLS', 'MAIL', 'RCPT', 'DATA', 'RSET', 'NOOP', 'QUIT'))
+
+
+def path_address(arg, keyword):
+    """The address in 'FROM:<addr> PARAM=...' or 'TO:<addr>', without the parameters"""
+    arg = arg.strip()
+    if arg[:len(keyword)].upper() == keyword:
+        arg = arg[len(keyword):].strip()
+    if arg.startswith('<'):
+        end = arg.find('>')
+        return arg[1:end] if end != -1 else arg[1:]
+    return arg.split(None, 1)[0] if arg else ''
+
+
+def remove_stale_socket(path):
+    """Unlink a Unix socket left behind by a previous run; refuse if one is live"""
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+    except OSError:
+        pass
+    else:
+        raise OSError(f"[Errno 98] Address already in use: {path}")
+    finally:
+        probe.close()
+
+
+async def read_data(reader, buffer, hasher=None):
+    """Read a DATA body up to the lone-dot terminator, undoing dot-stuffing"""
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError("connection closed during DATA")
+        if line[:1] == b".":
+            if line == b".\r\n" or line == b".\n":
+                return
+            line = line[1:]
+        buffer.write(line)
+        if hasher is not None:
+            hasher.update(line)
+
+
+def session_info(session, envelope, started):
+    """One row of the admin session table"""
+    peer = session.peer
+    return {'peer': f"{peer[0]}:{peer[1]}" if isinstance(peer, tuple) else (peer or 'unix'),
+            'listener': getattr(session, 'listener', None),
+            'age': round(time.time() - started, 1),
+            'helo': getattr(session, 'host_name', None),
+            'user': getattr(session, 'user', None),
+            'mail_from': envelope.mail_from,
+            'rcpts': len(envelope.rcpt_tos)}
+
+
+class BudgetedSMTP(SMTPServer):
+    """aiosmtpd SMTP session that honours the global memory budget
+
+    It also feeds the session capture when one is configured.
+    """
+    budget = None
+    capture = None
+    # The controller's set of open sessions
+    live = None
+
+    def __init__(self, *args, capture=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.captured = NULL_SESSION
+        self.started = time.time()
+        self.capture = capture
+        if capture is not None:
+            self._smtp_methods = {name: self._captured_command(name, method)
+                                  for name, method in self._smtp_methods.items()}
+
+    def _captured_command(self, name, method):
+        # wraps() keeps __smtp_syntax__ and friends, which HELP reads
+        @functools.wraps(method)
+        async def command(arg):
+            self.captured.command(f"{name} {arg}" if arg else name)
+            return await method(arg)
+        return command
+
+    def connection_made(self, transport):
+        # Called again after STARTTLS; keep the capture and lookups that are running
+        first = self.transport is None
+        if self.capture is not None and first:
+            self.captured = self.capture.session(transport.get_extra_info('peername'))
+        if first and self.live is not None:
+            self.live.add(self)
+        super().connection_made(transport)
+        # A new session is created after STARTTLS too
+        self.session.gates = getattr(self.event_handler, 'gates', None)
+        if first and hasattr(self.event_handler, 'start_lookups'):
+            self.event_handler.start_lookups(self.session)
+
+    async def _handle_client(self):
+        gates = self.session.gates
+        if gates is not None:
+            result = await gates.pregreet(self._reader)
+            if result != 'pass':
+                if result == 'early':
+                    await self.push('554 5.7.1 Protocol error: talked before the greeting')
+                self.transport.close()
+                return
+        await super()._handle_client()
+
+    def connection_lost(self, error):
+        self.captured.close('disconnect' if error is None else 'error')
+        self.captured = NULL_SESSION
+        if self.live is not None:
+            self.live.discard(self)
+        super().connection_lost(error)
+
+    async def smtp_DATA(self, arg):
+        if self.budget is not None and not self.budget.has_headroom() and self.envelope.rcpt_tos:
+            metrics.inc('mail_data_rejected_total', reason='memory')
+            await self.push('452 4.3.1 Insufficient system storage, try again later')
+            return
+        await super().smtp_DATA(arg)
+
+    async def _call_handler_hook(self, command, *args):
+        if command != 'DATA':
+            return await super()._call_handler_hook(command, *args)
+        self.captured.data(self.envelope.original_content or b'')
+        result = await self._budgeted_data_hook(*args)
+        self.captured.reply(result)
+        return result
+
+    async def _budgeted_data_hook(self, *args):
+        if self.budget is None:
+            return await super()._call_handler_hook('DATA', *args)
+        needed = int(len(self.envelope.content or b'') * (1 + PARSE_OVERHEAD))
+        if not await self.budget.reserve(needed):
+            metrics.inc('mail_data_rejected_total', reason='memory')
+            return '452 4.3.1 Insufficient system storage, try again later'
+        try:
+            return await super()._call_handler_hook('DATA', *args)
+        finally:
+            self.budget.release(needed)
+
+
+class BudgetedController(Controller):
+    def __init__(self, handler, budget=None, capture=None, **kwargs):
+        self.budget = budget
+        self.capture = capture
+        self.live = set()
+        super().__init__(handler, **kwargs)
+
+    def factory(self):
+        smtp = BudgetedSMTP(self.handler, capture=self.capture, **self.SMTP_kwargs)
+        smtp.budget = self.budget
+        smtp.live = self.live
+        return smtp
+
+    def drain(self):
+        """Stop accepting connections; open sessions carry on to the end"""
+        self.loop.call_soon_threadsafe(self.server.close)
+
+    def session_table(self):
+        return [session_info(smtp.session, smtp.envelope, smtp.started)
+                for smtp in list(self.live) if smtp.session is not None]
+
+
+class Listener:
+    """One address the server accepts connections on, and its policy
+
+    tls is 'none', 'starttls' or 'implicit' (TLS from the first byte, as on
+    port 465). auth is 'none', 'optional' or 'required'; AUTH is only
+    offered once the connection is encrypted, so it needs TLS.
+    """
+    TLS_MODES = ('none', 'starttls', 'implicit')
+    AUTH_POLICIES = ('none', 'optional', 'required')
+
+    def __init__(self, port=None, host='0.0.0.0', tls='none', auth='none', lmtp=False,
+                 unix_path=None, unix_mode=None):
+        if tls not in self.TLS_MODES:
+            raise ValueError(f"tls must be one of {', '.join(self.TLS_MODES)}")
+        if auth not in self.AUTH_POLICIES:
+            raise ValueError(f"auth must be one of {', '.join(self.AUTH_POLICIES)}")
+        if unix_path and tls != 'none':
+            # TLS over a local socket protects nothing
+            raise ValueError("Unix socket listeners do not use TLS")
+        if auth != 'none' and tls == 'none':
+            raise ValueError("auth needs tls=starttls or tls=implicit")
+        self.port = port
+        self.host = host
+        self.tls = tls
+        self.auth = auth
+        self.lmtp = lmtp
+        self.unix_path = unix_path
+        self.unix_mode = unix_mode
+
+    @property
+    def name(self):
+        return f"unix:{self.unix_path}" if self.unix_path else str(self.port)
+
+    def __repr__(self):
+        return (f"{self.name} ({'LMTP' if self.lmtp else 'SMTP'}, tls={self.tls}, "
+                f"auth={self.auth})")
+
+    @classmethod
+    def parse(cls, spec, host='0.0.0.0', tls='none', lmtp=False, unix_mode=None):
+        """Parse '[HOST:]PORT[,tls=MODE][,auth=POLICY][,lmtp]' or 'unix:PATH[,...]'
+
+        tls defaults to the given mode, or implicit on port 465.
+        """
+        address, *options = spec.split(',')
+        kwargs = {'lmtp': lmtp}
+        if address.startswith('unix:'):
+            kwargs['unix_path'] = address[len('unix:'):]
+            kwargs['unix_mode'] = unix_mode
+            kwargs['lmtp'] = True
+            kwargs['tls'] = 'none'
+        else:
+            bind, _, port = address.rpartition(':')
+            kwargs['host'] = bind.strip('[]') or host
+            kwargs['port'] = int(port)
+            kwargs['tls'] = 'implicit' if kwargs['port'] == 465 else tls
+        for option in options:
+            key, _, value = option.strip().partition('=')
+            if key == 'lmtp' and not value:
+                kwargs['lmtp'] = True
+            elif key in ('tls', 'auth') and value:
+                kwargs[key] = value
+            else:
+                raise ValueError(f"unknown listener option {option!r}")
+        return cls(**kwargs)
+
+
+class WorkingSMTPServer:
+    """asyncio SMTP server; also speaks LMTP (RFC 2033), over TCP or a Unix socket
+
+    It serves every Listener it is given from one event loop, sharing the
+    TLS context, handler, budget and capture. Without listeners it serves
+    hostname:port (or unix_path) alone, with STARTTLS if there is an
+    ssl_context.
+
+    In LMTP mode the client greets with LHLO and gets one reply per
+    accepted recipient after DATA, taken from envelope.rcpt_status where
+    the handler set one and from the handler's result otherwise.
+    """
+
+    def __init__(self, handler, hostname, port, ssl_context, tracer=None, budget=None,
+                 capture=None, server_name=None, lmtp=False, unix_path=None, unix_mode=None,
+                 listeners=None, credentials=None):
+        self.handler = handler
+        # Resolved once here; getfqdn() blocks on the resolver
+        self.server_name = server_name or socket.getfqdn()
+        self.hostname = hostname
+        self.port = port
+        self.ssl_context = ssl_context
+        self.tracer = tracer
+        self.budget = budget
+        self.capture = capture
+        self.credentials = credentials
+        if listeners is None:
+            tls = 'starttls' if ssl_context is not None and unix_path is None else 'none'
+            listeners = [Listener(port, hostname, tls=tls, lmtp=lmtp,
+                                  unix_path=unix_path, unix_mode=unix_mode)]
+        self.listeners = listeners
+        self.servers = []
+        # Connections being served, task -> session, for the admin session
+        # table and so they can be ended on shutdown
+        self.sessions = {}
+        self.loop = None
+        self.error = None
+        
+    async def handle_client(self, reader, writer, listener=None):
+        """Handle a client connection with proper SMTP greeting"""
+        listener = listener or self.listeners[0]
+        lmtp = listener.lmtp
+        task = asyncio.current_task()
+        # TLS state of this connection, and the user once AUTH succeeds
+        encrypted = listener.tls == 'implicit'
+        user = None
+        client_addr = writer.get_extra_info('peername')
+        trace = self.tracer.session(peer=str(client_addr)) if self.tracer else NULL_TRACE
+        captured = self.capture.session(client_addr) if self.capture else NULL_SESSION
+        end = 'error'
+        metrics.inc('mail_sessions_total', listener=listener.name, help='Client connections by listener')
+        # Submission and local delivery are not for strangers; only gate the rest
+        gates = None
+        if not lmtp and listener.auth != 'required' and not listener.unix_path:
+            gates = getattr(self.handler, 'gates', None)
+        envelope = type('Envelope', (), {
+            'mail_from': None,
+            'rcpt_tos': [],
+            'rcpt_status': {},
+            'content': b''
+        })()
+        session = type('Session', (), {'peer': client_addr, 'trace': trace,
+                                       'listener': listener.name, 'user': None,
+                                       'gates': gates, 'started': time.time(),
+                                       'writer': writer, 'envelope': envelope})()
+        self.sessions[task] = session
+        
+        try:
+            if gates is not None:
+                result = await gates.pregreet(reader)
+                if result != 'pass':
+                    end = 'pregreet'
+                    trace.set('end', end)
+                    if result == 'early':
+                        writer.write(b"554 5.7.1 Protocol error: talked before the greeting\r\n")
+                        await writer.drain()
+                    return
+
+            # Send initial greeting immediately - this fixes the bug!
+            with trace.span('greeting'):
+                if lmtp:
+                    writer.write(f"220 {self.server_name} LMTP ready\r\n".encode())
+                else:
+                    writer.write(b"220 Mail Server Ready\r\n")
+                await writer.drain()
             
-            return '250 Message accepted for delivery'
+            if hasattr(self.handler, 'start_lookups'):
+                self.handler.start_lookups(session)
             
+            while True:
+                try:
+                    data = await asyncio.wait_for(reader.readline(), timeout=30.0)
+                except asyncio.TimeoutError:
+                    end = 'timeout'
+                    trace.set('end', end)
+                    break
+                    
+                if not data:
+                    end = 'disconnect'
+                    trace.set('end', end)
+                    break
+                    
+                command = decode_command(data).strip()
+                parts = command.split(None, 1)
+                if not parts:
+                    continue
+                    
+                cmd = parts[0].upper()
+                arg = parts[1] if len(parts) > 1 else ''
+                # Keep credentials out of capture files
+                captured.command(f"AUTH {arg.split(None, 1)[0]}" if cmd == "AUTH" and arg else command)
+                starttls = listener.tls == 'starttls' and not encrypted
+                auth_offered = (listener.auth != 'none' and encrypted and user is None
+                                and self.credentials is not None)
+                
+                with trace.span(cmd if cmd in SMTP_COMMANDS else 'unknown'):
+                    if cmd == ("LHLO" if lmtp else "EHLO") or (cmd == "HELO" and not lmtp):
+                        session.host_name = arg
+                        response = f"250-{self.server_name}\r\n250-8BITMIME\r\n"
+                        if lmtp:
+                            response += "250-PIPELINING\r\n"
+                        if starttls:
+                            response += "250-STARTTLS\r\n"
+                        if auth_offered:
+                            response += "250-AUTH PLAIN LOGIN\r\n"
+                        response += "250 OK\r\n"
+                        writer.write(response.encode())
+
+                    elif cmd in ("EHLO", "HELO") and lmtp:
+                        writer.write(b"500 5.5.1 This is an LMTP server, use LHLO\r\n")
+
+                    elif cmd == "AUTH" and auth_offered:
+                        user = await self.authenticate(arg, reader, writer)
+                        session.user = user
+
+                    elif cmd == "AUTH" and user is not None:
+                        writer.write(b"503 5.5.1 Already authenticated\r\n")
+
+                    elif cmd == "AUTH" and listener.auth != 'none' and not encrypted:
+                        writer.write(b"538 5.7.11 Encryption required for requested authentication mechanism\r\n")
+
+                    elif cmd == "MAIL" and listener.auth == 'required' and user is None:
+                        writer.write(b"530 5.7.0 Authentication required\r\n")
+                        
+                    elif cmd == "STARTTLS" and starttls and reader._buffer:
+                        # Plaintext pipelined after STARTTLS would otherwise be read as if
+                        # it came over TLS (CVE-2011-0411); hang up rather than guess
+                        writer.write(b"554 5.5.1 Error: command pipelined after STARTTLS\r\n")
+                        await writer.drain()
+                        end = 'starttls-pipelined'
+                        trace.set('end', end)
+                        break
+
+                    elif cmd == "STARTTLS" and starttls:
+                        writer.write(b"220 Ready to start TLS\r\n")
+                        await writer.drain()
+                        
+                        # Upgrade to TLS
+                        transport = writer.transport
+                        protocol = transport.get_protocol()
+                        new_transport = await asyncio.get_event_loop().start_tls(
+                            transport, protocol, self.ssl_context, server_side=True
+                        )
+                        writer._transport = new_transport
+                        encrypted = True
+                        # RFC 3207: forget everything from before the handshake,
+                        # the client's EHLO included
+                        session.host_name = None
+                        envelope.mail_from = None
+                        envelope.rcpt_tos = []
+                        envelope.rcpt_status = {}
+
+                    elif cmd in ("MAIL", "AUTH") and encrypted and listener.tls == 'starttls' \
+                            and session.host_name is None:
+                        writer.write(b"503 5.5.1 Send EHLO again after STARTTLS\r\n")
+                        
+                    elif cmd == "MAIL":
+                        envelope.mail_from = path_address(arg, 'FROM:')
+                        envelope.rcpt_tos = []
+                        envelope.rcpt_status = {}
+                        writer.write(b"250 OK\r\n")
+
+                    elif cmd == "RCPT":
+                        address = path_address(arg, 'TO:')
+                        if hasattr(self.handler, 'handle_RCPT'):
+                            result = await self.handler.handle_RCPT(None, session, envelope, address, [])
+                        else:
+                            envelope.rcpt_tos.append(address)
+                            result = "250 OK"
+                        writer.write(f"{result}\r\n".encode())
+
+                    elif cmd == "DATA" and not envelope.rcpt_tos:
+                        writer.write(b"503 Error: need RCPT command\r\n")
+
+                    elif cmd == "DATA" and self.budget is not None and not self.budget.has_headroom():
+                        metrics.inc('mail_data_rejected_total', reason='memory')
+                        writer.write(b"452 4.3.1 Insufficient system storage, try again later\r\n")
+
+                    elif cmd == "DATA":
+                        writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                        await writer.drain()
+                        
+                        # Collect email data
+                        buffer = DataBuffer(self.budget)
+                        hasher = DedupHasher() if getattr(self.handler, 'dedup', None) else None
+                        try:
+                            with trace.span('receive') as span:
+                                await read_data(reader, buffer, hasher)
+                                envelope.dedup_key = hasher.key() if hasher else None
+                                span.set('bytes', buffer.size)
+                                span.set('spilled', buffer.spilled)
+                            
+                            content = await buffer.load()
+                            captured.data(content, buffer.size)
+                            if content is None:
+                                metrics.inc('mail_data_rejected_total', reason='memory')
+                                result = "452 4.3.1 Insufficient system storage, try again later"
+                            else:
+                                envelope.content = content
+                                
+                                # Call the handler
+                                with trace.span('handler'):
+                                    result = await self.handler.handle_DATA(None, session, envelope)
+                                metrics.inc('mail_messages_total', help='Messages received over SMTP')
+                        finally:
+                            envelope.content = b''
+                            buffer.release()
+                        if lmtp:
+                            replies = [envelope.rcpt_status.get(rcpt, result) for rcpt in envelope.rcpt_tos]
+                        else:
+                            replies = [result]
+                        for reply in replies:
+                            captured.reply(reply)
+                            writer.write(f"{reply}\r\n".encode())
+                        # The transaction is over either way
+                        envelope.mail_from = None
+                        envelope.rcpt_tos = []
+                        envelope.rcpt_status = {}
+
+                    elif cmd == "RSET":
+                        envelope.mail_from = None
+                        envelope.rcpt_tos = []
+                        envelope.rcpt_status = {}
+                        writer.write(b"250 OK\r\n")
+
+                    elif cmd == "NOOP":
+                        writer.write(b"250 OK\r\n")
+                        
+                    elif cmd == "QUIT":
+                        end = 'quit'
+                        trace.set('end', end)
+                        writer.write(b"221 Bye\r\n")
+                        await writer.drain()
+                        break
+                    else:
+                        writer.write(b"500 Command not recognized\r\n")
+                    
+                    with trace.span('reply'):
+                        await writer.drain()
+                
         except Exception as e:
-            print(f"Error processing email: {e}")
-            return '500 Error processing message'
+            # Connection errors are routine; keep them out of the console
+            # but record them on the session trace
+            trace.error(e)
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except:
+                pass
+            trace.close()
+            captured.close(end)
+            self.sessions.pop(task, None)
+    
+    async def authenticate(self, arg, reader, writer):
+        """Run an AUTH PLAIN/LOGIN exchange; returns the user name or None"""
+        mechanism, _, initial = arg.partition(' ')
+        mechanism = mechanism.upper()
+        initial = initial.strip()
+
+        async def challenge(prompt):
+            writer.write(b"334 " + prompt + b"\r\n")
+            await writer.drain()
+            line = (await asyncio.wait_for(reader.readline(), timeout=30.0)).strip()
+            if line == b"*":
+                raise ValueError("cancelled")
+            return base64.b64decode(line, validate=True)
+
+        try:
+            if mechanism == "PLAIN":
+                response = base64.b64decode(initial, validate=True) if initial else await challenge(b"")
+                _, username, password = response.split(b"\0", 2)
+            elif mechanism == "LOGIN":
+                username = (base64.b64decode(initial, validate=True) if initial
+                            else await challenge(base64.b64encode(b"Username:")))
+                password = await challenge(base64.b64encode(b"Password:"))
+            else:
+                writer.write(b"504 5.5.4 Unrecognized authentication type\r\n")
+                return None
+            username = username.decode('utf-8')
+            password = password.decode('utf-8')
+        except (ValueError, binascii.Error):
+            writer.write(b"501 5.5.2 Cannot decode response\r\n")
+            return None
+
+        ok = await asyncio.get_running_loop().run_in_executor(
+            None, self.credentials.verify, username, password)
+        metrics.inc('mail_auth_total', result='success' if ok else 'failure',
+                    help='SMTP AUTH attempts by outcome')
+        if not ok:
+            writer.write(b"535 5.7.8 Authentication credentials invalid\r\n")
+            return None
+        writer.write(b"235 2.7.0 Authentication successful\r\n")
+        return username
+
+    async def listen(self, listener):
+        handle = functools.partial(self.handle_client, listener=listener)
+        if listener.unix_path:
+            remove_stale_socket(listener.unix_path)
+            server = await asyncio.start_unix_server(handle, listener.unix_path)
+            if listener.unix_mode is not None:
+                os.chmod(listener.unix_path, listener.unix_mode)
+            return server
+        ssl_context = self.ssl_context if listener.tls == 'implicit' else None
+        server = await asyncio.start_server(handle, listener.host, listener.port, ssl=ssl_context)
+        if not listener.port:
+            # Port 0: record the one the kernel picked
+            listener.port = server.sockets[0].getsockname()[1]
+        return server
+
+    async def bind(self):
+        """Start accepting on every listener; on failure close the ones already open"""
+        try:
+            for listener in self.listeners:
+                self.servers.append(await self.listen(listener))
+        except OSError:
+            for server in self.servers:
+                server.close()
+            self.servers = []
+            raise
+
+    async def start_async(self):
+        await self.bind()
+        await asyncio.gather(*(server.serve_forever() for server in self.servers))
+            
+    def start(self):
+        # Run in a new thread like Controller does
+        import threading
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        # Give it a moment to start and potentially fail
+        import time
+        time.sleep(0.5)
+        if not self.thread.is_alive():
+            raise self.error or OSError("[Errno 98] Address already in use")
+        
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.bind())
+        except OSError as e:
+            self.error = e
+            return
+        # The listeners serve on their own; sessions keep running after drain()
+        self.loop.run_forever()
+
+    def _close_listeners(self):
+        for server in self.servers:
+            server.close()
+
+    def drain(self):
+        """Stop accepting connections; open sessions carry on to the end"""
+        self.loop.call_soon_threadsafe(self._close_listeners)
+
+    def session_table(self):
+        return [session_info(session, session.envelope, session.started)
+                for session in list(self.sessions.values())]
+        
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._close_listeners)
+        else:
+            self._close_listeners()
+        for listener in self.listeners:
+            if listener.unix_path and os.path.exists(listener.unix_path):
+                os.unlink(listener.unix_path)
+
+
+class MailServer:
+    """An in-process server for tests and embedding, on the caller's event loop
+
+        async with MailServer(handler) as server:
+            host, port = server.address
+            ...
+
+    Without listeners it serves plain SMTP on 127.0.0.1 with port 0, so the
+    kernel picks a free port; server.addresses lists what was bound, in
+    listener order. start() returns as soon as every socket is listening.
+    stop() closes the listeners, ends the sessions still open and waits for
+    them, so nothing outlives the block. Other keyword arguments go to
+    WorkingSMTPServer.
+
+    It can also run on a private loop in a thread, for blocking clients
+    like smtplib:
+
+        with MailServer(handler) as server:
+            smtplib.SMTP(*server.address).sendmail(...)
+    """
+
+    def __init__(self, handler, listeners=None, ssl_context=None, server_name='localhost', **kwargs):
+        # An explicit server_name keeps construction from blocking on getfqdn()
+        self.server = WorkingSMTPServer(handler, '127.0.0.1', 0, ssl_context, server_name=server_name,
+                                        listeners=listeners or [Listener(0, '127.0.0.1')], **kwargs)
+        self._loop = None
+        self._thread = None
+
+    @property
+    def listeners(self):
+        return self.server.listeners
+
+    @property
+    def addresses(self):
+        """(host, port) for each TCP listener and the path for each Unix one"""
+        return [listener.unix_path or server.sockets[0].getsockname()[:2]
+                for listener, server in zip(self.server.listeners, self.server.servers)]
+
+    @property
+    def address(self):
+        return self.addresses[0]
+
+    async def start(self):
+        await self.server.bind()
+        return self
+
+    async def stop(self):
+        servers, self.server.servers = self.server.servers, []
+        for server in servers:
+            server.close()
+        # Dropping the connection ends each session at its next read or write
+        sessions = dict(self.server.sessions)
+        for session in sessions.values():
+            session.writer.transport.abort()
+        await asyncio.gather(*sessions, return_exceptions=True)
+        for server in servers:
+            await server.wait_closed()
+        for listener in self.server.listeners:
+            if listener.unix_path and os.path.exists(listener.unix_path):
+                os.unlink(listener.unix_path)
 
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def __enter__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe(self.start(), self._loop).result()
+        except BaseException:
+            self._shutdown_loop()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        finally:
+            self._shutdown_loop()
+
+    def _shutdown_loop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
 
 
 def generate_self_signed_cert(cert_file='mailserver.crt', key_file='mailserver.key'):
@@ -306,6 +1291,84 @@ def run_diagnostics(hostname, port):
     return True
 
 
+def admin_commands(controller, handler, budget=None, store=None, compactor=None, credentials=None,
+                   ssl_context=None, cert=None, key=None, on_drain=None):
+    """The commands mailctl.py can send over --admin-socket"""
+    started = time.time()
+    state = {'draining': False}
+
+    def stats(arg):
+        result = {'uptime': round(time.time() - started), 'sessions': len(controller.session_table()),
+                  'draining': state['draining'], 'verbose': handler.verbose}
+        if budget is not None:
+            result['memory'] = {'limit': budget.limit, 'used': budget.used, 'peak': budget.peak}
+            result['queue'] = {'waiting_for_memory': budget.waiting}
+            result['spool'] = {'spilled_bodies': budget.spilled}
+        if compactor is not None:
+            result.setdefault('spool', {})['uncompacted_segments'] = len(
+                store.sealed_segments(compactor.min_age))
+        result['counters'] = {name: value for name, value in sorted(metrics.snapshot().items())
+                              if name.startswith('mail_')}
+        return result
+
+    def report(minutes, n, measure):
+        if handler.traffic is None:
+            raise ValueError("traffic statistics are off (--traffic-minutes 0)")
+        return handler.traffic.report(int(minutes or 60), int(n or 10), measure or 'messages')
+
+    def top(arg):
+        """'[N] [MEASURE] [MINUTES]': the busiest client IPs and sender domains"""
+        n, measure, minutes = (arg.split() + [None] * 3)[:3]
+        return report(minutes, n, measure)
+
+    def traffic(arg):
+        """'[MINUTES]': totals per minute, with the top talkers"""
+        return report(arg or None, None, None)
+
+    def verbose(arg):
+        if arg not in ('', 'on', 'off'):
+            raise ValueError("verbose takes on, off or nothing (to toggle)")
+        handler.verbose = not handler.verbose if not arg else arg == 'on'
+        return {'verbose': handler.verbose}
+
+    def drain(arg):
+        if not state['draining']:
+            state['draining'] = True
+            controller.drain()
+            print("🚰 Draining: no new connections, waiting for open sessions")
+            if on_drain is not None:
+                on_drain()
+        return {'draining': True, 'sessions': len(controller.session_table())}
+
+    def reload(arg):
+        reloaders = {}
+        if handler.router is not None:
+            reloaders['routes'] = handler.router.reload
+        if handler.recipients is not None:
+            reloaders['recipients'] = handler.recipients.reload
+        if credentials is not None:
+            reloaders['credentials'] = credentials.reload
+        if ssl_context is not None:
+            def reload_tls():
+                try:
+                    # New handshakes use the new certificate; open sessions keep theirs
+                    ssl_context.load_cert_chain(cert, key)
+                except (OSError, ssl.SSLError) as e:
+                    print(f"⚠️  Certificate not reloaded: {e}")
+                    return False
+                print(f"🔒 Reloaded certificate {cert}")
+                return True
+            reloaders['tls'] = reload_tls
+        names = arg.split() or list(reloaders)
+        for name in names:
+            if name not in reloaders:
+                raise ValueError(f"nothing to reload for {name!r}; have: {', '.join(reloaders) or 'none'}")
+        return {name: reloaders[name]() for name in names}
+
+    return {'stats': stats, 'top': top, 'traffic': traffic, 'verbose': verbose, 'drain': drain, 'reload': reload,
+            'sessions': lambda arg: controller.session_table()}
+
+
 def find_letsencrypt_cert():
     """Try to find Let's Encrypt certificates automatically"""
     hostname = socket.getfqdn()
@@ -344,8 +1407,24 @@ def main():
     parser = argparse.ArgumentParser(description='Simple email server that prints emails to console')
     parser.add_argument('--host', default='0.0.0.0', 
                         help='Hostname to bind to (default: 0.0.0.0 for all interfaces)')
-    parser.add_argument('--port', type=int, default=25,
-                        help='Port to listen on (default: 25 for SMTP server-to-server delivery)')
+    parser.add_argument('--port', type=int,
+                        help='Port to listen on (default: 25 for SMTP server-to-server delivery, '
+                             '24 with --lmtp)')
+    parser.add_argument('--lmtp', action='store_true',
+                        help='Speak LMTP (RFC 2033) for delivery from a local MTA such as Postfix')
+    parser.add_argument('--unix-socket',
+                        help='Listen on this Unix domain socket instead of a TCP port (implies --lmtp)')
+    parser.add_argument('--unix-socket-mode', type=lambda mode: int(mode, 8), default=0o660,
+                        help='Permissions for --unix-socket, in octal (default: 660)')
+    parser.add_argument('--listen', action='append', default=[], metavar='SPEC',
+                        help='Serve this listener instead of --port; repeatable. SPEC is '
+                             '[HOST:]PORT or unix:PATH, then optional ,tls=none|starttls|implicit '
+                             ',auth=none|optional|required ,lmtp. E.g. --listen 25 '
+                             '--listen 587,auth=required --listen 465,auth=required '
+                             '(465 defaults to implicit TLS)')
+    parser.add_argument('--auth-file',
+                        help='Accounts for SMTP AUTH on auth= listeners, made with credentials.py '
+                             '(reloaded on change)')
     parser.add_argument('--tls', action='store_true', default=True,
                         help='Enable TLS/STARTTLS support (default: enabled)')
     parser.add_argument('--no-tls', dest='tls', action='store_false',
@@ -356,11 +1435,86 @@ def main():
                         help=f'Path to TLS private key file (default: {default_key})')
     parser.add_argument('--generate-cert', action='store_true',
                         help='Generate a self-signed certificate if none exists')
+    parser.add_argument('--routes',
+                        help='JSON routing config mapping recipients to actions (reloaded on change)')
+    parser.add_argument('--store-dir',
+                        help='Directory for messages routed to the "store" action')
+    parser.add_argument('--compact-after', type=int,
+                        help='Compress stored segments once they are this many seconds old '
+                             '(zstd if installed, else zlib)')
+    parser.add_argument('--recipients',
+                        help='File of valid recipient addresses; others get 550 at RCPT time (reloaded on change)')
+    parser.add_argument('--attachments-dir',
+                        help='Save attachments to this content-addressed blob directory')
+    parser.add_argument('--max-attachment-size', type=int, default=25 * 1024 * 1024,
+                        help='Largest attachment to save, in bytes (default: 25MB)')
+    parser.add_argument('--max-attachments-total', type=int,
+                        help='Total size cap for the blob directory, in bytes')
+    parser.add_argument('--search-index',
+                        help='SQLite full-text index of subjects and bodies (query via webserver.py /search)')
+    parser.add_argument('--html-preview-chars', type=int, default=4000,
+                        help='Text characters rendered from html-only messages (default: 4000)')
+    parser.add_argument('--trace-file',
+                        help='Write per-session SMTP trace spans to this JSON-lines file')
+    parser.add_argument('--trace-sample', type=float, default=1.0,
+                        help='Fraction of sessions to trace (default: 1.0)')
+    parser.add_argument('--profile-dir',
+                        help='Enable the sampling profiler: SIGUSR2 starts/stops it and writes '
+                             'flamegraph stacks here')
+    parser.add_argument('--memory-budget', type=int,
+                        help='Total bytes of message data buffered across all sessions; '
+                             'DATA gets 452 when it is used up')
+    parser.add_argument('--server-name',
+                        help='Name announced in EHLO (default: this host\'s FQDN, looked up once)')
+    parser.add_argument('--resolve-clients', action='store_true',
+                        help='Look up client reverse DNS (cached, non-blocking) and show it')
+    parser.add_argument('--dns-server',
+                        help='Nameserver as HOST[:PORT] for client lookups (default: from /etc/resolv.conf)')
+    parser.add_argument('--verify-senders', action='store_true',
+                        help='Check SPF and DKIM after DATA (cached DNS, verification in a thread '
+                             'pool) and add an Authentication-Results header')
+    parser.add_argument('--verify-workers', type=int,
+                        help='Threads for DKIM verification (default: Python\'s ThreadPoolExecutor default)')
+    parser.add_argument('--pregreet-wait', type=float, default=0.0,
+                        help='Hold the 220 banner back this many seconds and drop clients that '
+                             'talk first (default: off)')
+    parser.add_argument('--helo-checks', action='store_true',
+                        help='Refuse RCPT from clients whose HELO is a bare IP, our own name '
+                             'or not a fully-qualified hostname')
+    parser.add_argument('--greylist', action='store_true',
+                        help='Greylist new (client /24, sender, recipient) triplets')
+    parser.add_argument('--greylist-delay', type=int, default=300,
+                        help='Seconds before a greylisted triplet may retry (default: 300)')
+    parser.add_argument('--greylist-file',
+                        help='Snapshot greylist triplets here so they survive restarts')
+    parser.add_argument('--capture-file',
+                        help='Record SMTP session transcripts here for smtp_replay.py')
+    parser.add_argument('--capture-bodies', action='store_true',
+                        help='Include DATA bodies in --capture-file (default: sizes only)')
+    parser.add_argument('--stream-socket',
+                        help='Publish a summary of each message to this Unix datagram socket, '
+                             'for webserver.py --stream-socket (GET /stream)')
+    parser.add_argument('--traffic-minutes', type=int, default=60,
+                        help='Keep per-minute message, byte and reject counts per client IP and '
+                             'sender domain for this many minutes (default: 60, 0: off)')
+    parser.add_argument('--admin-socket',
+                        help='Serve the mailctl.py admin interface (stats, top talkers, drain, '
+                             'reload) on this Unix socket')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve Prometheus metrics at http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--dedup-window', type=int, default=0,
+                        help='Skip repeats of a message (same Message-ID and body) seen within '
+                             'this many seconds (default: off)')
+    parser.add_argument('--dedup-file',
+                        help='Persist dedup keys here so they survive restarts')
     
     args = parser.parse_args()
+    if args.unix_socket and not args.listen:
+        args.lmtp = True
+        args.tls = False
     
     hostname = args.host
-    port = args.port
+    port = args.port if args.port is not None else (24 if args.lmtp else 25)
     
     # Setup TLS if enabled
     ssl_context = None
@@ -425,7 +1579,49 @@ def main():
     # Skip diagnostics - too verbose
     
     # Create and start the server
-    handler = EmailHandler()
+    router = Router(args.routes) if args.routes else None
+    store = MessageStore(args.store_dir) if args.store_dir else None
+    compactor = None
+    if store and args.compact_after is not None:
+        compactor = Compactor(store, min_age=args.compact_after)
+        compactor.start()
+    recipients = RecipientIndex(args.recipients) if args.recipients else None
+    blobs = BlobStore(args.attachments_dir, args.max_attachment_size,
+                      args.max_attachments_total) if args.attachments_dir else None
+    search = SearchIndex(args.search_index) if args.search_index else None
+    dedup = Deduplicator(args.dedup_window, args.dedup_file) if args.dedup_window else None
+    resolver = None
+    if args.resolve_clients or args.dns_server or args.verify_senders:
+        dns_host, _, dns_port = (args.dns_server or '').partition(':')
+        resolver = Resolver(dns_host or None, int(dns_port or 53))
+    events = EventPublisher(args.stream_socket) if args.stream_socket else None
+    server_name = args.server_name or socket.getfqdn()
+    verifier = Verifier(resolver, server_name, workers=args.verify_workers) if args.verify_senders else None
+    greylist = Greylist(args.greylist_delay, path=args.greylist_file) if args.greylist else None
+    gates = None
+    if args.pregreet_wait or args.helo_checks or greylist:
+        gates = Gates(server_name, args.pregreet_wait, args.helo_checks, greylist)
+    if greylist:
+        greylist.start()
+    traffic = None
+    if args.traffic_minutes:
+        traffic = TrafficStats(args.traffic_minutes)
+        traffic.register_metrics(metrics)
+    handler = EmailHandler(router=router, store=store, recipients=recipients, blobs=blobs,
+                           search=search, html_preview_chars=args.html_preview_chars,
+                           dedup=dedup, resolver=resolver if args.resolve_clients or args.dns_server else None,
+                           events=events, verifier=verifier, gates=gates,
+                           traffic=traffic)
+    
+    tracer = Tracer(args.trace_file, args.trace_sample) if args.trace_file else None
+    budget = MemoryBudget(args.memory_budget) if args.memory_budget else None
+    capture = SessionRecorder(args.capture_file, args.capture_bodies) if args.capture_file else None
+    if args.profile_dir:
+        import signal
+        profiler = SamplingProfiler(args.profile_dir)
+        profiler.arm()
+        signal.signal(signal.SIGUSR2, profiler.toggle)
+        print(f"🔥 Sampling profiler armed: kill -USR2 {os.getpid()} to start/stop")
     
     # Determine certificate type for display
     cert_type = None
@@ -437,150 +1633,38 @@ def main():
         else:
             cert_type = "custom"
     
-    # Use custom server implementation when TLS is enabled to fix greeting bug
-    if ssl_context:
-        # Use our custom implementation that properly sends SMTP greeting
-        import asyncio
-        
-        class WorkingSMTPServer:
-            def __init__(self, handler, hostname, port, ssl_context):
-                self.handler = handler
-                self.hostname = hostname
-                self.port = port
-                self.ssl_context = ssl_context
-                self.server = None
-                
-            async def handle_client(self, reader, writer):
-                """Handle a client connection with proper SMTP greeting"""
-                client_addr = writer.get_extra_info('peername')
-                
-                try:
-                    # Send initial greeting immediately - this fixes the bug!
-                    writer.write(b"220 Mail Server Ready\r\n")
-                    await writer.drain()
-                    
-                    envelope = type('Envelope', (), {
-                        'mail_from': None,
-                        'rcpt_tos': [],
-                        'content': b''
-                    })()
-                    
-                    session = type('Session', (), {'peer': client_addr})()
-                    
-                    while True:
-                        try:
-                            data = await asyncio.wait_for(reader.readline(), timeout=30.0)
-                        except asyncio.TimeoutError:
-                            break
-                            
-                        if not data:
-                            break
-                            
-                        command = data.decode('utf-8', errors='ignore').strip()
-                        parts = command.split(None, 1)
-                        if not parts:
-                            continue
-                            
-                        cmd = parts[0].upper()
-                        arg = parts[1] if len(parts) > 1 else ''
-                        
-                        if cmd in ("EHLO", "HELO"):
-                            response = f"250-{socket.getfqdn()}\r\n250-8BITMIME\r\n"
-                            if self.ssl_context:
-                                response += "250-STARTTLS\r\n"
-                            response += "250 OK\r\n"
-                            writer.write(response.encode())
-                            
-                        elif cmd == "STARTTLS" and self.ssl_context:
-                            writer.write(b"220 Ready to start TLS\r\n")
-                            await writer.drain()
-                            
-                            # Upgrade to TLS
-                            transport = writer.transport
-                            protocol = transport.get_protocol()
-                            new_transport = await asyncio.get_event_loop().start_tls(
-                                transport, protocol, self.ssl_context, server_side=True
-                            )
-                            writer._transport = new_transport
-                            
-                        elif cmd == "MAIL":
-                            envelope.mail_from = arg.replace('FROM:', '').strip('<>')
-                            writer.write(b"250 OK\r\n")
-                            
-                        elif cmd == "RCPT":
-                            envelope.rcpt_tos.append(arg.replace('TO:', '').strip('<>'))
-                            writer.write(b"250 OK\r\n")
-                            
-                        elif cmd == "DATA":
-                            writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
-                            await writer.drain()
-                            
-                            # Collect email data
-                            email_data = []
-                            while True:
-                                line = await reader.readline()
-                                if line == b".\r\n":
-                                    break
-                                email_data.append(line)
-                            
-                            envelope.content = b''.join(email_data)
-                            
-                            # Call the handler
-                            result = await self.handler.handle_DATA(None, session, envelope)
-                            writer.write(f"{result}\r\n".encode())
-                            
-                        elif cmd == "QUIT":
-                            writer.write(b"221 Bye\r\n")
-                            await writer.drain()
-                            break
-                        else:
-                            writer.write(b"500 Command not recognized\r\n")
-                        
-                        await writer.drain()
-                        
-                except Exception as e:
-                    pass  # Silently handle connection errors
-                finally:
-                    try:
-                        writer.close()
-                        await writer.wait_closed()
-                    except:
-                        pass
-            
-            async def start_async(self):
-                self.server = await asyncio.start_server(
-                    self.handle_client, self.hostname, self.port
-                )
-                async with self.server:
-                    await self.server.serve_forever()
-                    
-            def start(self):
-                # Run in a new thread like Controller does
-                import threading
-                self.thread = threading.Thread(target=self._run)
-                self.thread.daemon = True
-                self.thread.start()
-                # Give it a moment to start and potentially fail
-                import time
-                time.sleep(0.5)
-                if not self.thread.is_alive():
-                    raise OSError("[Errno 98] Address already in use")
-                
-            def _run(self):
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                loop.run_until_complete(self.start_async())
-                
-            def stop(self):
-                if self.server:
-                    self.server.close()
-        
+    listeners = None
+    if args.listen:
+        specs = args.listen + ([f"unix:{args.unix_socket}"] if args.unix_socket else [])
+        listeners = []
+        for spec in specs:
+            try:
+                listeners.append(Listener.parse(spec, hostname, 'starttls' if ssl_context else 'none',
+                                                args.lmtp, args.unix_socket_mode))
+            except ValueError as e:
+                parser.error(f"--listen {spec}: {e}")
+            if listeners[-1].tls != 'none' and not ssl_context:
+                parser.error(f"--listen {spec}: TLS needs a certificate (drop --no-tls)")
+            if listeners[-1].auth != 'none' and not args.auth_file:
+                parser.error(f"--listen {spec}: auth needs --auth-file")
+    credentials = CredentialStore(args.auth_file) if args.auth_file else None
+    
+    # Use custom server implementation when TLS is enabled to fix greeting bug,
+    # for LMTP, which aiosmtpd does not speak, and for several listeners
+    if ssl_context or args.lmtp or listeners:
         # Use working implementation for TLS
-        controller = WorkingSMTPServer(handler, hostname, port, ssl_context)
+        controller = WorkingSMTPServer(handler, hostname, port, ssl_context, tracer=tracer,
+                                       budget=budget, capture=capture, server_name=server_name,
+                                       lmtp=args.lmtp, unix_path=args.unix_socket,
+                                       unix_mode=args.unix_socket_mode,
+                                       listeners=listeners, credentials=credentials)
     else:
         # Use standard controller for non-TLS
-        controller = Controller(
+        controller = BudgetedController(
             handler, 
+            budget=budget,
+            capture=capture,
+            server_hostname=server_name,
             hostname=hostname, 
             port=port,
             auth_required=False,
@@ -603,7 +1687,13 @@ def main():
             print(f"   Check with: lsof -i :{port}")
         sys.exit(1)
     except OSError as e:
-        if "Address already in use" in str(e):
+        if listeners:
+            print(f"\n❌ Cannot start listeners: {e}")
+            print(f"   Check the ports are free (lsof -i) and the socket directories writable")
+        elif args.unix_socket:
+            print(f"\n❌ Cannot listen on {args.unix_socket}: {e}")
+            print(f"   Check the directory exists and is writable, and no other server is using it")
+        elif "Address already in use" in str(e):
             print(f"\n❌ Port {port} is already in use")
             print(f"   Check what's using it: lsof -i :{port}")
             print(f"   Or try a different port: ./mailserver --port {port + 1000}")
@@ -615,22 +1705,70 @@ def main():
         sys.exit(1)
     
     # Server started successfully, show minimal messages
-    external_ip = get_external_ip() or "unknown"
-    
-    print(f"\n✅ Mail server started on port {port}")
-    if hostname == '0.0.0.0':
+    if listeners:
+        print()
+        for listener in listeners:
+            print(f"✅ Listening on {listener!r}")
+    elif args.unix_socket:
+        print(f"\n✅ LMTP server listening on {args.unix_socket}")
+        print(f"📧 Postfix: mailbox_transport = lmtp:unix:{os.path.abspath(args.unix_socket)}")
+    elif args.lmtp:
+        print(f"\n✅ LMTP server started on port {port}")
+    else:
+        external_ip = get_external_ip() or "unknown"
+        print(f"\n✅ Mail server started on port {port}")
+    if hostname == '0.0.0.0' and not args.lmtp and not listeners:
         print(f"📧 Test: swaks --to test@localhost --from sender@example.com --server {external_ip}:{port}")
     print("Press Ctrl+C to stop\n")
     
+    admin = None
     try:
         # Keep the server running
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
+        if args.metrics_port:
+            loop.run_until_complete(start_metrics_server('127.0.0.1', args.metrics_port))
+            print(f"📊 Metrics at http://127.0.0.1:{args.metrics_port}/metrics")
+        if args.admin_socket:
+            async def stop_when_drained():
+                while controller.session_table():
+                    await asyncio.sleep(0.5)
+                print("✅ Drained")
+                loop.stop()
+
+            admin = AdminServer(args.admin_socket, admin_commands(
+                controller, handler, budget, store, compactor, credentials, ssl_context,
+                args.cert, args.key, on_drain=lambda: asyncio.ensure_future(stop_when_drained())))
+            try:
+                loop.run_until_complete(admin.start())
+            except OSError as e:
+                admin = None
+                print(f"\n❌ Cannot listen on admin socket {args.admin_socket}: {e}")
+                sys.exit(1)
+            print(f"🎛️  Admin socket at {args.admin_socket} (mailctl.py --socket {args.admin_socket} stats)")
         loop.run_forever()
     except KeyboardInterrupt:
         print("\n\n✋ Shutting down email server...")
     finally:
         controller.stop()
+        if admin:
+            admin.close()
+        if search:
+            search.close()
+        if tracer:
+            tracer.close()
+        if dedup:
+            dedup.close()
+        if compactor:
+            compactor.stop()
+        if capture:
+            capture.close()
+        if events:
+            events.close()
+        if verifier:
+            verifier.close()
+        if greylist:
+            greylist.stop()
         print("Server stopped.")
 
 
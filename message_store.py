@@ -0,0 +1,313 @@
+"""Append-only on-disk store for raw messages
+
+Messages are appended to numbered segment files and located through an
+index (index.jsonl) that maps a message id to (segment, offset, length).
+
+Sealed segments that are old enough can be compacted: a worker process
+rewrites NNNNNN.seg as NNNNNN.zseg where every message is its own
+compressed frame, using a dictionary trained on message headers. The index
+then points at the frame, so reading one message decompresses one frame.
+The new index is fsynced before the .seg is deleted, and an existing .zseg
+is never overwritten. A .seg that outlived a crash after the switch is then
+just removed.
+zstd is used when the zstandard package is installed, otherwise zlib with
+a preset dictionary.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from collections import Counter
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DICT_SIZE = 32 * 1024
+HEADER_SAMPLE = 4096
+
+
+def _fsync_dir(directory):
+    """Make renames and unlinks in directory durable"""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class MessageStore:
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, readonly=False):
+        self.directory = Path(directory)
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._dicts = {}
+        self.index = {}
+        self._index_file = None
+        self._segment = None
+        self._segment_name = None
+        if readonly:
+            self._load_index()
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._load_index()
+        self._index_file = open(self.directory / 'index.jsonl', 'a')
+        self._open_segment()
+
+    def _load_index(self):
+        path = self.directory / 'index.jsonl'
+        if not path.exists():
+            return
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn write at the end of the file
+                self.index[entry['id']] = entry
+
+    def _segments(self):
+        return sorted(self.directory.glob('*.seg'))
+
+    def _open_segment(self):
+        segments = self._segments()
+        if segments and segments[-1].stat().st_size < self.segment_size:
+            path = segments[-1]
+        else:
+            numbers = [int(p.stem) for p in self.directory.glob('*.*seg')]
+            path = self.directory / f'{max(numbers, default=0) + 1:06d}.seg'
+        self._segment = open(path, 'ab')
+        self._segment_name = path.name
+
+    def _next_id(self):
+        self._seq = (self._seq + 1) % 1000
+        return f'{time.time_ns() // 1000:x}{self._seq:03d}'
+
+    def append(self, content, **meta):
+        """Store a raw message and return its id"""
+        with self._lock:
+            if self._segment.tell() >= self.segment_size:
+                self._segment.close()
+                self._open_segment()
+            offset = self._segment.tell()
+            self._segment.write(content)
+            self._segment.flush()
+            entry = {
+                'id': self._next_id(),
+                'segment': self._segment_name,
+                'offset': offset,
+                'length': len(content),
+                'received': time.time(),
+                **meta,
+            }
+            self._index_file.write(json.dumps(entry) + '\n')
+            self._index_file.flush()
+            self.index[entry['id']] = entry
+            return entry['id']
+
+    def _dictionary(self, name):
+        if name not in self._dicts:
+            self._dicts[name] = (self.directory / 'dicts' / name).read_bytes()
+        return self._dicts[name]
+
+    def read(self, message_id):
+        """Return the raw bytes of a stored message"""
+        for attempt in range(2):
+            entry = self.index[message_id]
+            try:
+                with open(self.directory / entry['segment'], 'rb') as f:
+                    f.seek(entry['offset'])
+                    data = f.read(entry['length'])
+                break
+            except FileNotFoundError:
+                # Segment was compacted between the index lookup and open()
+                if attempt:
+                    raise
+        if 'codec' not in entry:
+            return data
+        zdict = self._dictionary(entry['dict']) if entry.get('dict') else None
+        return decompress_frame(entry['codec'], data, zdict)
+
+    def __iter__(self):
+        """Yield (id, entry) pairs in the order they were stored"""
+        return iter(list(self.index.items()))
+
+    def __len__(self):
+        return len(self.index)
+
+    def sealed_segments(self, min_age):
+        """Uncompressed segments no longer written to and older than min_age seconds"""
+        cutoff = time.time() - min_age
+        return [p.name for p in self._segments()
+                if p.name != self._segment_name and p.stat().st_mtime < cutoff]
+
+    def compact(self, segment, pool, level=9, rate_limit=None):
+        """Compress one sealed segment in a worker process and switch the index over"""
+        with self._lock:
+            entries = [e for e in self.index.values() if e['segment'] == segment]
+        if not entries:
+            # Left behind by a crash after the index moved to the .zseg;
+            # otherwise (a segment nothing points at) leave it alone
+            if (self.directory / (Path(segment).stem + '.zseg')).exists():
+                os.unlink(self.directory / segment)
+            return 0
+        entries.sort(key=lambda e: e['offset'])
+        future = pool.submit(compact_segment, str(self.directory), segment, entries, level, rate_limit)
+        updated = future.result()
+        with self._lock:
+            for entry in updated:
+                self.index[entry['id']] = entry
+            self._rewrite_index()
+        os.unlink(self.directory / segment)
+        return len(updated)
+
+    def _rewrite_index(self):
+        tmp = self.directory / 'index.jsonl.tmp'
+        with open(tmp, 'w') as f:
+            for entry in self.index.values():
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._index_file.close()
+        os.replace(tmp, self.directory / 'index.jsonl')
+        _fsync_dir(self.directory)
+        self._index_file = open(self.directory / 'index.jsonl', 'a')
+
+    def close(self):
+        with self._lock:
+            if self._segment is not None:
+                self._segment.close()
+                self._index_file.close()
+
+
+def train_dictionary(samples, codec):
+    """Build a compression dictionary from the header blocks of messages"""
+    if codec == 'zstd':
+        try:
+            return zstandard.train_dictionary(DICT_SIZE, samples).as_bytes()
+        except zstandard.ZstdError:
+            pass  # too few samples; fall through to the header-line dictionary
+    # Preset dictionary of the most common header lines. zlib matches
+    # best against the end of the dictionary, so the commonest go last.
+    lines = Counter()
+    for sample in samples:
+        for line in sample.splitlines(keepends=True):
+            lines[line] += 1
+    zdict = b''
+    for line, _ in lines.most_common():
+        if len(zdict) + len(line) > DICT_SIZE:
+            break
+        zdict = line + zdict
+    return zdict or None
+
+
+def compress_frame(codec, data, zdict, level):
+    if codec == 'zstd':
+        params = {'dict_data': zstandard.ZstdCompressionDict(zdict)} if zdict else {}
+        return zstandard.ZstdCompressor(level=level, **params).compress(data)
+    if zdict:
+        c = zlib.compressobj(level, zlib.DEFLATED, 15, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        c = zlib.compressobj(level)
+    return c.compress(data) + c.flush()
+
+
+def decompress_frame(codec, data, zdict):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("message was compressed with zstd; install zstandard to read it")
+        params = {'dict_data': zstandard.ZstdCompressionDict(zdict)} if zdict else {}
+        return zstandard.ZstdDecompressor(**params).decompress(data)
+    d = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+    return d.decompress(data) + d.flush()
+
+
+def compact_segment(directory, segment, entries, level=9, rate_limit=None):
+    """Worker-process side of MessageStore.compact(); returns the new index entries"""
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+    directory = Path(directory)
+    codec = 'zstd' if zstandard is not None else 'zlib'
+    source = directory / segment
+    target = directory / (Path(segment).stem + '.zseg')
+    if target.exists():
+        raise FileExistsError(f"{target.name} already exists; not overwriting it")
+
+    with open(source, 'rb') as f:
+        samples = []
+        for entry in entries:
+            f.seek(entry['offset'])
+            head = f.read(min(entry['length'], HEADER_SAMPLE))
+            end = head.find(b'\r\n\r\n')
+            samples.append(head[:end + 2] if end != -1 else head)
+    zdict = train_dictionary(samples, codec) if samples else None
+    dict_name = None
+    if zdict:
+        dict_name = hashlib.sha256(zdict).hexdigest()[:16] + f'.{codec}dict'
+        (directory / 'dicts').mkdir(exist_ok=True)
+        (directory / 'dicts' / dict_name).write_bytes(zdict)
+
+    tmp = target.with_suffix('.zseg.tmp')
+    updated = []
+    started = time.monotonic()
+    processed = 0
+    with open(source, 'rb') as src, open(tmp, 'wb') as out:
+        for entry in entries:
+            src.seek(entry['offset'])
+            data = src.read(entry['length'])
+            frame = compress_frame(codec, data, zdict, level)
+            updated.append({**entry, 'segment': target.name, 'offset': out.tell(),
+                            'length': len(frame), 'raw_length': len(data),
+                            'codec': codec, 'dict': dict_name})
+            out.write(frame)
+            processed += len(data)
+            if rate_limit:
+                # Stay under rate_limit bytes/second so ingest keeps the disk
+                ahead = processed / rate_limit - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp, target)
+    _fsync_dir(directory)
+    return updated
+
+
+class Compactor:
+    """Background thread that compacts sealed segments older than min_age"""
+
+    def __init__(self, store, min_age=3600, interval=300, level=9, rate_limit=8 * 1024 * 1024):
+        self.store = store
+        self.min_age = min_age
+        self.interval = interval
+        self.level = level
+        self.rate_limit = rate_limit
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+            while not self._stop.wait(self.interval):
+                for segment in self.store.sealed_segments(self.min_age):
+                    try:
+                        count = self.store.compact(segment, pool, self.level, self.rate_limit)
+                        print(f"🗜️  Compacted {segment}: {count} messages")
+                    except Exception as e:
+                        print(f"⚠️  Compaction of {segment} failed: {e}")
+                    if self._stop.is_set():
+                        return
+
+    def stop(self):
+        self._stop.set()
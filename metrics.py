@@ -0,0 +1,107 @@
+"""Process-wide counters and gauges with a Prometheus text endpoint"""
+
+import asyncio
+import threading
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    inner = ','.join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+    return f'{name}{{{inner}}}'
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._types = {}
+        self._help = {}
+        self._callbacks = {}
+        self._labeled = {}
+
+    def _declare(self, name, kind, help_text):
+        self._types.setdefault(name, kind)
+        if help_text:
+            self._help[name] = help_text
+
+    def inc(self, name, value=1, help=None, **labels):
+        """Add to a counter"""
+        key = _key(name, labels)
+        with self._lock:
+            self._declare(name, 'counter', help)
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, help=None, **labels):
+        """Set a gauge"""
+        key = _key(name, labels)
+        with self._lock:
+            self._declare(name, 'gauge', help)
+            self._values[key] = value
+
+    def gauge_callback(self, name, fn, help=None):
+        """Register a gauge whose value is read when metrics are rendered"""
+        with self._lock:
+            self._declare(name, 'gauge', help)
+            self._callbacks[name] = fn
+
+    def labeled_callback(self, name, fn, help=None):
+        """Register a gauge family read at render time; fn returns [(labels, value), ...]"""
+        with self._lock:
+            self._declare(name, 'gauge', help)
+            self._labeled[name] = fn
+
+    def snapshot(self):
+        with self._lock:
+            values = dict(self._values)
+            callbacks = list(self._callbacks.items())
+            labeled = list(self._labeled.items())
+        for name, fn in callbacks:
+            values[name] = fn()
+        for name, fn in labeled:
+            for labels, value in fn():
+                values[_key(name, labels)] = value
+        return values
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        seen = set()
+        for key, value in sorted(self.snapshot().items()):
+            name = key.split('{', 1)[0]
+            if name not in seen:
+                seen.add(name)
+                if name in self._help:
+                    lines.append(f'# HELP {name} {self._help[name]}')
+                lines.append(f'# TYPE {name} {self._types.get(name, "untyped")}')
+            lines.append(f'{key} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+async def start_metrics_server(host, port, registry=metrics):
+    """Serve GET /metrics over plain HTTP on the running event loop"""
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5.0)
+            path = request.split(b' ', 2)[1] if request.count(b' ') >= 2 else b''
+            if path.split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,69 @@
+"""Valid-recipient index used to reject unknown addresses at RCPT time
+
+The recipients file has one address per line. A line of the form
+"@example.com" accepts every address in that domain; blank lines and
+lines starting with "#" are ignored. Lookups are a couple of set probes.
+"""
+
+import os
+import threading
+import time
+
+
+class RecipientIndex:
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked = 0.0
+        self.addresses = frozenset()
+        self.domains = frozenset()
+        self.reload()
+
+    def reload(self):
+        """Load the recipients file now; keep the previous set if it fails"""
+        with self._lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                with open(self.path) as f:
+                    lines = [line.strip().lower() for line in f]
+            except OSError as e:
+                print(f"⚠️  Recipient list not loaded: {e}")
+                return False
+            addresses = set()
+            domains = set()
+            for line in lines:
+                if not line or line.startswith('#'):
+                    continue
+                if line.startswith('@'):
+                    domains.add(line[1:])
+                else:
+                    addresses.add(line)
+            self.addresses = frozenset(addresses)
+            self.domains = frozenset(domains)
+            self._mtime = mtime
+            print(f"📇 Loaded {len(addresses)} recipients and {len(domains)} domains from {self.path}")
+            return True
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.reload()
+
+    def __contains__(self, address):
+        self.maybe_reload()
+        address = address.lower()
+        if address in self.addresses:
+            return True
+        return address.rpartition('@')[2] in self.domains
+
+    def __len__(self):
+        return len(self.addresses) + len(self.domains)
@@ -0,0 +1,326 @@
+#!/usr/bin/env -S uv run
+# /// script
+# requires-python = ">=3.8"
+# dependencies = [
+#     "aiosmtpd>=1.4.0",
+#     "cryptography>=41.0.0",
+#     "zstandard>=0.22.0",
+# ]
+# ///
+"""Rerun past traffic through EmailHandler and compare the results
+
+    replay.py run --store-dir DIR --output new.jsonl
+    replay.py run --capture webserver-capture.jsonl --output new.jsonl
+    replay.py run --store-dir DIR --code ../old-checkout --output old.jsonl
+    replay.py diff old.jsonl new.jsonl
+
+Messages come from a --store-dir written by mailserver.py or from a
+webserver.py --capture-file. Each one is handed to EmailHandler.handle_DATA
+in a worker process; routed actions are recorded instead of performed, so
+nothing is stored, forwarded or posted. The output is one JSON line per
+message (status, printed output, routes) and doubles as the checkpoint:
+with --resume, messages already in the output are skipped.
+
+With --code, each worker imports mailserver and every module it uses from
+that checkout alone; only the store reader comes from this one, so old
+revisions can read segments compacted by newer code.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import inspect
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from email.message import EmailMessage
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from message_store import MessageStore
+
+# Per-worker state, set up by _init_worker()
+_worker = None
+
+
+def capture_to_message(email):
+    """Rebuild (mail_from, rcpt_tos, raw bytes) from a webserver.py POST body"""
+    rcpts = email.get('to') or []
+    if isinstance(rcpts, str):
+        rcpts = [r.strip() for r in rcpts.split(',') if r.strip()]
+    sender = email.get('from') or ''
+    if email.get('raw'):
+        return sender, rcpts, email['raw'].encode('utf-8', 'surrogateescape')
+    msg = EmailMessage()
+    msg['From'] = sender
+    msg['To'] = ', '.join(rcpts)
+    msg['Subject'] = email.get('subject') or ''
+    for name, value in (email.get('headers') or {}).items():
+        if name.lower() not in ('from', 'to', 'subject', 'content-type',
+                                'content-transfer-encoding', 'mime-version'):
+            msg[name] = str(value)
+    text = email.get('body') or email.get('text')
+    html = email.get('html')
+    if text:
+        msg.set_content(text)
+        if html:
+            msg.add_alternative(html, subtype='html')
+    elif html:
+        msg.set_content(html, subtype='html')
+    else:
+        msg.set_content('')
+    return sender, rcpts, msg.as_bytes()
+
+
+def load_capture(path):
+    """Yield (id, email dict) from a webserver.py capture file"""
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            yield record.get('id') or f'line-{lineno}', record['email']
+
+
+def _use_checkout(code):
+    """Make later imports come from the checkout at code only
+
+    Modules this checkout already loaded (message_store, metrics and what
+    they import) are evicted from sys.modules, so the old mailserver links
+    against its own revision of every module rather than a mix. The store
+    reader made before this keeps the current code, which it holds on to.
+    """
+    here = os.path.join(HERE, '')
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, '__file__', None) or ''
+        if path.startswith(here) and name not in ('__main__', '__mp_main__', __name__):
+            del sys.modules[name]
+    sys.path[:] = [p for p in sys.path if os.path.abspath(p or '.') != HERE]
+    sys.path.insert(0, os.path.abspath(code))
+
+
+def _init_worker(code, store_dir, routes, html_preview_chars):
+    global _worker
+    # The store reader always comes from this checkout so old handler
+    # versions can read segments they do not know how to decompress
+    store = MessageStore(store_dir, readonly=True) if store_dir else None
+    if code:
+        _use_checkout(code)
+    import mailserver
+    # Older revisions take fewer options (the baseline none at all), so
+    # only pass what this one's EmailHandler accepts
+    params = inspect.signature(mailserver.EmailHandler).parameters
+    takes_any = any(p.kind is inspect.Parameter.VAR_KEYWORD for p in params.values())
+    options = {'html_preview_chars': html_preview_chars}
+    if routes:
+        if hasattr(mailserver, 'Router'):
+            with contextlib.redirect_stdout(io.StringIO()):
+                options['router'] = mailserver.Router(routes)
+        else:
+            print(f"⚠️  {mailserver.__file__} has no routing; ignoring --routes", file=sys.stderr)
+    handler = mailserver.EmailHandler(**{name: value for name, value in options.items()
+                                         if takes_any or name in params})
+    handler.dispatch = _recording_dispatch(handler)
+    _worker = SimpleNamespace(store=store, handler=handler, loop=asyncio.new_event_loop(),
+                              routes=None)
+
+
+def _recording_dispatch(handler):
+    """Replacement for EmailHandler.dispatch that records routes instead of acting"""
+    async def dispatch(envelope, routes, subject, body, attachments):
+        for (action, target), rcpts in routes.items():
+            _worker.routes.append([action, target, rcpts])
+            if action == 'print':
+                handler.print_email(envelope.mail_from, rcpts, subject, body, attachments)
+    return dispatch
+
+
+def _replay_one(message_id, sender, rcpts, content):
+    envelope = SimpleNamespace(mail_from=sender, rcpt_tos=list(rcpts), content=content)
+    session = SimpleNamespace(peer=('replay', 0))
+    _worker.routes = []
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        status = _worker.loop.run_until_complete(
+            _worker.handler.handle_DATA(None, session, envelope))
+    return {'id': message_id, 'status': status, 'output': out.getvalue(),
+            'routes': _worker.routes}
+
+
+def _replay_batch(batch):
+    """Worker entry point: returns (results, bytes processed)"""
+    results = []
+    size = 0
+    for message_id, item in batch:
+        try:
+            if _worker.store is not None:
+                content = _worker.store.read(message_id)
+                sender, rcpts = item.get('mail_from', ''), item.get('rcpt_tos', [])
+            else:
+                sender, rcpts, content = capture_to_message(item)
+        except Exception as e:
+            results.append({'id': message_id, 'status': f'error: {type(e).__name__}: {e}',
+                            'output': '', 'routes': []})
+            continue
+        size += len(content)
+        results.append(_replay_one(message_id, sender, rcpts, content))
+    return results, size
+
+
+def _batches(items, done, size):
+    batch = []
+    for message_id, item in items:
+        if message_id in done:
+            continue
+        batch.append((message_id, item))
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _read_done(path):
+    done = set()
+    with open(path) as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)['id'])
+            except (json.JSONDecodeError, KeyError):
+                continue  # torn last line from an interrupted run
+    return done
+
+
+def run(args):
+    if args.store_dir:
+        items = list(MessageStore(args.store_dir, readonly=True))
+    else:
+        items = list(load_capture(args.capture))
+    done = _read_done(args.output) if args.resume and os.path.exists(args.output) else set()
+    total = len(items) - len(done & {message_id for message_id, _ in items})
+    if done:
+        print(f"⏩ Resuming: {len(done)} already in {args.output}, {total} to go", file=sys.stderr)
+
+    batches = _batches(items, done, args.batch_size)
+    processed = 0
+    nbytes = 0
+    failed = 0
+    started = time.monotonic()
+    last_report = started
+    context = multiprocessing.get_context('spawn')
+    with open(args.output, 'a' if args.resume else 'w') as out, \
+            ProcessPoolExecutor(args.workers, mp_context=context, initializer=_init_worker,
+                                initargs=(args.code, args.store_dir, args.routes,
+                                          args.html_preview_chars)) as pool:
+        pending = set()
+        while True:
+            while len(pending) < args.workers * 2:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                pending.add(pool.submit(_replay_batch, batch))
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                results, size = future.result()
+                for result in results:
+                    out.write(json.dumps(result) + '\n')
+                    if not result['status'].startswith('250'):
+                        failed += 1
+                out.flush()
+                processed += len(results)
+                nbytes += size
+            now = time.monotonic()
+            if now - last_report >= args.report_interval:
+                last_report = now
+                elapsed = now - started
+                print(f"📈 {processed}/{total} messages  {processed / elapsed:.0f} msg/s  "
+                      f"{nbytes / elapsed / 1e6:.1f} MB/s", file=sys.stderr)
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    print(f"✅ Replayed {processed} messages in {elapsed:.1f}s "
+          f"({processed / elapsed:.0f} msg/s, {nbytes / elapsed / 1e6:.1f} MB/s), "
+          f"{failed} not accepted", file=sys.stderr)
+
+
+def _load_results(path):
+    results = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            results[record['id']] = record
+    return results
+
+
+def diff(args):
+    import difflib
+    old = _load_results(args.old)
+    new = _load_results(args.new)
+    changed = 0
+    for message_id in sorted(old.keys() & new.keys()):
+        a, b = old[message_id], new[message_id]
+        if (a['status'], a['output'], a['routes']) == (b['status'], b['output'], b['routes']):
+            continue
+        changed += 1
+        print(f"--- {message_id}")
+        if a['status'] != b['status']:
+            print(f"status: {a['status']!r} -> {b['status']!r}")
+        if a['routes'] != b['routes']:
+            print(f"routes: {a['routes']} -> {b['routes']}")
+        if a['output'] != b['output']:
+            sys.stdout.writelines(difflib.unified_diff(
+                a['output'].splitlines(keepends=True), b['output'].splitlines(keepends=True),
+                args.old, args.new, n=args.context))
+    only_old = len(old.keys() - new.keys())
+    only_new = len(new.keys() - old.keys())
+    print(f"\n{changed} changed, {len(old.keys() & new.keys()) - changed} identical, "
+          f"{only_old} only in {args.old}, {only_new} only in {args.new}")
+    return 1 if changed or only_old or only_new else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay stored or captured mail through EmailHandler')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Replay messages and write per-message results')
+    source = run_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--store-dir', help='Message store written by mailserver.py --store-dir')
+    source.add_argument('--capture', help='Capture file written by webserver.py --capture-file')
+    run_parser.add_argument('--output', required=True, help='JSON-lines results file')
+    run_parser.add_argument('--resume', action='store_true',
+                            help='Skip messages already in --output and append to it')
+    run_parser.add_argument('--code',
+                            help='Directory with the mailserver.py to run (e.g. a git worktree '
+                                 'of another revision); default: this checkout')
+    run_parser.add_argument('--routes', help='Routing config to replay with')
+    run_parser.add_argument('--html-preview-chars', type=int, default=4000)
+    run_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    run_parser.add_argument('--batch-size', type=int, default=200)
+    run_parser.add_argument('--report-interval', type=float, default=5.0,
+                            help='Seconds between throughput reports (default: 5)')
+
+    diff_parser = commands.add_parser('diff', help='Compare the results of two runs')
+    diff_parser.add_argument('old')
+    diff_parser.add_argument('new')
+    diff_parser.add_argument('--context', type=int, default=3)
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(diff(args))
+
+
+if __name__ == "__main__":
+    main()
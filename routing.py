@@ -0,0 +1,240 @@
+"""Declarative routing rules for incoming mail
+
+Rules are loaded from a JSON file and compiled into dict indexes (exact
+address, recipient domain, sender domain) plus one combined regex for
+wildcard recipients, so looking up a recipient does not scan the rule list.
+
+Example routes.json:
+
+    {
+      "default": "print",
+      "rules": [
+        {"rcpt": "alerts@example.com", "action": "webhook",
+         "target": "https://hooks.example.com/mail"},
+        {"rcpt": "*@lists.example.com", "action": "store"},
+        {"rcpt": "noreply-*@example.com", "action": "drop"},
+        {"sender_domain": "partner.org", "action": "forward",
+         "target": "mx.internal:25"},
+        {"header": {"name": "X-Spam-Flag", "equals": "YES"}, "action": "drop"}
+      ]
+    }
+
+The first matching rule (in file order) wins for each recipient.
+"""
+
+import fnmatch
+import json
+import os
+import re
+import threading
+import time
+
+ACTIONS = ('store', 'forward', 'webhook', 'drop', 'print')
+
+
+class RoutingError(ValueError):
+    """Raised when a routing config is invalid"""
+
+
+class Rule:
+    __slots__ = ('index', 'rcpt', 'sender_domain', 'header', 'action', 'target')
+
+    def __init__(self, index, spec):
+        if not isinstance(spec, dict):
+            raise RoutingError(f"rule {index}: expected an object, got {type(spec).__name__}")
+        for field in ('rcpt', 'sender_domain', 'action', 'target'):
+            if spec.get(field) is not None and not isinstance(spec[field], str):
+                raise RoutingError(f"rule {index}: {field} must be a string")
+        self.index = index
+        self.rcpt = spec.get('rcpt')
+        self.sender_domain = spec.get('sender_domain')
+        self.header = spec.get('header')
+        self.action = spec.get('action', 'print')
+        self.target = spec.get('target')
+
+        if self.action not in ACTIONS:
+            raise RoutingError(f"rule {index}: unknown action {self.action!r}")
+        if self.action in ('forward', 'webhook') and not self.target:
+            raise RoutingError(f"rule {index}: action {self.action!r} needs a target")
+        if self.header is not None:
+            if not isinstance(self.header, dict) or 'name' not in self.header:
+                raise RoutingError(f"rule {index}: header predicate needs a name")
+            for field in ('name', 'equals', 'contains', 'matches'):
+                if field in self.header and not isinstance(self.header[field], str):
+                    raise RoutingError(f"rule {index}: header {field} must be a string")
+            self.header = dict(self.header)
+            self.header['name'] = self.header['name'].lower()
+            if 'matches' in self.header:
+                try:
+                    self.header['matches'] = re.compile(self.header['matches'])
+                except re.error as e:
+                    raise RoutingError(f"rule {index}: bad header regex: {e}") from None
+        if self.sender_domain:
+            self.sender_domain = self.sender_domain.lower().lstrip('@')
+
+    def accepts(self, sender_domain, headers):
+        """Check the non-recipient predicates of this rule"""
+        if self.sender_domain and self.sender_domain != sender_domain:
+            return False
+        if self.header is not None:
+            value = headers.get(self.header['name']) if headers is not None else None
+            if value is None:
+                return False
+            value = str(value)
+            if 'equals' in self.header and value != self.header['equals']:
+                return False
+            if 'contains' in self.header and self.header['contains'] not in value:
+                return False
+            if 'matches' in self.header and not self.header['matches'].search(value):
+                return False
+        return True
+
+
+class Route:
+    """Resolved action for a single recipient"""
+    __slots__ = ('action', 'target', 'rule')
+
+    def __init__(self, action, target=None, rule=None):
+        self.action = action
+        self.target = target
+        self.rule = rule
+
+    def __repr__(self):
+        return f"Route({self.action!r}, {self.target!r}, rule={self.rule})"
+
+
+def _domain(address):
+    return address.rpartition('@')[2].lower() if address else ''
+
+
+class RoutingTable:
+    """Compiled set of routing rules"""
+
+    def __init__(self, rules=(), default='print'):
+        if default not in ACTIONS:
+            raise RoutingError(f"unknown default action {default!r}")
+        self.default = Route(default)
+        self.rules = [r if isinstance(r, Rule) else Rule(i, r) for i, r in enumerate(rules)]
+        self._compile()
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            try:
+                config = json.load(f)
+            except json.JSONDecodeError as e:
+                raise RoutingError(f"{path}: {e}") from None
+        if not isinstance(config, dict):
+            raise RoutingError(f"{path}: expected an object with \"rules\" and \"default\"")
+        rules = config.get('rules', [])
+        if not isinstance(rules, list):
+            raise RoutingError(f"{path}: \"rules\" must be a list")
+        try:
+            return cls(rules, config.get('default', 'print'))
+        except RoutingError as e:
+            raise RoutingError(f"{path}: {e}") from None
+        except (re.error, TypeError, ValueError) as e:
+            # Anything the checks above missed still must not reach route()
+            raise RoutingError(f"{path}: {e}") from None
+
+    def _compile(self):
+        self.exact = {}          # full address -> [rule index, ...]
+        self.domains = {}        # recipient domain -> [rule index, ...]
+        self.unconditional = []  # rules without a recipient pattern
+        self.wildcards = []      # (rule index, compiled pattern), in rule order
+        wildcards = []
+
+        for rule in self.rules:
+            pattern = rule.rcpt
+            if not pattern:
+                self.unconditional.append(rule.index)
+                continue
+            pattern = pattern.lower()
+            local, _, domain = pattern.rpartition('@')
+            if not any(c in pattern for c in '*?['):
+                self.exact.setdefault(pattern, []).append(rule.index)
+            elif local in ('', '*') and domain and not any(c in domain for c in '*?['):
+                self.domains.setdefault(domain, []).append(rule.index)
+            else:
+                regex = fnmatch.translate(pattern)
+                wildcards.append(f"(?P<r{rule.index}>{regex})")
+                self.wildcards.append((rule.index, re.compile(regex)))
+
+        # Alternation is tried left to right, so the group that matches is
+        # the lowest-numbered wildcard rule.
+        self.wildcard = re.compile('|'.join(wildcards)) if wildcards else None
+        self.needs_headers = any(rule.header is not None for rule in self.rules)
+
+    def candidates(self, rcpt):
+        """Indexes of the rules whose recipient pattern matches rcpt"""
+        rcpt = rcpt.lower()
+        found = list(self.unconditional)
+        found.extend(self.exact.get(rcpt, ()))
+        found.extend(self.domains.get(_domain(rcpt), ()))
+        if self.wildcard is not None:
+            m = self.wildcard.match(rcpt)
+            if m:
+                # The combined regex finds the first match; a later wildcard
+                # rule may match too and apply when the first one's sender or
+                # header predicate does not
+                first = int(m.lastgroup[1:])
+                found.append(first)
+                found.extend(index for index, regex in self.wildcards
+                             if index > first and regex.match(rcpt))
+        found.sort()
+        return found
+
+    def route(self, rcpt, sender=None, headers=None):
+        """Return the Route for one recipient"""
+        sender_domain = _domain(sender)
+        for index in self.candidates(rcpt):
+            rule = self.rules[index]
+            if rule.accepts(sender_domain, headers):
+                return Route(rule.action, rule.target, rule.index)
+        return self.default
+
+    def __len__(self):
+        return len(self.rules)
+
+
+class Router:
+    """RoutingTable that reloads itself when its config file changes"""
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked = 0.0
+        self.table = RoutingTable()
+        self.reload()
+
+    def reload(self):
+        """Load the config now; keep the previous table if it is invalid"""
+        with self._lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                table = RoutingTable.from_file(self.path)
+            except (OSError, RoutingError) as e:
+                print(f"⚠️  Routing config not loaded: {e}")
+                return False
+            self.table = table
+            self._mtime = mtime
+            print(f"🔀 Loaded {len(table)} routing rules from {self.path}")
+            return True
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.reload()
+
+    def route(self, rcpt, sender=None, headers=None):
+        self.maybe_reload()
+        return self.table.route(rcpt, sender, headers)
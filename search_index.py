@@ -0,0 +1,122 @@
+"""Full-text search over received messages using SQLite FTS5
+
+Documents are queued by add() and written by a background thread in
+batched transactions, so callers on the event loop never wait on SQLite.
+The database runs in WAL mode so another process (webserver.py) can query
+it while the mail server is writing.
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+
+SCHEMA = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5("
+    "subject, body, sender UNINDEXED, recipients UNINDEXED, "
+    "message_id UNINDEXED, received UNINDEXED, tokenize='unicode61')"
+)
+
+_STOP = object()
+
+
+def _connect(path):
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    try:
+        db.execute(SCHEMA)
+    except sqlite3.OperationalError as e:
+        db.close()
+        raise RuntimeError(f"SQLite FTS5 is not available: {e}") from None
+    db.commit()
+    return db
+
+
+def quote_query(q):
+    """Turn free text into an FTS5 query that matches all of its terms"""
+    terms = [t.replace('"', '""') for t in q.split()]
+    return ' '.join(f'"{t}"' for t in terms)
+
+
+class SearchIndex:
+    def __init__(self, path, batch_size=500, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.indexed = 0
+        self._queue = queue.Queue()
+        self._writer_db = _connect(path)
+        self._reader = threading.local()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def add(self, subject, body, sender='', recipients='', message_id='', received=None):
+        """Queue a message for indexing"""
+        if not isinstance(recipients, str):
+            recipients = ', '.join(recipients)
+        self._queue.put((str(subject or ''), body or '', sender or '', recipients,
+                         str(message_id or ''), received or time.time()))
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self._queue.put(_STOP)
+                    self._queue.task_done()
+                    break
+                batch.append(item)
+            try:
+                with self._writer_db:
+                    self._writer_db.executemany(
+                        'INSERT INTO messages (subject, body, sender, recipients, message_id, received) '
+                        'VALUES (?, ?, ?, ?, ?, ?)', batch)
+                self.indexed += len(batch)
+            except sqlite3.Error as e:
+                print(f"⚠️  Search index write failed: {e}")
+            for _ in batch:
+                self._queue.task_done()
+
+    def flush(self):
+        """Block until everything queued so far has been committed"""
+        self._queue.join()
+
+    def _db(self):
+        db = getattr(self._reader, 'db', None)
+        if db is None:
+            db = self._reader.db = _connect(self.path)
+        return db
+
+    def search(self, q, limit=20, raw=False):
+        """Return the best matches for q, most relevant first"""
+        match = q if raw else quote_query(q)
+        if not match:
+            return []
+        rows = self._db().execute(
+            "SELECT rowid, subject, sender, recipients, message_id, received, "
+            "snippet(messages, 1, '[', ']', '…', 12) "
+            "FROM messages WHERE messages MATCH ? ORDER BY rank LIMIT ?",
+            (match, limit)).fetchall()
+        return [
+            {'id': rowid, 'subject': subject, 'from': sender, 'to': recipients,
+             'message_id': message_id, 'received': received, 'snippet': snippet}
+            for rowid, subject, sender, recipients, message_id, received, snippet in rows
+        ]
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._writer_db.close()
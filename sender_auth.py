@@ -0,0 +1,571 @@
+"""SPF and DKIM verification for received mail
+
+Verifier.verify() checks a message after DATA and returns the results
+along with an Authentication-Results header (RFC 8601) to prepend to it.
+AuthResults.apply() also removes any Authentication-Results the sender
+supplied under our authserv-id, so a client cannot forge our verdict:
+
+    Authentication-Results: mx.example.com; spf=pass smtp.mailfrom=a@example.org;
+        dkim=pass header.d=example.org header.s=sel1 header.b=AbCdEf12
+
+All DNS goes through dns_client.Resolver, so SPF records and DKIM keys are
+cached for their TTL and concurrent messages share lookups. The SPF check
+and the key lookups for every signature run concurrently. The CPU work
+(canonicalising and hashing the body, the RSA/Ed25519 verify) runs in a
+thread pool, with parsed public keys cached.
+
+Supports rsa-sha256 and ed25519-sha256 signatures with simple/relaxed
+canonicalisation, and SPF with the usual mechanisms and macros. To try it
+locally, make a key and sign a message with this module, publish the key
+with dns_stub.py, then run mailserver.py with --verify-senders and
+--dns-server pointing at the stub:
+
+    sender_auth.py keygen example.org sel1 > dkim.key    # prints the TXT record
+    sender_auth.py sign dkim.key example.org sel1 < msg.eml > signed.eml
+"""
+
+import asyncio
+import base64
+import functools
+import hashlib
+import ipaddress
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, padding, rsa
+
+from dns_client import DNSError
+from metrics import metrics
+
+# RFC 7208 4.6.4: at most 10 mechanisms or modifiers that need DNS
+SPF_LOOKUP_LIMIT = 10
+MAX_SIGNATURES = 5
+
+# Single spaces are left alone; replacing them with themselves is most of the cost
+_WSP_RUN = re.compile(rb'[ \t]{2,}|\t')
+_BARE_LF = re.compile(rb'(?<!\r)\n')
+_B_TAG = re.compile(rb'(^|;)(\s*b\s*=)[^;]*')
+_MECHANISM = re.compile(r'^([+?~-]?)(all|include|a|mx|ptr|ip4|ip6|exists)(?::([^/]*))?'
+                        r'(?:/(\d+))?(?://(\d+))?$', re.I)
+_MACRO = re.compile(r'%\{([slodiphcrtv])(\d*)(r?)([.\-+,/_=]*)\}|%%|%_|%-', re.I)
+_QUALIFIERS = {'+': 'pass', '-': 'fail', '~': 'softfail', '?': 'neutral', '': 'pass'}
+
+
+class PermError(Exception):
+    pass
+
+
+class TempError(Exception):
+    pass
+
+
+def parse_tags(value):
+    """'a=1; b = x y' -> {'a': '1', 'b': 'x y'}"""
+    tags = {}
+    for part in value.split(';'):
+        name, sep, tag_value = part.partition('=')
+        name = name.strip()
+        if not sep or not name:
+            if name:
+                raise PermError(f"malformed tag {part.strip()!r}")
+            continue
+        tags[name] = tag_value.strip()
+    return tags
+
+
+# ---- DKIM ----------------------------------------------------------------
+
+def split_message(content):
+    """(header fields, body); each field is (lowercase name, raw bytes with CRLF)"""
+    if content.count(b'\n') != content.count(b'\r\n'):
+        content = _BARE_LF.sub(b'\r\n', content)
+    end = content.find(b'\r\n\r\n')
+    if end == -1:
+        head, body = content, b''
+    else:
+        head, body = content[:end + 2], content[end + 4:]
+    fields = []
+    for line in head.split(b'\r\n'):
+        if not line:
+            continue
+        if line[:1] in (b' ', b'\t') and fields:
+            name, raw = fields[-1]
+            fields[-1] = (name, raw + line + b'\r\n')
+        elif b':' in line:
+            fields.append((line.split(b':', 1)[0].strip().lower(), line + b'\r\n'))
+    return fields, body
+
+
+def canonical_header(raw, relaxed):
+    if not relaxed:
+        return raw
+    name, _, value = raw.partition(b':')
+    value = _WSP_RUN.sub(b' ', value.replace(b'\r\n', b'')).strip()
+    return name.strip().lower() + b':' + value + b'\r\n'
+
+
+def canonical_body(body, relaxed):
+    if relaxed:
+        # Regexes scan byte by byte; most bodies need no collapsing at all
+        if b'\t' in body or b'  ' in body:
+            body = _WSP_RUN.sub(b' ', body)
+        # Runs are single spaces now, so trailing whitespace is just " \r\n".
+        # An unterminated last line keeps its space, as other verifiers do
+        body = body.replace(b' \r\n', b'\r\n')
+        if body and not body.endswith(b'\r\n'):
+            body += b'\r\n'
+    elif not body.endswith(b'\r\n'):
+        body += b'\r\n'
+    while body.endswith(b'\r\n\r\n'):
+        body = body[:-2]
+    if relaxed and body == b'\r\n':
+        return b''
+    return body
+
+
+def signature_fields(fields):
+    """Parsed DKIM-Signature fields, in message order, at most MAX_SIGNATURES"""
+    signatures = []
+    for name, raw in fields:
+        if name == b'dkim-signature':
+            value = raw.split(b':', 1)[1].decode('ascii', 'replace')
+            try:
+                tags = parse_tags(value)
+            except PermError:
+                tags = {}
+            signatures.append((raw, tags))
+            if len(signatures) == MAX_SIGNATURES:
+                break
+    return signatures
+
+
+@functools.lru_cache(maxsize=1024)
+def load_public_key(record):
+    """Public key from a DKIM key TXT record (cached; keys are reused a lot)"""
+    tags = parse_tags(record)
+    if tags.get('v', 'DKIM1') != 'DKIM1':
+        raise PermError("not a DKIM1 key record")
+    data = re.sub(r'\s+', '', tags.get('p', ''))
+    if not data:
+        raise PermError("key revoked")
+    raw = base64.b64decode(data)
+    kind = tags.get('k', 'rsa')
+    if kind == 'ed25519':
+        return ed25519.Ed25519PublicKey.from_public_bytes(raw)
+    if kind != 'rsa':
+        raise PermError(f"unsupported key type {kind}")
+    key = serialization.load_der_public_key(raw)
+    if not isinstance(key, rsa.RSAPublicKey):
+        raise PermError("key is not RSA")
+    return key
+
+
+def verify_signature(fields, body, raw, tags, record, body_hashes=None):
+    """Check one signature; returns (result, reason)
+
+    body_hashes memoises body hashes by canonicalisation, for messages
+    carrying several signatures.
+    """
+    try:
+        for required in ('v', 'a', 'b', 'bh', 'd', 'h', 's'):
+            if required not in tags:
+                raise PermError(f"missing {required}= tag")
+        if tags['v'] != '1':
+            raise PermError("unsupported version")
+        algorithm = tags['a'].lower()
+        if algorithm not in ('rsa-sha256', 'ed25519-sha256'):
+            return 'neutral', f"unsupported algorithm {algorithm}"
+        signed = [h.strip().lower() for h in tags['h'].split(':')]
+        if 'from' not in signed:
+            raise PermError("From is not signed")
+        if 'x' in tags and int(tags['x']) < time.time():
+            return 'fail', "signature expired"
+        header_canon, _, body_canon = tags.get('c', 'simple/simple').lower().partition('/')
+        header_relaxed = header_canon == 'relaxed'
+        body_relaxed = body_canon == 'relaxed'
+
+        length = int(tags['l']) if 'l' in tags else None
+        key = (body_relaxed, length)
+        if body_hashes is None or key not in body_hashes:
+            canonical = canonical_body(body, body_relaxed)
+            digest = hashlib.sha256(canonical if length is None else canonical[:length]).digest()
+            if body_hashes is not None:
+                body_hashes[key] = digest
+        else:
+            digest = body_hashes[key]
+        body_hash = base64.b64decode(re.sub(r'\s+', '', tags['bh']))
+        if digest != body_hash:
+            return 'fail', "body hash mismatch"
+
+        # Each h= name takes the next instance from the bottom of the header
+        remaining = {}
+        for name, field in fields:
+            remaining.setdefault(name, []).append(field)
+        data = []
+        for name in signed:
+            instances = remaining.get(name.encode())
+            if instances:
+                data.append(canonical_header(instances.pop(), header_relaxed))
+        # The signature itself is hashed with an empty b= and no final CRLF
+        name, _, value = raw.partition(b':')
+        data.append(canonical_header(name + b':' + _B_TAG.sub(rb'\1\2', value),
+                                     header_relaxed).rstrip(b'\r\n'))
+        data = b''.join(data)
+
+        key = load_public_key(record)
+        signature = base64.b64decode(re.sub(r'\s+', '', tags['b']))
+        if algorithm == 'ed25519-sha256':
+            if not isinstance(key, ed25519.Ed25519PublicKey):
+                raise PermError("key type does not match a=")
+            key.verify(signature, hashlib.sha256(data).digest())
+        else:
+            if not isinstance(key, rsa.RSAPublicKey):
+                raise PermError("key type does not match a=")
+            key.verify(signature, data, padding.PKCS1v15(), hashes.SHA256())
+        return 'pass', None
+    except InvalidSignature:
+        return 'fail', "signature did not verify"
+    except (PermError, ValueError, TypeError) as e:
+        return 'permerror', str(e)
+
+
+def verify_dkim(content, records):
+    """Check every signature against its key record (or the DNSError fetching it)
+
+    Runs in the verifier's thread pool. Returns [(result, domain, selector,
+    b= prefix, reason)].
+    """
+    fields, body = split_message(content)
+    results = []
+    body_hashes = {}
+    for (raw, tags), record in zip(signature_fields(fields), records):
+        domain, selector = tags.get('d', ''), tags.get('s', '')
+        b_prefix = re.sub(r'\s+', '', tags.get('b', ''))[:8]
+        if isinstance(record, Exception):
+            result = ('temperror' if isinstance(record, TempError) else 'permerror', str(record))
+        else:
+            result = verify_signature(fields, body, raw, tags, record, body_hashes)
+        results.append((result[0], domain, selector, b_prefix, result[1]))
+    return results
+
+
+def sign_message(content, private_key, domain, selector, headers=('from', 'to', 'subject', 'date', 'message-id')):
+    """DKIM-sign content (relaxed/relaxed); returns the message with the header prepended
+
+    For local testing of the verifier; the key is an RSA or Ed25519 private key.
+    """
+    fields, body = split_message(content)
+    present = {name for name, _ in fields}
+    signed = [h for h in headers if h.encode() in present]
+    algorithm = 'ed25519-sha256' if isinstance(private_key, ed25519.Ed25519PrivateKey) else 'rsa-sha256'
+    body_hash = base64.b64encode(hashlib.sha256(canonical_body(body, True)).digest()).decode()
+    value = (f" v=1; a={algorithm}; c=relaxed/relaxed; d={domain}; s={selector};"
+             f" t={int(time.time())}; h={':'.join(signed)}; bh={body_hash}; b=")
+    remaining = {}
+    for name, field in fields:
+        remaining.setdefault(name, []).append(field)
+    data = b''.join(canonical_header(remaining[h.encode()].pop(), True) for h in signed)
+    data += canonical_header(b'DKIM-Signature:' + value.encode(), True).rstrip(b'\r\n')
+    if algorithm == 'ed25519-sha256':
+        signature = private_key.sign(hashlib.sha256(data).digest())
+    else:
+        signature = private_key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+    header = f"DKIM-Signature:{value}{base64.b64encode(signature).decode()}\r\n"
+    return header.encode() + _BARE_LF.sub(b'\r\n', content)
+
+
+# ---- SPF -----------------------------------------------------------------
+
+def _macro_value(letter, ip, sender, domain, helo):
+    local, _, sender_domain = sender.rpartition('@')
+    letter = letter.lower()
+    if letter == 's':
+        return sender
+    if letter == 'l':
+        return local or 'postmaster'
+    if letter == 'o':
+        return sender_domain
+    if letter == 'd':
+        return domain
+    if letter == 'i':
+        if ip.version == 6:
+            return '.'.join(ip.exploded.replace(':', ''))
+        return str(ip)
+    if letter == 'v':
+        return 'ip6' if ip.version == 6 else 'in-addr'
+    if letter == 'h':
+        return helo or domain
+    return 'unknown'
+
+
+def expand(spec, ip, sender, domain, helo):
+    def replace(match):
+        text = match.group(0)
+        if text == '%%':
+            return '%'
+        if text == '%_':
+            return ' '
+        if text == '%-':
+            return '%20'
+        letter, digits, reverse, delimiters = match.groups()
+        parts = re.split('[' + re.escape(delimiters or '.') + ']',
+                         _macro_value(letter, ip, sender, domain, helo))
+        if reverse:
+            parts.reverse()
+        if digits:
+            parts = parts[-int(digits):]
+        return '.'.join(parts)
+    return _MACRO.sub(replace, spec)
+
+
+class _SPFCheck:
+    def __init__(self, resolver, ip, sender, helo):
+        self.resolver = resolver
+        self.ip = ip
+        self.sender = sender
+        self.helo = helo
+        self.lookups = 0
+
+    def _count(self):
+        self.lookups += 1
+        if self.lookups > SPF_LOOKUP_LIMIT:
+            raise PermError("too many DNS lookups")
+
+    async def _query(self, name, qtype):
+        try:
+            return await self.resolver.query(name, qtype)
+        except DNSError as e:
+            raise TempError(str(e))
+
+    async def _addresses(self, name):
+        qtype = 'AAAA' if self.ip.version == 6 else 'A'
+        return [ipaddress.ip_address(a) for a in await self._query(name, qtype)]
+
+    def _in_network(self, address, cidr4, cidr6):
+        prefix = cidr6 if self.ip.version == 6 else cidr4
+        if address.version != self.ip.version:
+            return False
+        if prefix is None:
+            return address == self.ip
+        return self.ip in ipaddress.ip_network(f"{address}/{prefix}", strict=False)
+
+    async def check_host(self, domain):
+        try:
+            records = await self._query(domain, 'TXT')
+        except TempError:
+            return 'temperror'
+        spf = [r for r in records if r.lower() == 'v=spf1' or r.lower().startswith('v=spf1 ')]
+        if not spf:
+            return 'none'
+        if len(spf) > 1:
+            return 'permerror'
+        redirect = None
+        for term in spf[0].split()[1:]:
+            name, sep, value = term.partition('=')
+            if sep and ':' not in name and '/' not in name:
+                if name.lower() == 'redirect':
+                    redirect = value
+                continue    # exp= and unknown modifiers
+            match = _MECHANISM.match(term)
+            if match is None:
+                raise PermError(f"bad SPF term {term!r}")
+            qualifier, mechanism, target, cidr4, cidr6 = match.groups()
+            mechanism = mechanism.lower()
+            target = expand(target, self.ip, self.sender, domain, self.helo) if target else domain
+            cidr4 = int(cidr4) if cidr4 else None
+            cidr6 = int(cidr6) if cidr6 else None
+            if await self._matches(mechanism, target, cidr4, cidr6):
+                return _QUALIFIERS[qualifier]
+        if redirect:
+            self._count()
+            result = await self.check_host(expand(redirect, self.ip, self.sender, domain, self.helo))
+            return 'permerror' if result == 'none' else result
+        return 'neutral'
+
+    async def _matches(self, mechanism, target, cidr4, cidr6):
+        if mechanism == 'all':
+            return True
+        if mechanism in ('ip4', 'ip6'):
+            # ip4:net/len and ip6:net/len both land in the first prefix group
+            network = ipaddress.ip_network(target if cidr4 is None else f"{target}/{cidr4}",
+                                           strict=False)
+            return self.ip.version == network.version and self.ip in network
+        self._count()
+        if mechanism == 'a':
+            return any(self._in_network(a, cidr4, cidr6) for a in await self._addresses(target))
+        if mechanism == 'mx':
+            hosts = await self._query(target, 'MX')
+            for _, host in sorted(hosts)[:10]:
+                if any(self._in_network(a, cidr4, cidr6) for a in await self._addresses(host)):
+                    return True
+            return False
+        if mechanism == 'exists':
+            return bool(await self._query(target, 'A'))
+        if mechanism == 'ptr':
+            name = await self.resolver.forward_confirmed(str(self.ip))
+            return bool(name) and (name == target or name.endswith('.' + target))
+        if mechanism == 'include':
+            result = await self.check_host(target)
+            if result == 'temperror':
+                raise TempError(f"include:{target}")
+            if result in ('permerror', 'none'):
+                raise PermError(f"include:{target} gave {result}")
+            return result == 'pass'
+        return False
+
+
+async def check_spf(resolver, ip, sender, helo):
+    """SPF result for a client ip sending as sender (or helo for bounces)"""
+    if not sender and helo:
+        sender = f"postmaster@{helo}"
+    if not sender or '@' not in sender:
+        return 'none', None
+    domain = sender.rpartition('@')[2]
+    try:
+        ip = ipaddress.ip_address(ip)
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        return await _SPFCheck(resolver, ip, sender, helo).check_host(domain), domain
+    except TempError:
+        return 'temperror', domain
+    except (PermError, ValueError):
+        return 'permerror', domain
+
+
+# ---- Pipeline ------------------------------------------------------------
+
+def strip_results(content, authserv_id):
+    """Drop Authentication-Results fields that claim to be from authserv_id (RFC 8601 section 5)
+
+    Everything else in the message is left byte for byte as it was.
+    """
+    ends = [i for i in (content.find(b'\n\r\n'), content.find(b'\n\n')) if i != -1]
+    end = min(ends) + 1 if ends else len(content)
+    head = content[:end]
+    if b'authentication-results' not in head.lower():
+        return content
+    fields = []
+    for line in head.splitlines(keepends=True):
+        if line[:1] in (b' ', b'\t') and fields:
+            fields[-1].append(line)
+        else:
+            fields.append([line])
+    ours = authserv_id.lower().encode()
+    kept = []
+    for field in fields:
+        name, _, value = b''.join(field).partition(b':')
+        if name.strip().lower() == b'authentication-results':
+            # authserv-id [version] ; results
+            words = value.split(b';', 1)[0].split()
+            if words and words[0].lower() == ours:
+                continue
+        kept.extend(field)
+    return b''.join(kept) + content[end:]
+
+
+class AuthResults:
+    def __init__(self, authserv_id, spf, mail_from, dkim):
+        self.authserv_id = authserv_id
+        self.spf = spf
+        self.mail_from = mail_from
+        self.dkim = dkim
+
+    def summary(self):
+        """'spf=pass dkim=pass' for printing"""
+        dkim = ','.join(result for result, *_ in self.dkim) or 'none'
+        return f"spf={self.spf} dkim={dkim}"
+
+    def header(self):
+        parts = [f"spf={self.spf}" + (f" smtp.mailfrom={self.mail_from}" if self.mail_from else '')]
+        for result, domain, selector, b_prefix, reason in self.dkim:
+            text = f"dkim={result}"
+            if reason:
+                text += f" ({reason})"
+            parts.append(f"{text} header.d={domain} header.s={selector} header.b={b_prefix}")
+        if not self.dkim:
+            parts.append("dkim=none")
+        return f"Authentication-Results: {self.authserv_id};\r\n\t" + ";\r\n\t".join(parts) + "\r\n"
+
+    def apply(self, content):
+        """content with our header prepended and any forged ones under our authserv-id removed"""
+        return self.header().encode() + strip_results(content, self.authserv_id)
+
+
+async def _no_client():
+    # LMTP over a Unix socket and the like: no client address to check
+    return 'none', None
+
+
+class Verifier:
+    def __init__(self, resolver, authserv_id, executor=None, workers=None):
+        self.resolver = resolver
+        self.authserv_id = authserv_id
+        self.executor = executor or ThreadPoolExecutor(max_workers=workers, thread_name_prefix='verify')
+
+    async def _key(self, tags):
+        domain, selector = tags.get('d'), tags.get('s')
+        if not domain or not selector:
+            return PermError("signature has no d= or s=")
+        try:
+            records = await self.resolver.query(f"{selector}._domainkey.{domain}", 'TXT')
+        except DNSError as e:
+            return TempError(str(e))
+        if not records:
+            return PermError("no key for signature")
+        return records[0]
+
+    async def verify(self, content, mail_from, client_ip=None, helo=None):
+        # Only the header block is looked at here; the body is left to the pool
+        end = content.find(b'\r\n\r\n')
+        fields, _ = split_message(content[:end + 4] if end != -1 else content)
+        signatures = signature_fields(fields)
+        spf_check = (check_spf(self.resolver, client_ip, mail_from, helo) if client_ip
+                     else _no_client())
+        spf, *records = await asyncio.gather(spf_check, *(self._key(tags) for _, tags in signatures))
+        dkim = []
+        if signatures:
+            dkim = await asyncio.get_running_loop().run_in_executor(
+                self.executor, verify_dkim, content, records)
+        metrics.inc('mail_auth_results_total', method='spf', result=spf[0],
+                    help='SPF/DKIM verification outcomes')
+        for result, *_ in dkim or [('none',)]:
+            metrics.inc('mail_auth_results_total', method='dkim', result=result)
+        return AuthResults(self.authserv_id, spf[0], mail_from if spf[1] else None, dkim)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def main():
+    usage = ("Usage: sender_auth.py keygen DOMAIN SELECTOR [rsa|ed25519] > key.pem\n"
+             "       sender_auth.py sign KEY.pem DOMAIN SELECTOR < message > signed")
+    if len(sys.argv) >= 4 and sys.argv[1] == 'keygen':
+        if sys.argv[4:5] == ['ed25519']:
+            key = ed25519.Ed25519PrivateKey.generate()
+            public = key.public_key().public_bytes(serialization.Encoding.Raw,
+                                                   serialization.PublicFormat.Raw)
+            kind = 'ed25519'
+        else:
+            key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+            public = key.public_key().public_bytes(serialization.Encoding.DER,
+                                                   serialization.PublicFormat.SubjectPublicKeyInfo)
+            kind = 'rsa'
+        sys.stdout.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                           serialization.NoEncryption()).decode())
+        print(f"{sys.argv[3]}._domainkey.{sys.argv[2]} TXT \"v=DKIM1; k={kind}; "
+              f"p={base64.b64encode(public).decode()}\"", file=sys.stderr)
+    elif len(sys.argv) == 5 and sys.argv[1] == 'sign':
+        with open(sys.argv[2], 'rb') as f:
+            key = serialization.load_pem_private_key(f.read(), None)
+        sys.stdout.buffer.write(sign_message(sys.stdin.buffer.read(), key, sys.argv[3], sys.argv[4]))
+    else:
+        print(usage, file=sys.stderr)
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
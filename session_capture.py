@@ -0,0 +1,88 @@
+"""Record SMTP session transcripts for replay with smtp_replay.py
+
+Each session is written as one JSON line when it ends:
+
+    {"peer": "...", "start": 1700000000.0, "duration": 1.23, "end": "quit",
+     "events": [[0.001, "C", "EHLO client"], [0.2, "D", 5120, null],
+                [0.25, "R", "250 Message accepted for delivery"], ...]}
+
+Event offsets are seconds since the session started. "C" is a command
+line, "D" a DATA body (size, and the base64 body when bodies are
+captured) and "R" the reply to that body.
+"""
+
+import base64
+import json
+import threading
+import time
+
+
+class CapturedSession:
+    def __init__(self, recorder, peer):
+        self.recorder = recorder
+        self.peer = peer
+        self.start = time.time()
+        self._t0 = time.monotonic()
+        self.events = []
+
+    def _offset(self):
+        return round(time.monotonic() - self._t0, 6)
+
+    def command(self, line):
+        self.events.append([self._offset(), 'C', line])
+
+    def data(self, content, size=None):
+        body = None
+        if self.recorder.bodies and content is not None:
+            body = base64.b64encode(content).decode('ascii')
+        self.events.append([self._offset(), 'D', len(content) if size is None else size, body])
+
+    def reply(self, text):
+        self.events.append([self._offset(), 'R', text])
+
+    def close(self, end=None):
+        self.recorder._write({
+            'peer': str(self.peer),
+            'start': self.start,
+            'duration': self._offset(),
+            'end': end,
+            'events': self.events,
+        })
+
+
+class _NullSession:
+    def command(self, line):
+        pass
+
+    def data(self, content, size=None):
+        pass
+
+    def reply(self, text):
+        pass
+
+    def close(self, end=None):
+        pass
+
+
+NULL_SESSION = _NullSession()
+
+
+class SessionRecorder:
+    def __init__(self, path, bodies=False):
+        self.path = path
+        self.bodies = bodies
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def session(self, peer):
+        return CapturedSession(self, peer)
+
+    def _write(self, record):
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
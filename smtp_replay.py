@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""Replay SMTP sessions recorded with mailserver.py --capture-file
+
+    smtp_replay.py capture.jsonl --port 1025               # original timing
+    smtp_replay.py capture.jsonl --port 1025 --speed 10    # 10x faster
+    smtp_replay.py capture.jsonl --port 1025 --speed max   # as fast as possible
+
+Sessions start at their recorded offsets (divided by --speed), so
+sessions that overlapped in production overlap again. With --speed max
+there are no pauses, and the number of concurrent sessions is capped at
+the peak concurrency seen in the capture (or --concurrency). DATA bodies
+that were not captured are replaced by filler of the recorded size.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import ssl
+import sys
+import time
+
+
+def load_sessions(path):
+    sessions = []
+    with open(path) as f:
+        for line in f:
+            try:
+                sessions.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    sessions.sort(key=lambda s: s['start'])
+    return sessions
+
+
+def peak_concurrency(sessions):
+    edges = []
+    for s in sessions:
+        edges.append((s['start'], 1))
+        edges.append((s['start'] + s['duration'], -1))
+    peak = current = 0
+    for _, delta in sorted(edges):
+        current += delta
+        peak = max(peak, current)
+    return max(peak, 1)
+
+
+def filler_body(size):
+    """A syntactically valid message of roughly `size` bytes"""
+    header = b"From: replay@example.com\r\nSubject: smtp_replay filler\r\n\r\n"
+    line = b"x" * 76 + b"\r\n"
+    remaining = max(size - len(header), 0)
+    return header + line * (remaining // len(line)) + b"y" * (remaining % len(line)) + b"\r\n"
+
+
+def dot_stuff(content):
+    if not content.endswith(b"\r\n"):
+        content += b"\r\n"
+    lines = content.split(b"\r\n")
+    return b"\r\n".join(b"." + l if l.startswith(b".") else l for l in lines) + b".\r\n"
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+class Stats:
+    def __init__(self):
+        self.sessions = 0
+        self.failed_sessions = 0
+        self.messages = 0
+        self.bytes = 0
+        self.rejected = 0
+        self.latency = {}   # command -> [seconds]
+
+    def record(self, command, seconds):
+        self.latency.setdefault(command, []).append(seconds)
+
+
+async def read_reply(reader):
+    lines = []
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError("server closed the connection")
+        lines.append(line)
+        if line[3:4] != b"-":
+            return b"".join(lines).decode('utf-8', 'replace')
+
+
+async def replay_session(session, args, stats, t0):
+    start = t0 + (session['start'] - args.origin) / args.speed if args.speed else None
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    try:
+        await read_reply(reader)
+        events = session['events']
+        for i, (offset, kind, *rest) in enumerate(events):
+            if kind != 'C':
+                continue
+            if start is not None:
+                delay = start + offset / args.speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            line = rest[0]
+            command = line.split(None, 1)[0].upper() if line.strip() else ''
+            if command == 'STARTTLS' and args.no_starttls:
+                continue
+            began = time.monotonic()
+            writer.write(line.encode('utf-8', 'surrogateescape') + b"\r\n")
+            await writer.drain()
+            reply = await read_reply(reader)
+            stats.record(command, time.monotonic() - began)
+
+            if command == 'STARTTLS' and reply.startswith('220'):
+                context = ssl.create_default_context()
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                transport = writer.transport
+                protocol = transport.get_protocol()
+                new_transport = await asyncio.get_running_loop().start_tls(
+                    transport, protocol, context, server_hostname=args.host)
+                writer._transport = new_transport
+            elif command == 'DATA' and reply.startswith('354'):
+                body_event = next((e for e in events[i + 1:] if e[1] == 'D'), None)
+                if body_event is None:
+                    content = b""
+                elif body_event[3]:
+                    content = base64.b64decode(body_event[3])
+                else:
+                    content = filler_body(body_event[2])
+                began = time.monotonic()
+                writer.write(dot_stuff(content))
+                await writer.drain()
+                reply = await read_reply(reader)
+                stats.record('DATA body', time.monotonic() - began)
+                stats.messages += 1
+                stats.bytes += len(content)
+                if not reply.startswith('2'):
+                    stats.rejected += 1
+            elif command == 'QUIT':
+                break
+        stats.sessions += 1
+    except (OSError, asyncio.IncompleteReadError) as e:
+        stats.failed_sessions += 1
+        if args.verbose:
+            print(f"⚠️  Session from {session['peer']} failed: {e}", file=sys.stderr)
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+
+
+async def replay(sessions, args):
+    stats = Stats()
+    limit = asyncio.Semaphore(args.concurrency or (10 ** 9 if args.speed else peak_concurrency(sessions)))
+    t0 = time.monotonic()
+
+    async def run(session):
+        if args.speed:
+            delay = t0 + (session['start'] - args.origin) / args.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        async with limit:
+            await replay_session(session, args, stats, t0)
+
+    await asyncio.gather(*(run(s) for s in sessions))
+    return stats, time.monotonic() - t0
+
+
+def report(stats, elapsed):
+    print(f"\n✅ Replayed {stats.sessions} sessions ({stats.failed_sessions} failed) in {elapsed:.2f}s")
+    print(f"   {stats.messages} messages, {stats.rejected} not accepted, "
+          f"{stats.messages / elapsed:.1f} msg/s, {stats.bytes / elapsed / 1e6:.2f} MB/s")
+    print(f"   {'command':<12} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+    for command, values in sorted(stats.latency.items()):
+        print(f"   {command:<12} {len(values):>7} {percentile(values, 0.5) * 1000:>9.2f} "
+              f"{percentile(values, 0.95) * 1000:>9.2f} {max(values) * 1000:>9.2f}")
+
+
+def parse_speed(value):
+    if value == 'max':
+        return 0.0
+    speed = float(value.rstrip('x'))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured SMTP sessions against a server')
+    parser.add_argument('capture', help='File written by mailserver.py --capture-file')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=25)
+    parser.add_argument('--speed', type=parse_speed, default=1.0,
+                        help="Time scale: 1 (original), N (N times faster) or 'max'")
+    parser.add_argument('--concurrency', type=int,
+                        help='Cap on simultaneous sessions (default: unlimited, or the '
+                             'captured peak with --speed max)')
+    parser.add_argument('--no-starttls', action='store_true',
+                        help='Skip STARTTLS commands in the transcript')
+    parser.add_argument('--limit', type=int, help='Replay only the first N sessions')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    sessions = load_sessions(args.capture)[:args.limit]
+    if not sessions:
+        print(f"❌ No sessions in {args.capture}")
+        sys.exit(1)
+    args.origin = sessions[0]['start']
+    span = sessions[-1]['start'] - args.origin
+    pace = f"{args.speed:g}x, ~{span / args.speed:.1f}s" if args.speed else "max speed"
+    print(f"▶️  Replaying {len(sessions)} sessions to {args.host}:{args.port} ({pace})")
+    stats, elapsed = asyncio.run(replay(sessions, args))
+    report(stats, elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+import pytest
+
+from dns_client import DNSError, Resolver
+from dns_stub import start_stub
+
+RECORDS = {
+    ('192.0.2.1', 'PTR'): ['mail.example.org'],
+    ('mail.example.org', 'A'): ['192.0.2.1'],
+    ('192.0.2.2', 'PTR'): ['liar.example.org'],
+    ('liar.example.org', 'A'): ['198.51.100.7'],
+    ('example.org', 'TXT'): ['v=spf1 -all'],
+}
+
+
+def with_stub(test, records=RECORDS, resolver_options=None, **stub_options):
+    """Run test(resolver, stub) against a stub DNS server on a free port"""
+    async def run():
+        stub = await start_stub(records, port=0, **stub_options)
+        port = stub.transport.get_extra_info('sockname')[1]
+        options = {'timeout': 0.2, 'attempts': 1, **(resolver_options or {})}
+        try:
+            return await test(Resolver('127.0.0.1', port, **options), stub)
+        finally:
+            stub.transport.close()
+    return asyncio.run(run())
+
+
+def expires_in(resolver, name, qtype):
+    expiry, _ = resolver.cache._data[(name, qtype)]
+    return expiry - time.monotonic()
+
+
+def test_ptr_and_forward_confirmed():
+    async def test(resolver, stub):
+        assert await resolver.ptr('192.0.2.1') == 'mail.example.org'
+        assert await resolver.forward_confirmed('192.0.2.1') == 'mail.example.org'
+        # PTR exists but its name does not point back
+        assert await resolver.ptr('192.0.2.2') == 'liar.example.org'
+        assert await resolver.forward_confirmed('192.0.2.2') is None
+        # No PTR at all
+        assert await resolver.ptr('192.0.2.3') is None
+        assert await resolver.forward_confirmed('192.0.2.3') is None
+        assert await resolver.ptr('not an ip') is None
+    with_stub(test)
+
+
+def test_answers_are_cached_for_their_ttl():
+    async def test(resolver, stub):
+        assert await resolver.query('example.org', 'TXT') == ['v=spf1 -all']
+        assert await resolver.query('Example.ORG.', 'TXT') == ['v=spf1 -all']
+        assert stub.queries[('example.org', 'TXT')] == 1
+        assert 110 < expires_in(resolver, 'example.org', 'TXT') <= 120
+    with_stub(test, ttl=120)
+
+
+def test_ttl_is_clamped_and_expires():
+    async def test(resolver, stub):
+        await resolver.query('mail.example.org', 'A')
+        assert expires_in(resolver, 'mail.example.org', 'A') <= 1
+        await asyncio.sleep(1.1)
+        await resolver.query('mail.example.org', 'A')
+        assert stub.queries[('mail.example.org', 'A')] == 2
+    with_stub(test, ttl=0, resolver_options={'min_ttl': 1})
+
+
+def test_negative_answers_use_the_soa_ttl():
+    async def test(resolver, stub):
+        assert await resolver.query('missing.example.org', 'A') == []
+        assert await resolver.query('missing.example.org', 'A') == []
+        assert stub.queries[('missing.example.org', 'A')] == 1
+        assert 30 < expires_in(resolver, 'missing.example.org', 'A') <= 42
+    with_stub(test, negative_ttl=42)
+
+
+def test_concurrent_lookups_share_one_query():
+    async def test(resolver, stub):
+        results = await asyncio.gather(*(resolver.query('mail.example.org', 'A') for _ in range(20)))
+        assert results == [['192.0.2.1']] * 20
+        assert stub.queries[('mail.example.org', 'A')] == 1
+        assert not resolver._inflight
+    with_stub(test, delay=0.1)
+
+
+def test_failures_are_cached():
+    async def test(resolver, stub):
+        with pytest.raises(DNSError):
+            await resolver.query('mail.example.org', 'A')
+        started = time.monotonic()
+        with pytest.raises(DNSError):
+            await resolver.query('mail.example.org', 'A')
+        # The second failure comes from the cache, not another timeout
+        # (dropped queries never reach stub.queries, so time it instead)
+        assert time.monotonic() - started < 0.1
+        assert 0 < expires_in(resolver, 'mail.example.org', 'A') <= 30
+        # ptr() and forward_confirmed() turn failures into "no name"
+        assert await resolver.forward_confirmed('192.0.2.1') is None
+    with_stub(test, drop=1.0, resolver_options={'failure_ttl': 30})
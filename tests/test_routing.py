@@ -0,0 +1,63 @@
+import json
+import os
+
+import pytest
+
+from routing import Router, RoutingError, RoutingTable
+
+
+def write_config(path, config):
+    path.write_text(config if isinstance(config, str) else json.dumps(config))
+    # Make sure the mtime changes even on coarse-grained filesystems
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def test_later_wildcard_applies_when_first_predicate_fails():
+    table = RoutingTable([
+        {'rcpt': '*-alerts@x.com', 'sender_domain': 'a.com', 'action': 'drop'},
+        {'rcpt': 'ops-*@x.com', 'action': 'store'},
+    ])
+    assert table.route('ops-alerts@x.com', 'me@b.com').action == 'store'
+    assert table.route('ops-alerts@x.com', 'me@a.com').action == 'drop'
+    assert table.route('dev-alerts@x.com', 'me@b.com').action == 'print'
+
+
+def test_needs_headers():
+    assert not RoutingTable([{'rcpt': 'a@x.com', 'action': 'drop'}]).needs_headers
+    assert RoutingTable([{'header': {'name': 'X-Spam', 'equals': 'yes'}, 'action': 'drop'}]).needs_headers
+
+
+@pytest.mark.parametrize('config', [
+    '[]',
+    '{"rules": {"rcpt": "a@x.com"}}',
+    '{"rules": ["a@x.com"]}',
+    '{"rules": [{"rcpt": 5, "action": "drop"}]}',
+    '{"rules": [{"header": {"name": "Subject", "matches": "(unclosed"}, "action": "drop"}]}',
+    '{"rules": [{"header": {"name": "Subject", "contains": 1}, "action": "drop"}]}',
+    '{"rules": [], "default": "explode"}',
+    '{"rules": [',
+])
+def test_invalid_config_raises_routing_error(tmp_path, config):
+    path = tmp_path / 'routes.json'
+    path.write_text(config)
+    with pytest.raises(RoutingError):
+        RoutingTable.from_file(path)
+
+
+@pytest.mark.parametrize('broken', [
+    {'rules': [{'header': {'name': 'Subject', 'matches': '(unclosed'}, 'action': 'drop'}]},
+    ['not', 'an', 'object'],
+])
+def test_broken_reload_keeps_previous_table(tmp_path, broken):
+    path = tmp_path / 'routes.json'
+    write_config(path, {'rules': [{'rcpt': 'a@x.com', 'action': 'store'}]})
+    router = Router(str(path), check_interval=0)
+    assert router.route('a@x.com').action == 'store'
+
+    write_config(path, broken)
+    assert router.route('a@x.com').action == 'store'
+    assert not router.reload()
+
+    write_config(path, {'rules': [{'rcpt': 'a@x.com', 'action': 'drop'}]})
+    assert router.route('a@x.com').action == 'drop'
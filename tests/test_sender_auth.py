@@ -0,0 +1,130 @@
+import asyncio
+import base64
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+from dns_client import Resolver
+from dns_stub import start_stub
+from sender_auth import Verifier, sign_message, strip_results
+
+MESSAGE = (b"From: Alice <alice@example.org>\r\nTo: bob@example.net\r\nSubject: Hello\r\n"
+           b"Date: Mon, 1 Jan 2024 00:00:00 +0000\r\nMessage-ID: <1@example.org>\r\n\r\n"
+           b"Hi Bob,\r\n\r\nJust testing.\r\n")
+
+
+def key_record(key):
+    if isinstance(key, ed25519.Ed25519PrivateKey):
+        public = key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        kind = 'ed25519'
+    else:
+        public = key.public_key().public_bytes(serialization.Encoding.DER,
+                                               serialization.PublicFormat.SubjectPublicKeyInfo)
+        kind = 'rsa'
+    return f"v=DKIM1; k={kind}; p={base64.b64encode(public).decode()}"
+
+
+def verify(records, content, mail_from, ip='192.0.2.10', helo='mail.example.org', **stub_options):
+    """Run Verifier.verify against a stub DNS server serving records"""
+    async def run():
+        stub = await start_stub(records, port=0, **stub_options)
+        port = stub.transport.get_extra_info('sockname')[1]
+        verifier = Verifier(Resolver('127.0.0.1', port, timeout=0.2, attempts=1), 'mx.example.net')
+        try:
+            return await verifier.verify(content, mail_from, ip, helo)
+        finally:
+            verifier.close()
+            stub.transport.close()
+    return asyncio.run(run())
+
+
+def spf(record_set, ip):
+    return verify(record_set, MESSAGE, 'alice@example.org', ip).spf
+
+
+SPF = {('example.org', 'TXT'): ['v=spf1 ip4:192.0.2.0/24 -all']}
+
+
+def test_spf_pass_and_fail():
+    assert spf(SPF, '192.0.2.10') == 'pass'
+    assert spf(SPF, '198.51.100.1') == 'fail'
+
+
+def test_spf_none_without_record():
+    assert spf({('example.com', 'TXT'): ['v=spf1 -all']}, '192.0.2.10') == 'none'
+
+
+def test_spf_include():
+    records = {('example.org', 'TXT'): ['v=spf1 include:_spf.example.net -all'],
+               ('_spf.example.net', 'TXT'): ['v=spf1 ip4:203.0.113.7 -all']}
+    assert spf(records, '203.0.113.7') == 'pass'
+    assert spf(records, '203.0.113.8') == 'fail'
+
+
+def test_spf_redirect():
+    records = {('example.org', 'TXT'): ['v=spf1 redirect=_spf.example.net'],
+               ('_spf.example.net', 'TXT'): ['v=spf1 a:mail.example.net ~all'],
+               ('mail.example.net', 'A'): ['203.0.113.9']}
+    assert spf(records, '203.0.113.9') == 'pass'
+    assert spf(records, '203.0.113.10') == 'softfail'
+
+
+def test_spf_lookup_limit():
+    mechanisms = ' '.join(f'a:host{i}.example.org' for i in range(11))
+    records = {('example.org', 'TXT'): [f'v=spf1 {mechanisms} -all']}
+    assert spf(records, '192.0.2.10') == 'permerror'
+    records = {('example.org', 'TXT'): [f'v=spf1 {mechanisms[:mechanisms.rindex(" a:")]} -all']}
+    assert spf(records, '192.0.2.10') == 'fail'
+
+
+def test_spf_temperror_when_query_is_dropped():
+    assert verify(SPF, MESSAGE, 'alice@example.org', drop=1.0).spf == 'temperror'
+
+
+def rsa_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def check_dkim(generate):
+    key = generate()
+    records = {('sel1._domainkey.example.org', 'TXT'): [key_record(key)], **SPF}
+    signed = sign_message(MESSAGE, key, 'example.org', 'sel1')
+    result = verify(records, signed, 'alice@example.org')
+    assert [r[:3] for r in result.dkim] == [('pass', 'example.org', 'sel1')]
+
+    tampered = signed.replace(b'Just testing.', b'Send money.')
+    assert verify(records, tampered, 'alice@example.org').dkim[0][0] == 'fail'
+
+    records[('sel1._domainkey.example.org', 'TXT')] = [key_record(generate())]
+    assert verify(records, signed, 'alice@example.org').dkim[0][0] == 'fail'
+
+
+def test_dkim_rsa():
+    check_dkim(rsa_key)
+
+
+def test_dkim_ed25519():
+    check_dkim(ed25519.Ed25519PrivateKey.generate)
+
+
+def test_dkim_temperror_when_key_query_is_dropped():
+    signed = sign_message(MESSAGE, ed25519.Ed25519PrivateKey.generate(), 'example.org', 'sel1')
+    result = verify({}, signed, 'alice@example.org', drop=1.0)
+    assert result.dkim[0][0] == 'temperror'
+
+
+def test_forged_results_are_replaced():
+    forged = (b"Authentication-Results: MX.example.net;\r\n\tdkim=pass header.d=example.org\r\n"
+              b"Authentication-Results: other.example; spf=pass\r\n" + MESSAGE)
+    result = verify(SPF, forged, 'alice@example.org', '198.51.100.1')
+    applied = result.apply(forged)
+    assert applied.count(b'mx.example.net;') == 1
+    assert applied.startswith(b'Authentication-Results: mx.example.net;\r\n\tspf=fail')
+    assert b'Authentication-Results: other.example; spf=pass\r\n' in applied
+    assert applied.endswith(MESSAGE)
+
+
+def test_strip_results_leaves_body_alone():
+    body = b"Authentication-Results: mx.example.net; dkim=pass\r\n"
+    content = b"Subject: quoted\r\n\r\n" + body
+    assert strip_results(content, 'mx.example.net') == content
@@ -0,0 +1,40 @@
+import json
+import os
+import signal
+import time
+
+from tracing import SamplingProfiler, Tracer
+
+
+def test_queued_sessions_are_written_on_close(tmp_path):
+    path = tmp_path / 'trace.jsonl'
+    tracer = Tracer(str(path))
+    for i in range(20):
+        trace = tracer.session(peer=str(i))
+        with trace.span('data', size=i):
+            pass
+        trace.close()
+    tracer.close()
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(records) == 40
+    assert [r['name'] for r in records[:2]] == ['data', 'session']
+    assert records[0]['parent_span_id'] == records[1]['span_id']
+
+
+def test_profiler_signal_only_flags_the_toggle(tmp_path):
+    profiler = SamplingProfiler(str(tmp_path), interval=0.001)
+    profiler.arm()
+    previous = signal.signal(signal.SIGUSR2, profiler.toggle)
+    try:
+        os.kill(os.getpid(), signal.SIGUSR2)
+        deadline = time.monotonic() + 2
+        while not profiler.running and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert profiler.running
+        os.kill(os.getpid(), signal.SIGUSR2)
+        while not list(tmp_path.glob('*.folded')) and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        signal.signal(signal.SIGUSR2, previous)
+    assert not profiler.running
+    assert len(list(tmp_path.glob('profile-*.folded'))) == 1
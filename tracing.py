@@ -0,0 +1,218 @@
+"""Per-session SMTP tracing and an on-demand sampling profiler
+
+Tracer writes one JSON object per span to a JSON-lines file. The fields
+follow the OTLP span model (trace_id, span_id, parent_span_id, name,
+start/end in unix nanoseconds, attributes, status), so the file can be fed
+to an OTLP collector's file receiver or read with jq.
+
+SamplingProfiler snapshots every thread's stack at a fixed interval and
+writes collapsed stacks ("frame;frame;frame count"), the input format of
+flamegraph.pl and speedscope.
+"""
+
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class Span:
+    __slots__ = ('trace', 'name', 'span_id', 'parent_id', 'start', 'attributes', 'error')
+
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.trace._stack.append(self.span_id)
+        self.start = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.time_ns()
+        self.trace._stack.pop()
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        self.trace._finish(self, end)
+        return False
+
+
+class SessionTrace:
+    """Spans for one client session, written out together when it ends"""
+
+    def __init__(self, tracer, **attributes):
+        self.tracer = tracer
+        self.trace_id = os.urandom(16).hex()
+        self._stack = []
+        self._records = []
+        self.root = Span(self, 'session', None, attributes)
+        self.root.__enter__()
+
+    def span(self, name, **attributes):
+        return Span(self, name, self._stack[-1] if self._stack else None, attributes)
+
+    def set(self, key, value):
+        self.root.set(key, value)
+
+    def error(self, exc):
+        self.root.error = f"{type(exc).__name__}: {exc}"
+
+    def _finish(self, span, end):
+        self._records.append({
+            'trace_id': self.trace_id,
+            'span_id': span.span_id,
+            'parent_span_id': span.parent_id,
+            'name': span.name,
+            'start_time_unix_nano': span.start,
+            'end_time_unix_nano': end,
+            'duration_ms': round((end - span.start) / 1e6, 3),
+            'attributes': span.attributes,
+            'status': 'error' if span.error else 'ok',
+            **({'error': span.error} if span.error else {}),
+        })
+
+    def close(self):
+        """End the session span and write every span of this session"""
+        if self._stack:
+            self.root.__exit__(None, None, None)
+        self.tracer._write(self._records)
+
+
+class _NullSpan:
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class _NullTrace:
+    _span = _NullSpan()
+
+    def span(self, name, **attributes):
+        return self._span
+
+    def set(self, key, value):
+        pass
+
+    def error(self, exc):
+        pass
+
+    def close(self):
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+
+class Tracer:
+    """Writes finished sessions from a background thread, off the event loop"""
+
+    def __init__(self, path, sample_rate=1.0):
+        self.path = path
+        self.sample_rate = sample_rate
+        self._file = open(path, 'a', buffering=1024 * 1024)
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def session(self, **attributes):
+        """Start tracing a session, or return a no-op trace if not sampled"""
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return NULL_TRACE
+        return SessionTrace(self, **attributes)
+
+    def _write(self, records):
+        self._queue.put(records)
+
+    def _run(self):
+        while True:
+            records = self._queue.get()
+            if records is None:
+                break
+            self._file.write(''.join(json.dumps(r, default=str) + '\n' for r in records))
+            if self._queue.empty():
+                self._file.flush()
+        self._file.close()
+
+    def close(self):
+        """Write the sessions still queued, then close the file"""
+        self._queue.put(None)
+        self._thread.join()
+
+
+class SamplingProfiler:
+    def __init__(self, directory='.', interval=0.005):
+        self.directory = directory
+        self.interval = interval
+        self.stacks = Counter()
+        self._thread = None
+        self._stop = threading.Event()
+        self._toggle = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def _sample_loop(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.stacks.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and write the collapsed stacks; returns the file path"""
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        path = os.path.join(self.directory, f"profile-{os.getpid()}-{int(time.time())}.folded")
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+    def arm(self):
+        """Start the thread that acts on toggle(); call before installing the handler"""
+        threading.Thread(target=self._control_loop, daemon=True).start()
+
+    def _control_loop(self):
+        while True:
+            self._toggle.wait()
+            self._toggle.clear()
+            if self.running:
+                path = self.stop()
+                print(f"🔥 Profiler stopped, stacks written to {path}")
+            else:
+                self.start()
+                print(f"🔥 Profiler started (sampling every {self.interval * 1000:.0f}ms)")
+
+    def toggle(self, *_):
+        """Signal handler: only flags the request, the armed thread starts or stops sampling"""
+        self._toggle.set()
@@ -0,0 +1,239 @@
+"""Rolling per-IP and per-sender-domain traffic counts in bounded memory
+
+TrafficStats keeps one slot per minute in a fixed ring (an hour by
+default). Each slot holds the minute's totals and, for client IPs and for
+sender domains:
+
+- a space-saving table (Metwally, Agrawal and El Abbadi) of the busiest
+  keys by events (messages plus rejects), so the heavy hitters are known
+  however many distinct senders there are;
+- a count-min sketch of messages, bytes and rejects for any key, which
+  answers "how much from this IP" and fills in the figures for the top
+  keys. Estimates never undercount; they can overcount by roughly
+  e / width of the minute's total.
+
+Memory is fixed by minutes x (capacity + sketch size), whatever the
+cardinality. record() costs two dict updates and a handful of array
+increments.
+"""
+
+import array
+import heapq
+import threading
+import time
+
+MEASURES = ('messages', 'bytes', 'rejects')
+DIMENSIONS = ('ip', 'domain')
+
+
+def sender_domain(sender):
+    if not sender or '@' not in sender:
+        return '(none)'
+    return sender.rpartition('@')[2].lower()
+
+
+class SpaceSaving:
+    """Approximate top-K counter in fixed memory
+
+    A key's count can overestimate its true count by at most its error,
+    and any key seen more than total / capacity times is always tracked.
+    Each add is a dict update; only a new key arriving when the table is
+    full touches the heap, at O(log capacity) amortised.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}    # key -> [count, error]
+        # One (count, key) entry per tracked key; a count here may be stale
+        # (lower than the real one), never higher
+        self._heap = []
+
+    def add(self, key, n=1):
+        self.total += n
+        entry = self.counts.get(key)
+        if entry is not None:
+            entry[0] += n
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[key] = [n, 0]
+            heapq.heappush(self._heap, (n, key))
+            return
+        # Evict the key with the smallest count; refresh stale heap entries on the way
+        while True:
+            count, victim = self._heap[0]
+            current = self.counts[victim][0]
+            if current == count:
+                break
+            heapq.heapreplace(self._heap, (current, victim))
+        del self.counts[victim]
+        self.counts[key] = [count + n, count]
+        heapq.heapreplace(self._heap, (count + n, key))
+
+    def top(self, n=10):
+        """[(key, count, error), ...], largest count first"""
+        items = list(self.counts.items())
+        return [(key, count, error) for key, (count, error)
+                in heapq.nlargest(n, items, key=lambda item: item[1][0])]
+
+
+class CountMin:
+    """Count-min sketch with one counter table per measure
+
+    The rows index from 16-bit slices of one hash() of the key, so depth
+    is at most 4 and width at most 65536. hash() is salted per process,
+    which is fine for counts that live only in memory. Updates are
+    conservative (only the cells at the current minimum grow), which keeps
+    overestimates for light keys much smaller on skewed traffic.
+    """
+
+    def __init__(self, width=512, depth=4, measures=len(MEASURES)):
+        if not 0 < depth <= 4 or not 0 < width <= 65536:
+            raise ValueError("depth must be 1-4 and width 1-65536")
+        self.width = width
+        self.depth = depth
+        self.tables = [array.array('q', bytes(8 * width * depth)) for _ in range(measures)]
+
+    def _cells(self, key):
+        h = hash(key)
+        return [row * self.width + ((h >> (16 * row)) & 0xffff) % self.width
+                for row in range(self.depth)]
+
+    def add(self, key, values):
+        cells = self._cells(key)
+        for table, value in zip(self.tables, values):
+            if value:
+                target = min(table[cell] for cell in cells) + value
+                for cell in cells:
+                    if table[cell] < target:
+                        table[cell] = target
+
+    def estimate(self, key, cells=None):
+        """[estimate per measure]; cells from _cells() may be passed to skip rehashing"""
+        cells = cells or self._cells(key)
+        return [min(map(table.__getitem__, cells)) for table in self.tables]
+
+
+def _sum_estimates(sketches, key):
+    """Estimates for key summed over sketches of the same shape"""
+    sums = [0] * len(MEASURES)
+    if sketches:
+        cells = sketches[0]._cells(key)
+        for sketch in sketches:
+            for i, value in enumerate(sketch.estimate(key, cells)):
+                sums[i] += value
+    return sums
+
+
+class _Minute:
+    __slots__ = ('minute', 'totals', 'heavy', 'sketches')
+
+    def __init__(self, minute, capacity, width, depth):
+        self.minute = minute
+        self.totals = [0, 0, 0]
+        self.heavy = {by: SpaceSaving(capacity) for by in DIMENSIONS}
+        self.sketches = {by: CountMin(width, depth) for by in DIMENSIONS}
+
+
+class TrafficStats:
+    def __init__(self, minutes=60, capacity=100, width=512, depth=4):
+        self.minutes = minutes
+        self.capacity = capacity
+        self.width = width
+        self.depth = depth
+        self._slots = [None] * minutes
+        self._lock = threading.Lock()
+
+    def _slot(self, minute):
+        index = minute % self.minutes
+        slot = self._slots[index]
+        if slot is None or slot.minute != minute:
+            slot = self._slots[index] = _Minute(minute, self.capacity, self.width, self.depth)
+        return slot
+
+    def record(self, ip, sender, size=0, rejected=False, now=None):
+        """Count one accepted message of size bytes, or one rejection"""
+        minute = int((now if now is not None else time.time()) // 60)
+        values = (0, 0, 1) if rejected else (1, size, 0)
+        ip = ip or '(none)'
+        domain = sender_domain(sender)
+        with self._lock:
+            slot = self._slot(minute)
+            totals = slot.totals
+            totals[0] += values[0]
+            totals[1] += values[1]
+            totals[2] += values[2]
+            slot.heavy['ip'].add(ip)
+            slot.sketches['ip'].add(ip, values)
+            slot.heavy['domain'].add(domain)
+            slot.sketches['domain'].add(domain, values)
+
+    def _window(self, minutes, now):
+        current = int((now if now is not None else time.time()) // 60)
+        first = current - min(minutes, self.minutes) + 1
+        return first, current, [slot for slot in self._slots
+                                if slot is not None and first <= slot.minute <= current]
+
+    def series(self, minutes=60, now=None):
+        """Totals for each of the last `minutes` minutes, oldest first; empty minutes are zeros"""
+        with self._lock:
+            first, current, slots = self._window(minutes, now)
+            totals = {slot.minute: list(slot.totals) for slot in slots}
+        return [dict(zip(('minute',) + MEASURES, [minute * 60] + totals.get(minute, [0, 0, 0])))
+                for minute in range(first, current + 1)]
+
+    def lookup(self, by, key, minutes=60, now=None):
+        """Estimated messages, bytes and rejects for one key over the window"""
+        if by not in DIMENSIONS:
+            raise ValueError(f"by must be one of {', '.join(DIMENSIONS)}")
+        if by == 'domain':
+            key = key.lower()
+        with self._lock:
+            _, _, slots = self._window(minutes, now)
+        return dict(zip(MEASURES, _sum_estimates([slot.sketches[by] for slot in slots], key)))
+
+    def top(self, by='ip', measure='messages', minutes=60, n=10, now=None):
+        """The n busiest keys over the window, ranked by measure
+
+        Candidates are the keys with the most events across each minute's
+        heavy hitters; their figures come from the sketches.
+        """
+        if by not in DIMENSIONS:
+            raise ValueError(f"by must be one of {', '.join(DIMENSIONS)}")
+        if measure not in MEASURES:
+            raise ValueError(f"measure must be one of {', '.join(MEASURES)}")
+        # Only the slot list is taken under the lock. Reading counters that
+        # record() is still bumping just gives a slightly newer estimate
+        with self._lock:
+            _, _, slots = self._window(minutes, now)
+        events = {}
+        for slot in slots:
+            for key, count, _ in slot.heavy[by].top(n):
+                events[key] = events.get(key, 0) + count
+        candidates = heapq.nlargest(4 * n, events, key=events.get)
+        sketches = [slot.sketches[by] for slot in slots]
+        rows = [dict(zip(('key',) + MEASURES, [key] + _sum_estimates(sketches, key)))
+                for key in candidates]
+        rows = [row for row in rows if row[measure]]
+        return heapq.nlargest(n, rows, key=lambda row: row[measure])
+
+    def report(self, minutes=60, n=10, measure='messages', now=None):
+        series = self.series(minutes, now)
+        return {'minutes': len(series),
+                'totals': {m: sum(point[m] for point in series) for m in MEASURES},
+                'series': series,
+                'top': {by: self.top(by, measure, minutes, n, now) for by in DIMENSIONS}}
+
+    def register_metrics(self, registry, minutes=5, n=10):
+        """Expose the last `minutes` minutes' totals and top keys as gauges"""
+        for i, measure in enumerate(MEASURES):
+            registry.gauge_callback(
+                f'mail_traffic_recent_{measure}',
+                lambda i=i: sum(point[MEASURES[i]] for point in self.series(minutes)),
+                help=f'{measure.capitalize()} over the last {minutes} minutes')
+            registry.labeled_callback(
+                f'mail_traffic_top_{measure}',
+                lambda measure=measure: [({'by': by, 'key': row['key']}, row[measure])
+                                         for by in DIMENSIONS
+                                         for row in self.top(by, measure, minutes, n)],
+                help=f'Busiest client IPs and sender domains by {measure} over the last {minutes} minutes')
@@ -8,7 +8,10 @@
 # ///
 """HTTP/HTTPS server that receives emails via POST and prints them to console"""
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
 import uvicorn
@@ -16,9 +19,54 @@ import argparse
 import sys
 import os
 import ssl
+from search_index import SearchIndex
+from html_text import html_preview
+from dedup import Deduplicator, file_key, message_key, recipients_key
+from json_stream import ObjectStreamParser
+from framing import CONTENT_TYPE as FRAME_CONTENT_TYPE, FrameStreamParser
+from live_stream import Broadcaster, listen_datagrams, summary
+from traffic import TrafficStats
+import codecs
+import hashlib
+import zlib
+import json
+import time
+import asyncio
+import importlib.util
+
+try:
+    import orjson
+    from fastapi.responses import ORJSONResponse as FastJSONResponse
+    json_loads, json_dumps = orjson.loads, orjson.dumps
+except ImportError:
+    from fastapi.responses import JSONResponse as FastJSONResponse
+    json_loads = json.loads
+    json_dumps = lambda obj: json.dumps(obj).encode()
+
+try:
+    import zstandard
+    DECODE_ERRORS = (ValueError, zlib.error, zstandard.ZstdError)
+except ImportError:
+    zstandard = None
+    DECODE_ERRORS = (ValueError, zlib.error)
 
 app = FastAPI(title="Email Receiver", version="1.0.0")
 
+# Set from --search-index / --dedup-window / --capture-file in main(), or
+# from CONFIG_ENV in each worker process when running with --workers
+search_index = None
+dedup = None
+capture = None
+configured = False
+max_body_size = 64 * 1024 * 1024
+# Live feed for GET /stream; --stream-socket adds mailserver.py's messages to it
+stream = Broadcaster()
+stream_socket = None
+traffic = None
+# Bodies up to this size are parsed in one go; larger ones are streamed
+STREAM_THRESHOLD = 1024 * 1024
+CONFIG_ENV = 'MAILPRINT_WEBSERVER_CONFIG'
+
 class Email(BaseModel):
     from_: Optional[str] = None
     to: Optional[str | List[str]] = None
@@ -27,6 +75,7 @@ class Email(BaseModel):
     text: Optional[str] = None
     html: Optional[str] = None
     headers: Optional[Dict[str, Any]] = None
+    raw: Optional[str] = None
     
     class Config:
         fields = {'from_': 'from'}
@@ -43,9 +92,225 @@ async def health():
 async def email_info():
     return {"message": "Email endpoint ready. Use POST to submit emails.", "status": "ready"}
 
+@app.get("/search")
+def search(q: str, limit: int = 20):
+    """Full-text search over indexed subjects and bodies"""
+    if search_index is None:
+        raise HTTPException(status_code=404, detail="Search index not configured (use --search-index)")
+    results = search_index.search(q, limit=max(1, min(limit, 100)))
+    return {"query": q, "count": len(results), "results": results}
+
+@app.get("/traffic")
+def traffic_report(minutes: int = 60, n: int = 10, measure: str = 'messages',
+                   by: Optional[str] = None, key: Optional[str] = None):
+    """Per-minute totals and top client IPs / sender domains; with by and key, one key's figures"""
+    if traffic is None:
+        raise HTTPException(status_code=404, detail="Traffic statistics are off (--traffic-minutes 0)")
+    try:
+        if key is not None:
+            return {"by": by or 'domain', "key": key, "minutes": minutes,
+                    **traffic.lookup(by or 'domain', key, minutes)}
+        return traffic.report(minutes, min(n, 100), measure)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/stream")
+async def stream_events(request: Request):
+    """Server-Sent Events feed of every message received, by HTTP or SMTP"""
+    subscriber = stream.subscribe()
+
+    async def frames():
+        try:
+            yield b': connected\n\n'
+            while True:
+                data = await subscriber.next()
+                if data is None:
+                    # Fell too far behind with --stream-slow close
+                    break
+                yield data or b': keepalive\n\n'
+        finally:
+            stream.unsubscribe(subscriber)
+
+    return StreamingResponse(frames(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/stream/stats")
+async def stream_stats():
+    return stream.stats()
+
+def email_key(email, raw_file=None):
+    """Dedup key: same as the SMTP path when the raw message is included"""
+    if raw_file is not None:
+        try:
+            return recipients_key(file_key(raw_file), email.to)
+        finally:
+            raw_file.seek(0)
+    if email.raw:
+        return recipients_key(message_key(email.raw.encode('utf-8', 'surrogateescape')), email.to)
+    headers = email.headers or {}
+    message_id = headers.get('message-id') or headers.get('Message-ID') or ''
+    parts = (message_id, email.subject or '', email.body or email.text or '', email.html or '')
+    return hashlib.blake2b('\0'.join(parts).encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+class BodyTooLarge(Exception):
+    pass
+
+class _Sink:
+    """Collects decompressed pieces, giving up as soon as their total passes limit"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.pieces = []
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise BodyTooLarge()
+        self.pieces.append(data)
+        return len(data)
+
+    def take(self):
+        pieces, self.pieces = self.pieces, []
+        return pieces
+
+def decompressor(encoding, limit):
+    """Incremental decoder for a Content-Encoding, as a chunk -> iterator of bytes function
+
+    Output comes out in pieces of bounded size and is counted as it is
+    produced, so BodyTooLarge is raised once the decoded body passes limit,
+    without a compressed bomb ever being inflated in memory.
+    """
+    if encoding in ('', 'identity'):
+        return None
+    sink = _Sink(limit)
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        # 32 + MAX_WBITS accepts both gzip and zlib-wrapped deflate
+        d = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        def inflate(chunk):
+            sink.write(d.decompress(chunk, STREAM_THRESHOLD))
+            yield from sink.take()
+            while d.unconsumed_tail:
+                sink.write(d.decompress(d.unconsumed_tail, STREAM_THRESHOLD))
+                yield from sink.take()
+        inflate.truncated = lambda: not d.eof
+        return inflate
+    if encoding == 'zstd' and zstandard is not None:
+        # The stream writer hands the sink one output block at a time; small
+        # input slices keep what one write() can produce small too
+        writer = zstandard.ZstdDecompressor().stream_writer(sink, write_size=STREAM_THRESHOLD)
+        def unzstd(chunk):
+            for start in range(0, len(chunk), 4096):
+                writer.write(chunk[start:start + 4096])
+                yield from sink.take()
+        return unzstd
+    raise HTTPException(status_code=415, detail=f"Unsupported Content-Encoding: {encoding}")
+
+async def read_email(request):
+    """Read a POSTed email as (fields, raw_file)
+
+    Large bodies are never held whole: the JSON is parsed as it streams in
+    and `raw` is unescaped into a spool file (raw_file), which the caller
+    must close. Small bodies are parsed in one go and keep `raw` in fields.
+    Bodies may be gzip/deflate/zstd encoded, and may use the binary framing
+    from framing.py instead of JSON; both are decoded as they stream in.
+    """
+    length = request.headers.get('content-length')
+    if length is not None:
+        try:
+            length = int(length)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Content-Length")
+        if length > max_body_size:
+            raise HTTPException(status_code=413, detail=f"Body larger than {max_body_size} bytes")
+    decode = decompressor(request.headers.get('content-encoding', '').strip().lower(), max_body_size)
+    framed = request.headers.get('content-type', '').startswith(FRAME_CONTENT_TYPE)
+    try:
+        if length is not None and length <= STREAM_THRESHOLD and decode is None and not framed:
+            data = json_loads(await request.body())
+            if not isinstance(data, dict):
+                raise ValueError("expected a JSON object")
+            raw_file = None
+        else:
+            parser = FrameStreamParser() if framed else ObjectStreamParser(spool=('raw',))
+            received = 0
+            try:
+                async for chunk in request.stream():
+                    if not chunk:
+                        continue
+                    if decode is None:
+                        received += len(chunk)
+                        if received > max_body_size:
+                            raise BodyTooLarge()
+                        parser.feed(chunk)
+                    else:
+                        # decode() counts its own output and stops at max_body_size
+                        for piece in decode(chunk):
+                            parser.feed(piece)
+            except BodyTooLarge:
+                for f in parser.spools.values():
+                    f.close()
+                raise HTTPException(status_code=413, detail=f"Body larger than {max_body_size} bytes")
+            if getattr(decode, 'truncated', lambda: False)():
+                raise ValueError("compressed stream ended early")
+            data, spools = parser.close()
+            raw_file = spools.get('raw')
+    except DECODE_ERRORS as e:
+        raise HTTPException(status_code=400, detail=f"Invalid body: {e}")
+    fields = {name: data.get(name) for name in ('to', 'subject', 'body', 'text', 'html', 'headers', 'raw')}
+    fields['from_'] = data.get('from')
+    return fields, raw_file
+
 @app.post("/email")
-async def receive_email(email: Email):
+async def post_email(request: Request):
+    fields, raw_file = await read_email(request)
+    try:
+        try:
+            email = Email(**fields)
+        except ValidationError as e:
+            raise RequestValidationError(e.errors())
+        return await receive_email(email, raw_file)
+    finally:
+        if raw_file is not None:
+            raw_file.close()
+
+CAPTURE_CHUNK = 64 * 1024
+
+def write_capture(email, raw_file=None):
+    """Record the request as posted, for replay.py run --capture
+
+    A spooled raw body is copied into the JSON string a chunk at a time,
+    so large POSTs are never held in memory whole.
+    """
+    record = {'ts': time.time(), 'email': {
+        'from': email.from_, 'to': email.to, 'subject': email.subject, 'body': email.body,
+        'text': email.text, 'html': email.html, 'headers': email.headers,
+        # Kept last: a spooled body is written in place of this null
+        'raw': email.raw if raw_file is None else None}}
+    line = json_dumps(record).decode()
+    if raw_file is None:
+        capture.write(line + '\n')
+    else:
+        capture.write(line[:-len('null}}')] + '"')
+        # Incremental, so a UTF-8 sequence split across chunks still decodes whole
+        decoder = codecs.getincrementaldecoder('utf-8')('surrogateescape')
+        for chunk in iter(lambda: raw_file.read(CAPTURE_CHUNK), b''):
+            capture.write(json.dumps(decoder.decode(chunk))[1:-1])
+        capture.write(json.dumps(decoder.decode(b'', final=True))[1:-1] + '"}}\n')
+        raw_file.seek(0)
+    capture.flush()
+
+async def receive_email(email, raw_file=None):
     """Receive and print email"""
+    if capture is not None:
+        write_capture(email, raw_file)
+    
+    # Cloudflare retries the same message; acknowledge repeats without printing
+    dedup_key = None
+    if dedup is not None:
+        dedup_key = email_key(email, raw_file)
+        if dedup.is_duplicate(dedup_key):
+            return {"status": "success", "message": "Email received", "duplicate": True}
+    
     # Extract email fields
     sender = email.from_ or '(unknown)'
     recipients = email.to or '(unknown)'
@@ -74,17 +339,167 @@ async def receive_email(email: Email):
         print(body)
     elif html:
         print("[HTML content received]")
-        print(html[:500] + "..." if len(html) > 500 else html)
+        print(html_preview(html, 500))
     else:
         print("(empty body)")
     print("="*60 + "\n")
     
+    if search_index is not None:
+        search_index.add(subject, body or html, sender, recipients,
+                         headers.get('message-id') or headers.get('Message-ID'))
+    
+    if dedup_key is not None:
+        dedup.record(dedup_key)
+    
+    if stream.subscribers or traffic is not None:
+        size = len(email.raw) if email.raw else None
+        if raw_file is not None:
+            size = raw_file.seek(0, os.SEEK_END)
+            raw_file.seek(0)
+        if traffic is not None:
+            # Cloudflare does not pass on the client address, so only the domain is useful here
+            traffic.record(None, sender, size or len(body) + len(html))
+    if stream.subscribers:
+        stream.publish_json(json_dumps(summary('http', sender, recipients, subject, size, ts=time.time())))
+    
     return {"status": "success", "message": "Email received"}
 
 # Backward compatibility - also accept at /mail
 @app.post("/mail")
-async def receive_email_alt(email: Email):
-    return await receive_email(email)
+async def receive_email_alt(request: Request):
+    return await post_email(request)
+
+@app.on_event("startup")
+async def load_config():
+    configure_from_env()
+    await start_stream_socket()
+
+async def start_stream_socket():
+    """Receive mailserver.py --stream-socket events in this process"""
+    if not stream_socket:
+        return
+    try:
+        await listen_datagrams(stream_socket, stream, on_event=count_event)
+        print(f"📡 Streaming SMTP events from {stream_socket}")
+    except OSError as e:
+        # With --workers, the first worker to bind gets the SMTP events
+        print(f"⚠️  Not receiving SMTP events in this worker: {e}")
+
+def count_event(event):
+    """Add an SMTP message or rejection from the stream socket to the traffic counts"""
+    if traffic is not None and isinstance(event, dict):
+        traffic.record(event.get('client'), event.get('from'), event.get('size') or 0,
+                       rejected=event.get('event') == 'reject')
+
+
+# Production mode (--production) serves fast_app: POST bodies are parsed
+# with orjson and type-checked by field_errors() instead of being built into
+# the Email model, queued, and answered with 202 before anything is printed. A per-process consumer task
+# then runs the same receive_email() on each queued message.
+fast_app = FastAPI(title="Email Receiver", version="1.0.0", default_response_class=FastJSONResponse)
+for path, endpoint in (("/", root), ("/health", health), ("/email", email_info), ("/search", search),
+                       ("/traffic", traffic_report), ("/stream", stream_events),
+                       ("/stream/stats", stream_stats)):
+    fast_app.add_api_route(path, endpoint, methods=["GET"])
+
+ingest_queue = None
+queue_size = 10000
+ACCEPTED = b'{"status":"accepted","message":"Email queued"}'
+QUEUE_FULL = b'{"status":"error","message":"Ingest queue full, retry later"}'
+
+# The Email model's field types, checked by hand so production mode can
+# refuse what the default app would refuse without building the model
+FIELD_TYPES = {'from_': str, 'subject': str, 'body': str, 'text': str, 'html': str, 'raw': str,
+               'headers': dict}
+
+def field_errors(fields):
+    """Validation errors, in FastAPI's 422 format, for fields that don't fit Email"""
+    errors = []
+    for name, value in fields.items():
+        if value is None:
+            continue
+        if name == 'to':
+            ok = isinstance(value, str) or (isinstance(value, list)
+                                            and all(isinstance(item, str) for item in value))
+            expected = 'a string or a list of strings'
+        else:
+            ok = isinstance(value, FIELD_TYPES[name])
+            expected = 'an object' if FIELD_TYPES[name] is dict else 'a string'
+        if not ok:
+            errors.append({'type': 'type_error', 'loc': ('body', 'from' if name == 'from_' else name),
+                           'msg': f"Input should be {expected}", 'input': value})
+    return errors
+
+async def drain_queue():
+    while True:
+        fields, raw_file = await ingest_queue.get()
+        try:
+            await receive_email(Email.model_construct(**fields), raw_file)
+        except Exception as e:
+            print(f"Error processing email: {e}")
+        finally:
+            if raw_file is not None:
+                raw_file.close()
+            ingest_queue.task_done()
+
+@fast_app.on_event("startup")
+async def start_ingest():
+    global ingest_queue
+    configure_from_env()
+    await start_stream_socket()
+    ingest_queue = asyncio.Queue(maxsize=queue_size)
+    fast_app.state.consumer = asyncio.create_task(drain_queue())
+
+@fast_app.on_event("shutdown")
+async def stop_ingest():
+    # Print whatever was already acknowledged before exiting
+    try:
+        await asyncio.wait_for(ingest_queue.join(), timeout=10)
+    except asyncio.TimeoutError:
+        print(f"⚠️  {ingest_queue.qsize()} queued emails dropped at shutdown")
+    fast_app.state.consumer.cancel()
+
+@fast_app.post("/email")
+@fast_app.post("/mail")
+async def enqueue_email(request: Request):
+    fields, raw_file = await read_email(request)
+    errors = field_errors(fields)
+    if errors:
+        if raw_file is not None:
+            raw_file.close()
+        raise RequestValidationError(errors)
+    try:
+        ingest_queue.put_nowait((fields, raw_file))
+    except asyncio.QueueFull:
+        if raw_file is not None:
+            raw_file.close()
+        return Response(QUEUE_FULL, status_code=503, media_type="application/json",
+                        headers={"Retry-After": "1"})
+    return Response(ACCEPTED, status_code=202, media_type="application/json")
+
+
+def configure(options):
+    """Open the search index, dedup store and capture file named in options"""
+    global search_index, dedup, capture, queue_size, max_body_size, configured
+    global stream, stream_socket, traffic
+    configured = True
+    if options.get('search_index'):
+        search_index = SearchIndex(options['search_index'])
+    if options.get('dedup_window'):
+        dedup = Deduplicator(options['dedup_window'], options.get('dedup_file'))
+    if options.get('capture_file'):
+        capture = open(options['capture_file'], 'a')
+    queue_size = options.get('queue_size') or queue_size
+    max_body_size = options.get('max_body_size') or max_body_size
+    stream = Broadcaster(options.get('stream_queue') or stream.queue_size,
+                         options.get('stream_slow') or stream.slow)
+    stream_socket = options.get('stream_socket')
+    if options.get('traffic_minutes', 60):
+        traffic = TrafficStats(options.get('traffic_minutes') or 60)
+
+def configure_from_env():
+    if not configured and os.environ.get(CONFIG_ENV):
+        configure(json.loads(os.environ[CONFIG_ENV]))
 
 
 def main():
@@ -99,15 +514,48 @@ def main():
                         help='Path to SSL certificate (default: /etc/letsencrypt/live/telemetry.fyi/fullchain.pem)')
     parser.add_argument('--key', default='/etc/letsencrypt/live/telemetry.fyi/privkey.pem',
                         help='Path to SSL private key (default: /etc/letsencrypt/live/telemetry.fyi/privkey.pem)')
+    parser.add_argument('--search-index',
+                        help='SQLite full-text index to query at /search (shared with mailserver.py --search-index)')
+    parser.add_argument('--dedup-window', type=int, default=0,
+                        help='Skip repeats of a message seen within this many seconds (default: off)')
+    parser.add_argument('--dedup-file',
+                        help='Persist dedup keys here so they survive restarts')
+    parser.add_argument('--capture-file',
+                        help='Append every received POST to this JSON-lines file (see replay.py)')
+    parser.add_argument('--max-body-size', type=int, default=64 * 1024 * 1024,
+                        help='Reject POST bodies larger than this with 413 (default: 64MB)')
+    parser.add_argument('--production', action='store_true',
+                        help='Queue POSTs and answer 202 immediately; orjson parsing, '
+                             'uvloop/httptools when installed, no access log')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes (default: 1). Each keeps its own dedup window')
+    parser.add_argument('--queue-size', type=int, default=10000,
+                        help='Queued emails per worker before POSTs get 503 (with --production)')
+    parser.add_argument('--stream-socket',
+                        help='Unix datagram socket that mailserver.py --stream-socket publishes to; '
+                             'its messages then appear on GET /stream too')
+    parser.add_argument('--stream-queue', type=int, default=256,
+                        help='Events buffered per /stream subscriber (default: 256)')
+    parser.add_argument('--stream-slow', choices=('drop', 'close'), default='drop',
+                        help='When a /stream subscriber falls behind: drop its oldest events '
+                             '(default) or disconnect it')
+    parser.add_argument('--traffic-minutes', type=int, default=60,
+                        help='Minutes of per-sender-domain counts (and per-client-IP, from --stream-socket) '
+                             'kept for GET /traffic (default: 60, 0: off)')
     args = parser.parse_args()
     
+    if args.workers > 1:
+        # Workers import this module afresh and configure themselves from the environment
+        os.environ[CONFIG_ENV] = json.dumps(vars(args))
+    else:
+        configure(vars(args))
+    
     # If no-tls is specified and port is still 443, switch to 80
     if args.no_tls and args.port == 443:
         args.port = 80
     
     # Check if we need root for port < 1024
     if args.port < 1024 and sys.platform != 'win32':
-        import os
         if os.geteuid() != 0:
             print(f"❌ Port {args.port} requires root privileges.")
             print(f"   Run with: sudo {' '.join(sys.argv)}")
@@ -136,12 +584,23 @@ def main():
     
     print("Press Ctrl+C to stop\n")
     
+    options = {'host': args.host, 'port': args.port, 'log_level': "info"}
+    if ssl_context:
+        options.update(ssl_keyfile=args.key, ssl_certfile=args.cert)
+    target = fast_app if args.production else app
+    if args.workers > 1:
+        # Multiple workers need an import string rather than the app object
+        target = 'webserver:fast_app' if args.production else 'webserver:app'
+        options['workers'] = args.workers
+    if args.production:
+        options['access_log'] = False
+        options['loop'] = 'uvloop' if importlib.util.find_spec('uvloop') else 'asyncio'
+        options['http'] = 'httptools' if importlib.util.find_spec('httptools') else 'h11'
+        print(f"🚀 Production mode: {args.workers} worker(s), {options['loop']} loop, "
+              f"{options['http']} parser, {'orjson' if json_loads is not json.loads else 'json'}")
+    
     try:
-        if ssl_context:
-            uvicorn.run(app, host=args.host, port=args.port, log_level="info",
-                       ssl_keyfile=args.key, ssl_certfile=args.cert)
-        else:
-            uvicorn.run(app, host=args.host, port=args.port, log_level="info")
+        uvicorn.run(target, **options)
     except KeyboardInterrupt:
         print("\n✋ Server stopped")
     except OSError as e:
@@ -12,10 +12,12 @@ import sys
 from pathlib import Path
 
 class SimpleSMTPServer:
-    def __init__(self, host='0.0.0.0', port=587, ssl_context=None):
+    def __init__(self, host='0.0.0.0', port=587, ssl_context=None, server_name=None):
         self.host = host
         self.port = port
         self.ssl_context = ssl_context
+        # Resolved once here; getfqdn() blocks on the resolver
+        self.server_name = server_name or socket.getfqdn()
         self.server = None
         
     async def handle_client(self, reader, writer):
@@ -51,7 +53,7 @@ class SimpleSMTPServer:
                 
                 # Handle SMTP commands
                 if cmd == "EHLO" or cmd == "HELO":
-                    response = f"250-{socket.getfqdn()}\r\n"
+                    response = f"250-{self.server_name}\r\n"
                     response += "250-8BITMIME\r\n"
                     if self.ssl_context:
                         response += "250-STARTTLS\r\n"
@@ -152,6 +154,7 @@ def main():
     parser.add_argument('--key', default='/etc/letsencrypt/live/telemetry.fyi/privkey.pem',
                         help='Private key file')
     parser.add_argument('--no-tls', action='store_true', help='Disable TLS')
+    parser.add_argument('--server-name', help='Name announced in EHLO (default: FQDN, looked up once)')
     args = parser.parse_args()
     
     # Setup SSL context if certificates exist and TLS is enabled
@@ -166,7 +169,7 @@ def main():
         print("⚠️  TLS disabled by --no-tls flag")
     
     # Create and start server
-    server = SimpleSMTPServer(args.host, args.port, ssl_context)
+    server = SimpleSMTPServer(args.host, args.port, ssl_context, args.server_name)
     
     try:
         asyncio.run(server.start())